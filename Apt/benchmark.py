@@ -0,0 +1,331 @@
+###
+# Copyright (c) 2019, Valentin Lorentz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Measures how fast the Apt plugin answers queries on a synthetic repository.
+
+Run it with:
+
+    python3 Apt/benchmark.py --packages 5000 --files 20 --suites 3
+
+It doesn't use the network: it writes a repository of random packages
+(Packages, Sources and Contents files, compressed in several formats) in a
+temporary directory, and points the plugin's aptdir to it with file://
+sources.
+"""
+
+import os
+import sys
+import gzip
+import lzma
+import time
+import random
+import atexit
+import shutil
+import hashlib
+import tempfile
+import argparse
+import resource
+import collections
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+WORDS = '''robust user friendly python irc bot library tool daemon server
+client graphical terminal file system network utilities documentation data
+development headers plugin extension fast small simple secure modular
+compression image audio video parser kernel module driver shell editor
+'''.split()
+
+# Makes APT download Contents files, like apt-file does.
+CONTENTS_CONF = '''
+Acquire::IndexTargets {
+    deb::Contents-deb {
+        MetaKey "$(COMPONENT)/Contents-$(ARCHITECTURE)";
+        ShortDescription "Contents-$(ARCHITECTURE)";
+        Description "$(RELEASE)/$(COMPONENT) $(ARCHITECTURE) Contents (deb)";
+        KeepCompressed "true";
+    };
+};
+'''
+
+def get_compressors():
+    compressors = collections.OrderedDict([
+        ('none', lambda data: data),
+        ('gz', lambda data: gzip.compress(data, mtime=0)),
+        ('xz', lzma.compress),
+    ])
+    if lz4 is not None:
+        compressors['lz4'] = lz4.frame.compress
+    return compressors
+
+def make_packages(options):
+    """Returns a list of (name, version, description, depends, files)."""
+    packages = []
+    for i in range(options.packages):
+        name = 'pkg%i' % i
+        words = random.sample(WORDS, 8)
+        description = '%s %s\n %s.' % (
+            words[0], ' '.join(words[1:3]), ' '.join(words))
+        depends = ['pkg%i' % random.randrange(options.packages)
+                   for j in range(random.randrange(4))]
+        files = ['usr/share/doc/%s/changelog.gz' % name,
+                 'usr/bin/%s' % name]
+        files.extend('usr/lib/%s/%s%i.py' % (name, random.choice(WORDS), j)
+                     for j in range(options.files - len(files)))
+        packages.append((name, '1.%i-1' % i, description, depends, files))
+    return packages
+
+def write_index(suite_dir, path, data, compression, compressors, checksums):
+    """Writes an index file of the repository, and remembers its checksums
+    for the Release file."""
+    full_path = os.path.join(suite_dir, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    variants = [(path, data)]
+    if compression != 'none':
+        variants.append(('%s.%s' % (path, compression),
+                         compressors[compression](data)))
+    for (i, (variant_path, variant_data)) in enumerate(variants):
+        checksums.append((hashlib.sha256(variant_data).hexdigest(),
+                          len(variant_data), variant_path))
+        if compression == 'none' or i > 0:
+            with open(os.path.join(suite_dir, variant_path), 'wb') as fd:
+                fd.write(variant_data)
+
+def make_repository(repo_dir, packages, options):
+    """Writes one suite per compression format in repo_dir, and returns
+    their names."""
+    compressors = get_compressors()
+    suites = []
+    for i in range(options.suites):
+        compression = list(compressors)[i % len(compressors)]
+        suite = 'bench%i' % i
+        suite_dir = os.path.join(repo_dir, 'dists', suite)
+        checksums = []
+
+        stanzas = []
+        sources = []
+        contents = []
+        for (name, version, description, depends, files) in packages:
+            stanzas.append(
+                'Package: %s\nVersion: %s\nArchitecture: amd64\n'
+                'Maintainer: Nobody <nobody@example.org>\n'
+                'Installed-Size: %i\nDepends: %s\nPriority: optional\n'
+                'Section: utils\nFilename: pool/main/%s_%s_amd64.deb\n'
+                'Size: %i\nSHA256: %s\nDescription: %s\n' % (
+                    name, version, random.randrange(10, 10000),
+                    ', '.join(depends) or 'libc6', name, version,
+                    random.randrange(1000, 100000),
+                    hashlib.sha256(name.encode()).hexdigest(), description))
+            sources.append(
+                'Package: %s\nBinary: %s\nVersion: %s\n'
+                'Maintainer: Nobody <nobody@example.org>\n'
+                'Architecture: any\nFormat: 3.0 (quilt)\n'
+                'Directory: pool/main/%s\nChecksums-Sha256:\n'
+                ' %s 1000 %s_%s.dsc\n' % (
+                    name, name, version, name,
+                    hashlib.sha256(name.encode()).hexdigest(), name,
+                    version))
+            contents.extend('%-60s utils/%s\n' % (path, name)
+                            for path in files)
+        contents.sort()
+
+        write_index(suite_dir, 'main/binary-amd64/Packages',
+                    '\n'.join(stanzas).encode(), compression, compressors,
+                    checksums)
+        write_index(suite_dir, 'main/source/Sources',
+                    '\n'.join(sources).encode(), compression, compressors,
+                    checksums)
+        write_index(suite_dir, 'main/Contents-amd64',
+                    ''.join(contents).encode(), compression, compressors,
+                    checksums)
+
+        with open(os.path.join(suite_dir, 'Release'), 'w') as fd:
+            fd.write('Origin: Benchmark\nLabel: Benchmark\nSuite: %s\n'
+                     'Codename: %s\nVersion: %i\n'
+                     'Date: Sat, 01 Jan 2000 00:00:00 UTC\n'
+                     'Architectures: amd64\nComponents: main\n'
+                     'Description: %s-compressed lists\nSHA256:\n' %
+                     (suite, suite, i, compression))
+            for (checksum, size, path) in checksums:
+                fd.write(' %s %i %s\n' % (checksum, size, path))
+        suites.append((suite, compression))
+    return suites
+
+def write_aptdir(aptdir, repo_dir, suites):
+    os.makedirs(os.path.join(aptdir, 'etc', 'apt', 'apt.conf.d'))
+    with open(os.path.join(aptdir, 'etc', 'apt', 'sources.list'), 'w') as fd:
+        for (suite, compression) in suites:
+            fd.write('deb [trusted=yes arch=amd64] file://%s %s main\n'
+                     'deb-src [trusted=yes] file://%s %s main\n' %
+                     (repo_dir, suite, repo_dir, suite))
+    with open(os.path.join(aptdir, 'etc', 'apt', 'apt.conf.d',
+                           '50contents.conf'), 'w') as fd:
+        fd.write(CONTENTS_CONF)
+
+def get_rss():
+    """Returns the current resident memory of the process, in MB."""
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0
+
+def get_max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class FakeIrc(object):
+    """Just enough of supybot.callbacks.NestedCommandsIrcProxy for the Apt
+    commands."""
+    network = 'benchmark'
+
+    def __init__(self, cb):
+        self.cb = cb
+
+    def getCallback(self, name):
+        return self.cb
+
+    def error(self, s, Raise=False, **kwargs):
+        import supybot.callbacks as callbacks
+        raise callbacks.Error(s)
+
+class FakeMsg(object):
+    channel = None
+
+def main():
+    parser = argparse.ArgumentParser(description='Apt benchmark.')
+    parser.add_argument('--packages', type=int, default=5000,
+                        help='number of packages in each suite')
+    parser.add_argument('--files', type=int, default=20,
+                        help='number of files in each package')
+    parser.add_argument('--suites', type=int, default=3,
+                        help='number of suites; each one uses a different '
+                        'compression format: %s' %
+                        ', '.join(get_compressors()))
+    parser.add_argument('--queries', type=int, default=20,
+                        help='number of queries of each kind')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    random.seed(options.seed)
+
+    plugins_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, plugins_dir)
+    # Supybot writes its configuration and logs in the current directory.
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+    # Registered before Supybot is imported, so it runs after Supybot's own
+    # exit handlers.
+    atexit.register(shutil.rmtree, tmp_dir, True)
+    run(options, tmp_dir)
+
+def measure(name, f, args_list):
+    """Calls f on each of the arguments, and prints the latency."""
+    import supybot.callbacks as callbacks
+    times = []
+    for args in args_list:
+        before = time.perf_counter()
+        try:
+            f(*args)
+        except callbacks.Error:
+            pass
+        times.append(time.perf_counter() - before)
+    times.sort()
+    print('  %-30s median %8.2fms, max %8.2fms' %
+          (name, times[len(times)//2] * 1000, times[-1] * 1000))
+
+def run(options, tmp_dir):
+    import supybot.conf as conf
+    import supybot.log as log
+    log._stdoutHandler.setLevel(100)
+    import Apt
+    from Apt.plugin import filter_versions
+
+    start = time.time()
+    packages = make_packages(options)
+    suites = make_repository(os.path.join(tmp_dir, 'repo'), packages, options)
+    aptdir = conf.supybot.directories.data.dirize('aptdir')
+    write_aptdir(aptdir, os.path.join(tmp_dir, 'repo'), suites)
+    print('Repository of %i suites (%s) with %i packages and %i files '
+          'each written in %.1fs.' %
+          (len(suites), ', '.join(c for (s, c) in suites), len(packages),
+           options.files, time.time() - start))
+
+    # Measure the commands, not the cache of their results
+    conf.supybot.plugins.Apt.cache.results.setValue(0)
+    cb = Apt.Class(None)
+    irc = FakeIrc(cb)
+    msg = FakeMsg()
+    rss = get_rss()
+    start = time.time()
+    cb._update_cache()
+    print('Cache updated and indexes built in %.1fs, using %.0fMB more '
+          'memory.' % (time.time() - start, get_rss() - rss))
+
+    samples = random.sample(packages, min(options.queries, len(packages)))
+    print('Query latency (%i queries of each kind):' % len(samples))
+    for match in ('exact', 'basename', 'suffix', 'substring'):
+        if match == 'exact':
+            filenames = [files[-1] for (n, v, d, dep, files) in samples]
+        elif match == 'basename':
+            filenames = [os.path.basename(files[-1])
+                         for (n, v, d, dep, files) in samples]
+        else:
+            filenames = ['/'.join(files[-1].split('/')[-2:])
+                         for (n, v, d, dep, files) in samples]
+        measure('file packages --match %s' % match, cb.file._packages,
+                [(irc, msg, {}, match, filename) for filename in filenames])
+    measure('package search', cb.package._search,
+            [(irc, msg, {}, '%s*' % name[:-1])
+             for (name, v, d, dep, f) in samples])
+    measure('package search --description', cb.package._search,
+            [(irc, msg, {'description': True}, '*%s*' % random.choice(WORDS))
+             for i in range(len(samples))])
+    measure('package info', cb.package._info,
+            [(irc, msg, {}, name) for (name, v, d, dep, f) in samples])
+
+    def depends(package_name):
+        # Same as the 'package depends' command
+        versions = cb.package._get_package_versions(irc, package_name)
+        version = filter_versions(cb, irc, None, {}, versions)[0]
+        return version.get_dependencies('Depends', 'PreDepends')
+    measure('package depends', depends,
+            [(name,) for (name, v, d, dep, f) in samples])
+
+    print('Memory: %.0fMB resident, %.0fMB peak.' % (get_rss(), get_max_rss()))
+    cb.die()
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -54,6 +54,31 @@ conf.registerGlobalValue(Apt.cache, 'updateInterval',
     registry.NonNegativeInteger(3600*24, _("""Minimum interval before an
     automatic update of the cache, in seconds. Set to 0 to disable automatic
     updates.""")))
+conf.registerGlobalValue(Apt.cache, 'results',
+    registry.NonNegativeInteger(1000, _("""Number of results of commands
+    (package search, package info, file packages) kept in memory, so
+    repeated queries are answered immediately. They are dropped when the
+    cache is updated. Set to 0 to disable.""")))
+conf.registerGlobalValue(Apt.cache, 'descriptionIndex',
+    registry.Boolean(True, _("""Determines whether an index of the words in
+    package descriptions is built when the cache is opened or updated. It
+    makes 'package search --description' much faster.""")))
+conf.registerGlobalValue(Apt.cache, 'fileIndex',
+    registry.Boolean(True, _("""Determines whether an index of the files in
+    Contents lists is built when the cache is updated. It makes most
+    'file packages' lookups much faster, at the cost of some disk space and
+    longer updates.""")))
+
+conf.registerGroup(Apt, 'workers')
+conf.registerGlobalValue(Apt.workers, 'number',
+    registry.NonNegativeInteger(0, _("""Number of processes searching
+    Contents lists for 'file packages'. They are started on the first search
+    and kept for the next ones. Lists are split between them when there are
+    fewer lists than processes. Set to 0 to use one process per CPU.""")))
+conf.registerGlobalValue(Apt.workers, 'maxTasks',
+    registry.NonNegativeInteger(100, _("""Number of searches a process
+    runs before it is replaced by a new one, to release the memory it uses.
+    Set to 0 to never replace them.""")))
 
 conf.registerGroup(Apt, 'defaults')
 conf.registerChannelValue(Apt.defaults, 'archs',
@@ -68,6 +93,13 @@ conf.registerChannelValue(Apt.defaults, 'releases',
     registry.CommaSeparatedListOfStrings([], _("""Default value of --releases
     for commands that accept it. Comma-separated list of releases ("buster",
     "bionic", "stretch", "stretch-backports", ...). """)))
+class FileMatch(registry.OnlySomeStrings):
+    validStrings = ('exact', 'basename', 'suffix', 'substring')
+conf.registerChannelValue(Apt.defaults, 'match',
+    FileMatch('substring', _("""Default value of --match for commands that
+    accept it. Determines how filenames are compared with paths in
+    packages: the whole path (exact), its last component (basename), its end
+    (suffix), or any part of it (substring).""")))
 
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -30,10 +30,22 @@
 
 import os
 import re
+import gzip
+import lzma
+import mmap
 import time
+import array
+import bisect
+import heapq
+import pickle
+import struct
 import itertools
+import collections
 import threading
+import weakref
+import shutil
 import subprocess
+import tempfile
 import multiprocessing
 
 import apt
@@ -43,16 +55,33 @@ try:
     import lz4.frame
 except ImportError:
     lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from supybot import callbacks, utils
 from supybot.commands import wrap, commalist, getopts
 from supybot.i18n import PluginInternationalization
 import supybot.conf as conf
+import supybot.world as world
 
 
 _ = PluginInternationalization('Apt')
 
 
+# The APT configuration is global to the process, and other plugins (like
+# PackageInfo) change it too, so it is changed under this lock, kept in
+# supybot.world, which is shared by all plugins, as world.aptConfigLock.
+if not hasattr(world, 'aptConfigLock'):
+    world.aptConfigLock = threading.Lock()
+apt_config_lock = world.aptConfigLock
+# Options changed by opening a cache, including the ones apt.Cache sets
+# for its rootdir
+APT_CONFIG_KEYS = ('Dir', 'Dir::State::Lists', 'Dir::Cache',
+                   'Dir::State::status', 'Dir::bin::dpkg')
+
+
 def get_dependency_translations():
     """Returns a map from English names to locale names of dependency types.
     """
@@ -87,6 +116,10 @@ def get_priority_translations():
     }
 
 
+def open_uncompressed(filename):
+    return open(filename, 'rb')
+
+
 def get_file_opener(extension):
     """Returns a callable suitable for opening a file with the provided
     extension."""
@@ -97,6 +130,19 @@ def get_file_opener(extension):
             raise callbacks.Error(
                 _('Cannot open lz4 file, python3-lz4 0.23.1 or higher '
                   'is required.'))
+    elif extension == 'zst':
+        try:
+            return zstandard.open
+        except AttributeError:
+            raise callbacks.Error(
+                _('Cannot open zst file, python3-zstandard 0.15 or higher '
+                  'is required.'))
+    elif extension == 'gz':
+        return gzip.open
+    elif extension == 'xz':
+        return lzma.open
+    elif extension == '':
+        return open_uncompressed
     elif extension == 'diff_Index':
         return None
     else:
@@ -116,29 +162,397 @@ def read_chunk(fd, remainder):
     return (chunk, remainder, bool(new_data))
 
 
+def get_location_packages(locations):
+    """Returns the names of the packages in the last column of a line of
+    a Contents file, like 'admin/e2fsprogs,utils/foo'."""
+    return [location.rsplit(b'/', 1)[-1].decode()
+            for location in locations.split(b',')]
+
+
 def search_lines(pattern, fd):
-    """Reads the fd un chunks of lines, and runs pattern.finditer on each of
+    """Reads the fd in chunks of lines, and runs pattern.finditer on each of
     the chunks."""
-    remainder = b''
+    # Data is appended to and removed from the same buffer, and the pattern
+    # is run directly on it, instead of building new strings for each chunk.
+    buf = bytearray()
     while True:
-        (chunk, remainder, new_data) = read_chunk(fd, remainder)
-        yield from pattern.findall(chunk)
+        new_data = fd.read(1024*1024)
+        buf += new_data
+        if new_data:
+            end = buf.rfind(b'\n') + 1
+        else:
+            end = len(buf)
+        for match in pattern.finditer(buf, 0, end):
+            yield match.groups()
+        del buf[:end]
         if not new_data:
             break
 
+
+def search_mmap(pattern, mm, start, end):
+    """Runs pattern.finditer on the lines of a memory-mapped file that start
+    between the offsets start (inclusive) and end (exclusive)."""
+    if start:
+        # skip the end of the line started before 'start'
+        start = mm.find(b'\n', start - 1) + 1
+        if not start:
+            return
+    if end < len(mm):
+        # include the whole line containing 'end - 1'
+        end = mm.find(b'\n', end - 1) + 1 or len(mm)
+    for match in pattern.finditer(mm, start, end):
+        yield match.groups()
+
+
+# Patterns compiled by a worker of the pool, by (source, flags)
+_worker_patterns = None
+
+def init_search_worker():
+    """Initializer of the processes of the pool running search_file."""
+    global _worker_patterns
+    _worker_patterns = collections.OrderedDict()
+
+
+def get_worker_pattern(source, flags):
+    """Returns the compiled pattern, compiling it only once per worker."""
+    key = (source, flags)
+    try:
+        _worker_patterns.move_to_end(key)
+    except KeyError:
+        _worker_patterns[key] = re.compile(source, flags)
+        if len(_worker_patterns) > 100:
+            _worker_patterns.popitem(last=False)
+    return _worker_patterns[key]
+
+
 def search_file(args):
+    """Returns the packages of the lines of a Contents file matching the
+    pattern. If byte_range is not None, only searches in the lines starting
+    in this range. In the workers of the pool, the pattern is given as a
+    (source, flags) tuple."""
     results = set()
-    (pattern, list_filename, file_opener) = args
+    (pattern, list_filename, file_opener, byte_range) = args
+    if isinstance(pattern, tuple):
+        pattern = get_worker_pattern(*pattern)
+    if file_opener is open_uncompressed:
+        if os.path.getsize(list_filename) == 0:
+            # empty files can't be mapped
+            return results
+        with open(list_filename, 'rb') as fd, \
+                mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            (start, end) = byte_range or (0, len(mm))
+            for (locations,) in search_mmap(pattern, mm, start, end):
+                results.update(get_location_packages(locations))
+        return results
     with file_opener(list_filename) as fd:
-        for match in search_lines(pattern, fd):
-            results.add(match[1].decode())
+        for (locations,) in search_lines(pattern, fd):
+            results.update(get_location_packages(locations))
     return results
 
 
-def list_content_lists(plugin, irc, channel, filters, rootdir):
+def search_chunk(args):
+    """Returns the packages of the lines of a chunk of a decompressed
+    Contents file matching the pattern. In the workers of the pool, the
+    pattern is given as a (source, flags) tuple."""
+    (pattern, chunk) = args
+    if isinstance(pattern, tuple):
+        pattern = get_worker_pattern(*pattern)
+    results = set()
+    for match in pattern.finditer(chunk):
+        results.update(get_location_packages(match.group(1)))
+    return results
+
+
+# Uncompressed Contents files are split in ranges of this size, so a large
+# file can be searched by several workers.
+SCAN_CHUNK_SIZE = 32*1024*1024
+# Compressed Contents files are decompressed by the plugin and sent to the
+# workers in chunks of about this size.
+DECOMPRESSED_CHUNK_SIZE = 4*1024*1024
+
+
+def split_content_list(list_filename, file_opener):
+    """Returns the byte ranges a Contents file should be split in to be
+    searched, or [None] if it can't be split."""
+    if file_opener is not open_uncompressed:
+        # Compressed files can't be read from the middle
+        return [None]
+    size = os.path.getsize(list_filename)
+    if size <= SCAN_CHUNK_SIZE:
+        return [None]
+    return [(start, min(start + SCAN_CHUNK_SIZE, size))
+            for start in range(0, size, SCAN_CHUNK_SIZE)]
+
+
+def read_list_chunks(list_filename, file_opener,
+                     size=DECOMPRESSED_CHUNK_SIZE):
+    """Yields the decompressed content of a Contents file in chunks of
+    about size bytes, which end at line boundaries."""
+    with file_opener(list_filename) as fd:
+        remainder = b''
+        while True:
+            data = fd.read(size)
+            if not data:
+                if remainder:
+                    yield remainder
+                return
+            data = remainder + data
+            end = data.rfind(b'\n') + 1
+            (chunk, remainder) = (data[:end], data[end:])
+            if chunk:
+                yield chunk
+
+
+def get_search_tasks(pattern, lists, workers):
+    """Yields the (function, args) tasks searching the pattern in the
+    lists. Uncompressed lists are split in byte ranges. Compressed lists
+    can't be read from the middle: if there are at least as many lists as
+    workers, each worker decompresses whole lists; otherwise, they are
+    decompressed here and their chunks are searched by the workers, so all
+    the workers are used."""
+    split_compressed = len(lists) < workers
+    for (list_filename, opener) in lists:
+        if opener is open_uncompressed or not split_compressed:
+            for byte_range in split_content_list(list_filename, opener):
+                yield (search_file,
+                       (pattern, list_filename, opener, byte_range))
+        else:
+            for chunk in read_list_chunks(list_filename, opener):
+                yield (search_chunk, (pattern, chunk))
+
+
+def imap_bounded(pool, tasks, window):
+    """Runs the (function, args) tasks on the pool and yields their
+    results. Unlike pool.imap_unordered, the next task is only taken from
+    the iterator when fewer than window are pending, so the decompressed
+    chunks they carry are not all held in memory."""
+    pending = collections.deque()
+    for (function, args) in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(function, (args,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+FILE_INDEX_MAGIC = b'APTFIDX2'
+# Magic, number of records and of packages, then the signature of the
+# Contents file the index was built from.
+FILE_INDEX_HEADER = struct.Struct('<8sQQQqQ')
+FILE_INDEX_OFFSET = struct.Struct('<Q')
+# Records are sorted by runs of this many, written to temporary files and
+# merged, so the whole Contents file is never held in memory.
+FILE_INDEX_SORT_CHUNK = 1000000
+
+
+def get_file_signature(filename):
+    """Returns what identifies a version of a file: its size,
+    modification time, and inode."""
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def read_file_index_signature(index_filename):
+    """Returns the signature of the Contents file an index was built from,
+    or None if it is not a valid index."""
+    with open(index_filename, 'rb') as fd:
+        header = fd.read(FILE_INDEX_HEADER.size)
+    if len(header) != FILE_INDEX_HEADER.size:
+        return None
+    (magic, nb_records, nb_packages, *signature) = \
+        FILE_INDEX_HEADER.unpack(header)
+    if magic != FILE_INDEX_MAGIC:
+        return None
+    return tuple(signature)
+
+
+def _write_sorted_run(records, dirname):
+    records.sort()
+    fd = tempfile.TemporaryFile(dir=dirname)
+    fd.writelines(record + b'\n' for record in records)
+    fd.seek(0)
+    return fd
+
+
+def build_file_index(list_filename, file_opener, index_filename,
+                     chunk_size=FILE_INDEX_SORT_CHUNK):
+    """Reads a Contents file and writes an index of its paths to
+    index_filename.
+
+    The index is made of a header, two tables of offsets, then the records
+    and the package names they point to. Records are the reversed paths,
+    sorted, followed by the ids of their packages; so looking up a path by
+    its suffix is a binary search on the records."""
+    # Taken before reading, so a file changed meanwhile is indexed again.
+    signature = get_file_signature(list_filename)
+    dirname = os.path.dirname(index_filename)
+    package_ids = {}
+    records = []
+    runs = []
+    try:
+        with file_opener(list_filename) as fd:
+            remainder = b''
+            while True:
+                (chunk, remainder, new_data) = read_chunk(fd, remainder)
+                for line in chunk.split(b'\n'):
+                    try:
+                        (path, locations) = line.rsplit(None, 1)
+                    except ValueError:
+                        continue
+                    ids = []
+                    for location in locations.split(b','):
+                        package = location.rsplit(b'/', 1)[-1]
+                        id_ = package_ids.setdefault(package,
+                                                     len(package_ids))
+                        ids.append(b'%d' % id_)
+                    records.append(
+                        path.strip()[::-1] + b'\0' + b','.join(ids))
+                    if len(records) >= chunk_size:
+                        runs.append(_write_sorted_run(records, dirname))
+                        records = []
+                if not new_data:
+                    break
+        runs.append(_write_sorted_run(records, dirname))
+        records = None
+        packages = sorted(package_ids, key=package_ids.get)
+
+        # Records are merged into a temporary file while their offsets
+        # (relative to the first record) are computed.
+        record_offsets = array.array('Q')
+        size = 0
+        with tempfile.TemporaryFile(dir=dirname) as records_fd:
+            for record in heapq.merge(*runs):
+                record_offsets.append(size)
+                records_fd.write(record[:-1])
+                size += len(record) - 1
+            records_fd.seek(0)
+
+            nb_records = len(record_offsets)
+            start = FILE_INDEX_HEADER.size + \
+                FILE_INDEX_OFFSET.size * (nb_records + len(packages) + 2)
+            tmp_filename = index_filename + '.tmp'
+            with open(tmp_filename, 'wb') as fd:
+                fd.write(FILE_INDEX_HEADER.pack(
+                    FILE_INDEX_MAGIC, nb_records, len(packages), *signature))
+                # Offsets of the records and packages, plus the end of the
+                # last one
+                for offset in record_offsets:
+                    fd.write(FILE_INDEX_OFFSET.pack(start + offset))
+                offset = start + size
+                for item in itertools.chain([b''], packages):
+                    fd.write(FILE_INDEX_OFFSET.pack(offset))
+                    offset += len(item)
+                fd.write(FILE_INDEX_OFFSET.pack(offset))
+                shutil.copyfileobj(records_fd, fd)
+                fd.writelines(packages)
+    finally:
+        for run in runs:
+            run.close()
+    os.replace(tmp_filename, index_filename)
+
+
+class FileIndex:
+    """Memory-mapped index written by build_file_index."""
+    def __init__(self, index_filename):
+        with open(index_filename, 'rb') as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self._nb_records, self._nb_packages, *_) = \
+            FILE_INDEX_HEADER.unpack_from(self._mmap, 0)
+        if magic != FILE_INDEX_MAGIC:
+            self.close()
+            raise ValueError('%s is not a file index' % index_filename)
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_item(self, i):
+        """Returns the i-th item of the index; records come first, then
+        package names."""
+        position = FILE_INDEX_HEADER.size + FILE_INDEX_OFFSET.size * i
+        (start,) = FILE_INDEX_OFFSET.unpack_from(self._mmap, position)
+        (end,) = FILE_INDEX_OFFSET.unpack_from(
+            self._mmap, position + FILE_INDEX_OFFSET.size)
+        return self._mmap[start:end]
+
+    def _get_record(self, i):
+        return self._get_item(i).split(b'\0', 1)
+
+    def _get_package(self, id_):
+        return self._get_item(self._nb_records + 1 + id_).decode()
+
+    def search(self, suffix, exact=False):
+        """Returns the set of packages containing a path that ends with
+        the given suffix (or is equal to it, if exact is True)."""
+        key = suffix[::-1]
+        (low, high) = (0, self._nb_records)
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        packages = set()
+        for i in range(low, self._nb_records):
+            (record_key, ids) = self._get_record(i)
+            if not record_key.startswith(key):
+                break
+            if exact and record_key != key:
+                continue
+            packages.update(self._get_package(int(id_))
+                            for id_ in ids.split(b','))
+        return packages
+
+
+def search_file_index(index_filename, match, filename):
+    """Looks up a filename in an index built by build_file_index, using
+    one of the 'exact', 'basename', and 'suffix' match types."""
+    with FileIndex(index_filename) as index:
+        if match == 'exact':
+            return index.search(filename.lstrip(b'/'), exact=True)
+        elif match == 'basename':
+            return index.search(b'/' + filename) | \
+                index.search(filename, exact=True)
+        elif match == 'suffix':
+            return index.search(filename)
+        else:
+            raise ValueError('Unknown match type: %s' % match)
+
+
+def get_file_pattern(match, filename):
+    """Returns a pattern suitable for search_file matching the given
+    filename with one of the match types."""
+    if match == 'exact':
+        filename = filename.lstrip(b'/')
+    filename = re.escape(filename)
+    # You may want to add '^.*' at the beginning of the pattern; but
+    # don't do that because the regexp then becomes much slower (6s for
+    # a 500MB list, instead of 0.3s).
+    # Given that we're matching end of lines, a line can't be matched
+    # twice anyway because matches can't overlap.
+    # The last column is the comma-separated list of the packages
+    # containing the file, as section/name.
+    if match == 'exact':
+        pattern = rb'^/?%s\s+(\S+/\S+)$'
+    elif match == 'basename':
+        pattern = rb'(?:^|/)%s\s+(\S+/\S+)$'
+    elif match == 'suffix':
+        pattern = rb'%s\s+(\S+/\S+)$'
+    else:
+        pattern = rb'%s.*\s+(\S+/\S+)$'
+    return re.compile(pattern % filename, re.MULTILINE)
+
+
+def list_content_lists(plugin, irc, channel, filters, rootdir, slot=None):
     """Returns a list of '/var/lib/apt/lists/*_Contents-*' and functions
-    suitable to open them"""
-    index_targets = plugin._call_apt_get(['indextargets'])
+    suitable to open them. The lists are the ones of the given slot, or of
+    the current one."""
+    index_targets = plugin._call_apt_get(['indextargets'], slot)
     entries = list(debian.deb822.Deb822.iter_paragraphs(index_targets))
 
     archs = get_filter_config(plugin, irc, channel, filters, 'archs')
@@ -176,9 +590,12 @@ def list_content_lists(plugin, irc, channel, filters, rootdir):
         list_filenames.append(entry['Filename'])
 
     for list_filename in list_filenames:
-        (_, extension) = os.path.splitext(list_filename)
+        # Can't use os.path.splitext, because file names contain the domain
+        # name of the repository (eg. deb.debian.org_debian_..._Contents-amd64)
+        (_, _, extension) = list_filename.rpartition('Contents-')[2] \
+            .partition('.')
         try:
-            file_opener = get_file_opener(extension.strip('.'))
+            file_opener = get_file_opener(extension)
         except ValueError:
             raise ValueError(
                 'Could not find opener for file %s' % list_filename)
@@ -226,6 +643,9 @@ def add_filters_doc(f):
     return f
 
 
+FILE_MATCH_TYPES = ('exact', 'basename', 'suffix', 'substring')
+
+
 FILTERS_OPTLIST = {
     'archs': commalist('something'),
     'distribs': commalist('something'),
@@ -233,20 +653,167 @@ FILTERS_OPTLIST = {
 }
 
 
-def origins_with_version(pkg_version):
-    """Same as the pkg_version.origins property, but adds a 'version'
-    attribute to origins"""
-    origins = []
-    for (packagefile, _unused) in pkg_version._cand.file_list:
-        if hasattr(pkg_version.package._pcache, '_origins'):
-            # python-apt >= 1.9.3:
-            origin = pkg_version.package._pcache._origins[packagefile.id]
+DESCRIPTION_WORD_REGEXP = re.compile(r'\w+')
+
+
+def get_cache_signature(cache):
+    """Returns a value that changes when the package lists used by an
+    apt.Cache change."""
+    signature = []
+    for package_file in cache._cache.file_list:
+        try:
+            mtime = os.stat(package_file.filename).st_mtime
+        except (OSError, TypeError):
+            continue
+        signature.append((package_file.filename, mtime))
+    return tuple(sorted(signature))
+
+
+class DescriptionIndex:
+    """Inverted index from the words of package descriptions to the names
+    of the packages whose descriptions contain them."""
+    def __init__(self, signature, names, words):
+        self.signature = signature
+        self._names = names
+        self._words = words
+        self._sorted_words = sorted(words)
+
+    @classmethod
+    def build(cls, cache):
+        """Builds the index of an open apt.Cache"""
+        signature = get_cache_signature(cache)
+        names = []
+        words = collections.defaultdict(lambda: array.array('I'))
+        # Reading records with apt_pkg is much faster than building
+        # apt.Package and apt.Version instances
+        records = apt_pkg.PackageRecords(cache._cache)
+        for package in cache._cache.packages:
+            if not package.version_list:
+                # virtual package
+                continue
+            package_words = set()
+            for version in package.version_list:
+                description = version.translated_description
+                if description is None or not description.file_list:
+                    continue
+                records.lookup(description.file_list[0])
+                package_words.update(
+                    DESCRIPTION_WORD_REGEXP.findall(records.long_desc.lower()))
+            id_ = len(names)
+            names.append(package.get_fullname(True))
+            for word in package_words:
+                words[word].append(id_)
+        return cls(signature, names, dict(words))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as fd:
+            (signature, names, words) = pickle.load(fd)
+        return cls(signature, names, words)
+
+    def save(self, filename):
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as fd:
+            pickle.dump((self.signature, self._names, self._words), fd)
+        os.replace(tmp_filename, filename)
+
+    def _get_ids(self, word, open_left, open_right):
+        """Returns the ids of packages containing a word that is equal to
+        the given word, or ends with it if open_left is True, and/or
+        starts with it if open_right is True."""
+        if not open_left and not open_right:
+            return set(self._words.get(word, ()))
+        ids = set()
+        if open_left:
+            if open_right:
+                matching_words = (w for w in self._sorted_words if word in w)
+            else:
+                matching_words = (w for w in self._sorted_words
+                                  if w.endswith(word))
         else:
-            # python-apt <= 1.9.0:
-            origin = apt.package.Origin(pkg_version.package, packagefile)
-        origin.version = packagefile.version
-        origins.append(origin)
-    return origins
+            start = bisect.bisect_left(self._sorted_words, word)
+            matching_words = itertools.takewhile(
+                lambda w: w.startswith(word),
+                itertools.islice(self._sorted_words, start, None))
+        for matching_word in matching_words:
+            ids.update(self._words[matching_word])
+        return ids
+
+    def search(self, glob):
+        """Returns the names of packages whose description may match the
+        glob; or None if the index can't restrict the search."""
+        if '[' in glob:
+            # Character classes are not worth parsing here
+            return None
+        ids = None
+        segments = re.split(r'[*?]', glob)
+        for (i, segment) in enumerate(segments):
+            for match in DESCRIPTION_WORD_REGEXP.finditer(segment.lower()):
+                # A word next to a wildcard may be part of a longer word
+                # in the description.
+                open_left = match.start() == 0 and i > 0
+                open_right = match.end() == len(segment) \
+                    and i < len(segments) - 1
+                word_ids = self._get_ids(
+                    match.group(0), open_left, open_right)
+                ids = word_ids if ids is None else ids & word_ids
+                if not ids:
+                    return set()
+        if ids is None:
+            return None
+        return {self._names[id_] for id_ in ids}
+
+
+def get_filters_key(plugin, irc, channel, filters):
+    """Returns a hashable value of the filters that apply to a command, for
+    use in keys of the result cache."""
+    return tuple(
+        tuple(get_filter_config(plugin, irc, channel, filters, name) or ())
+        for name in ('archs', 'distribs', 'releases'))
+
+
+class ResultCache:
+    """LRU cache of the results of commands."""
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key, f):
+        """Returns the result for this key if it is cached, else calls f
+        and caches its return value."""
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+            self.misses += 1
+        result = f()
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+def get_origin_table(cache):
+    """Returns a dict from the ids of the package files of an apt.Cache to
+    their (label, archive, codename, version), lower-cased."""
+    return {
+        package_file.id: tuple(
+            (value or '').lower()
+            for value in (package_file.label, package_file.archive,
+                          package_file.codename, package_file.version))
+        for package_file in cache._cache.file_list}
 
 
 def filter_versions(plugin, irc, channel, filters, versions):
@@ -261,38 +828,43 @@ def filter_versions(plugin, irc, channel, filters, versions):
         versions = [version for version in versions
                     if version.architecture in archs]
 
-    # Spare round-trips to the C code to build the origin list:
-    versions = [(version, origins_with_version(version)) for version in versions]
-
     def filter_on_origins(pred):
+        # Package files matching the filter are found once in the origin
+        # table, then versions are filtered by the ids of their package
+        # files, instead of building apt.package.Origin objects for each
+        # of them.
         nonlocal versions
+        origins = plugin._get_origin_table(versions[0].package._pcache)
+        file_ids = {id_ for (id_, origin) in origins.items() if pred(*origin)}
         versions = [
-            (version, origins) for (version, origins) in versions
-            if any(map(pred, origins))]
+            version for version in versions
+            if any(package_file.id in file_ids
+                   for (package_file, _unused) in version._cand.file_list)]
 
     distribs = get_filter_config(plugin, irc, channel, filters, 'distribs')
-    if distribs:
+    if distribs and versions:
         distribs = [distrib.lower() for distrib in distribs]
-        filter_on_origins(lambda origin: origin.label.lower() in distribs)
+        filter_on_origins(lambda label, archive, codename, version:
+                          label in distribs)
 
     releases = get_filter_config(plugin, irc, channel, filters, 'releases')
-    if releases:
+    if releases and versions:
         releases = [release.lower() for release in releases]
         # Examples:
         # * in Debian, origin.archive='stable' and origin.codename='buster'
         # * in Ubuntu, origin.archive='bionic' and origin.codename='bionic'
         # So checking both allows supporting both version names and
         # stable/testing/...
-        filter_on_origins(lambda origin: (
-            origin.archive.lower() in releases
-            or origin.codename.lower() in releases
-            or origin.version.lower() in releases))
+        filter_on_origins(lambda label, archive, codename, version: (
+            archive in releases
+            or codename in releases
+            or version in releases))
 
     if not versions:
         irc.error(_('Package exists, but no version is found.'),
                   Raise=True)
 
-    return [version for (version, origins) in versions]
+    return versions
 
 
 class Apt(callbacks.Plugin):
@@ -300,16 +872,220 @@ class Apt(callbacks.Plugin):
     threaded = True
 
     _cache = None
+    _cache_slot = None
     _cache_last_update = 0
     _cache_lock = threading.Lock()
 
+    _update_lock = threading.Lock()
+    _update_thread = None
+    _update_error = None
+    # Weak references to the cache opened on each slot, so the lists of a
+    # slot are not replaced while queries still use its cache.
+    _slot_caches = None
+    # (time to update the lists, time including indexes) of the last
+    # updates
+    _update_durations = ()
+
+    _cache_generation = 0
+    _results = None
+    # (weak reference to a cache, its origin table); the reference is weak
+    # so the table doesn't keep the cache of a replaced slot in use.
+    _origin_table = (None, None)
+
+    _description_index = None
+    _description_index_lock = threading.Lock()
+
+    _pool = None
+    _pool_config = None
+    _pool_lock = threading.Lock()
+    # Number of searches running on each pool, including the pools replaced
+    # after a configuration change, which are joined when their searches
+    # are done.
+    _pool_users = None
+
     def die(self):
         if self._cache:
             self._cache.close()
+        with self._pool_lock:
+            pools = set(self._pool_users or ())
+            if self._pool:
+                pools.add(self._pool)
+            self._pool = None
+            self._pool_users = None
+        for pool in pools:
+            pool.terminate()
+            pool.join()
+
+    def _get_pool(self):
+        """Returns the pool of workers searching Contents files, starting
+        it if it is not running yet or if its configuration changed.
+        _release_pool() must be called when the search is done."""
+        size = self.registryValue('workers.number') or None
+        max_tasks = self.registryValue('workers.maxTasks') or None
+        old_pool = None
+        with self._pool_lock:
+            if self._pool_users is None:
+                self._pool_users = {}
+            if self._pool and self._pool_config != (size, max_tasks):
+                # Searches already running on it can finish.
+                self._pool.close()
+                if not self._pool_users.get(self._pool):
+                    self._pool_users.pop(self._pool, None)
+                    old_pool = self._pool
+                self._pool = None
+            if not self._pool:
+                self._pool = multiprocessing.Pool(
+                    processes=size, maxtasksperchild=max_tasks,
+                    initializer=init_search_worker)
+                self._pool_config = (size, max_tasks)
+            pool = self._pool
+            self._pool_users[pool] = self._pool_users.get(pool, 0) + 1
+        if old_pool:
+            old_pool.join()
+        return pool
+
+    def _release_pool(self, pool):
+        with self._pool_lock:
+            if not self._pool_users or pool not in self._pool_users:
+                # Terminated by die()
+                return
+            self._pool_users[pool] -= 1
+            retired = pool is not self._pool and not self._pool_users[pool]
+            if retired:
+                del self._pool_users[pool]
+        if retired:
+            pool.join()
+
+    def _get_results(self):
+        size = self.registryValue('cache.results')
+        if self._results is None or self._results.size != size:
+            self._results = ResultCache(size)
+        return self._results
+
+    def _get_cached_result(self, key, f):
+        """Returns the result of f(), which may be cached from a previous
+        call with the same key during the current generation of the APT
+        cache. Errors raised by f() are cached too."""
+        def compute():
+            try:
+                return (True, f())
+            except callbacks.Error as e:
+                return (False, str(e))
+        if not self.registryValue('cache.results'):
+            (success, result) = compute()
+        else:
+            (success, result) = self._get_results().get(
+                (self._cache_generation,) + key, compute)
+        if not success:
+            raise callbacks.Error(result)
+        return result
+
+    def _new_generation(self):
+        """Called after the APT cache is updated, to invalidate results
+        computed from the previous lists."""
+        self._cache_generation += 1
+        if self._results is not None:
+            self._results.clear()
+
+    def _get_origin_table(self, cache):
+        """Returns the origin table of the cache, computed once per cache."""
+        (table_cache, table) = self._origin_table
+        if table_cache is None or table_cache() is not cache:
+            table = get_origin_table(cache)
+            self._origin_table = (weakref.ref(cache), table)
+        return table
 
     def _get_cache_dir(self):
         return conf.supybot.directories.data.dirize('aptdir')
 
+    def _get_slot_dirs(self, slot):
+        """Returns the directories of the lists and binary caches of a slot.
+        The cache is updated in the slot that is not in use, so queries
+        can still use the other one meanwhile."""
+        slot_dir = os.path.join(self._get_cache_dir(), 'slots', slot)
+        return (os.path.join(slot_dir, 'lists'),
+                os.path.join(slot_dir, 'cache'))
+
+    def _get_slot(self):
+        """Returns the name of the slot the cache was last updated in."""
+        if self._cache_slot:
+            return self._cache_slot
+        try:
+            with open(os.path.join(self._get_cache_dir(), 'slot')) as fd:
+                return fd.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _set_slot(self, slot):
+        filename = os.path.join(self._get_cache_dir(), 'slot')
+        with open(filename + '.tmp', 'w') as fd:
+            fd.write(slot)
+        os.replace(filename + '.tmp', filename)
+
+    def _open_slot(self, slot, update):
+        """Returns a new apt.Cache on the lists of the slot, after updating
+        them if update is True. Must be called with _update_lock held."""
+        (lists_dir, cache_dir) = self._get_slot_dirs(slot)
+        os.makedirs(os.path.join(lists_dir, 'partial'), exist_ok=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        if update:
+            # apt-get is given the directories of the slot as options, so
+            # the global APT configuration (and its lock, shared with other
+            # plugins) is not held during the download. It needs the dpkg
+            # status file, which apt.Cache only creates when it opens.
+            status_filename = os.path.join(
+                self._get_cache_dir(), 'var', 'lib', 'dpkg', 'status')
+            os.makedirs(os.path.dirname(status_filename), exist_ok=True)
+            open(status_filename, 'a').close()
+            self._call_apt_get(['update'], slot, check=True)
+        # The APT configuration is global to the process, so it is restored
+        # once the cache is open.
+        with apt_config_lock:
+            saved = {key: apt_pkg.config.get(key)
+                     for key in APT_CONFIG_KEYS}
+            try:
+                apt_pkg.config.set('Dir::State::Lists', lists_dir)
+                apt_pkg.config.set('Dir::Cache', cache_dir)
+                cache = apt.Cache(rootdir=self._get_cache_dir())
+            finally:
+                for (key, value) in saved.items():
+                    apt_pkg.config.set(key, value)
+        if self._slot_caches is None:
+            self._slot_caches = {}
+        self._slot_caches[slot] = weakref.ref(cache)
+        return cache
+
+    def _get_free_slot(self, current_slot):
+        """Returns the first slot that is not the current one and whose
+        cache is not used anymore. Must be called with _update_lock held."""
+        for i in itertools.count():
+            slot = chr(ord('a') + i)
+            ref = (self._slot_caches or {}).get(slot)
+            if slot != current_slot and (ref is None or ref() is None):
+                return slot
+
+    def _copy_lists(self, source_dir, slot):
+        """Replaces the lists of the slot with hard links to the lists in
+        source_dir, so the update only downloads the lists that changed.
+        APT replaces lists instead of writing them in place, so the lists
+        of source_dir are not modified by the update."""
+        (lists_dir, _unused) = self._get_slot_dirs(slot)
+        os.makedirs(os.path.join(lists_dir, 'partial'), exist_ok=True)
+        for name in os.listdir(lists_dir):
+            path = os.path.join(lists_dir, name)
+            if os.path.isfile(path):
+                os.unlink(path)
+        if not os.path.isdir(source_dir):
+            return
+        for name in os.listdir(source_dir):
+            path = os.path.join(source_dir, name)
+            if name == 'lock' or not os.path.isfile(path):
+                continue
+            try:
+                os.link(path, os.path.join(lists_dir, name))
+            except OSError:
+                shutil.copy2(path, os.path.join(lists_dir, name))
+
     def _should_update(self):
         """Is the cache older than the configured interval?"""
         interval = self.registryValue('cache.updateInterval')
@@ -318,43 +1094,231 @@ class Apt(callbacks.Plugin):
         return self._cache_last_update + interval < time.time()
 
     def _get_cache(self):
-        """Get the current cache if any, else open it. Also performs an update
-        if the cache is expired (wrt. the updateInterval)."""
-        is_open = False
+        """Get the current cache if any, else open it. Also starts an update
+        in the background if the cache is expired (wrt. the
+        updateInterval)."""
+        cache = self._cache
+        if cache is None:
+            cache = self._open_cache()
+        if self._should_update():
+            self._start_update()
+        return cache
+
+    def _get_legacy_lists_dir(self):
+        """Returns the directory of the lists downloaded by previous
+        versions of this plugin, before slots were used."""
+        return os.path.join(
+            self._get_cache_dir(), 'var', 'lib', 'apt', 'lists')
+
+    def _adopt_legacy_lists(self):
+        """Links the lists downloaded by previous versions of this plugin
+        in a slot, so they are used until the next update, instead of
+        waiting for one. Returns the slot, or None if there are no such
+        lists. Must be called with _update_lock held."""
+        source_dir = self._get_legacy_lists_dir()
+        if not os.path.isdir(source_dir):
+            return None
+        mtimes = [os.path.getmtime(os.path.join(source_dir, name))
+                  for name in os.listdir(source_dir)
+                  if name != 'lock' and
+                  os.path.isfile(os.path.join(source_dir, name))]
+        if not mtimes:
+            return None
+        slot = self._get_free_slot(None)
+        self._copy_lists(source_dir, slot)
+        self._set_slot(slot)
+        # The time of the last update is the modification time of the slot
+        # file; the next update is started when the lists are too old.
+        os.utime(os.path.join(self._get_cache_dir(), 'slot'),
+                 (max(mtimes), max(mtimes)))
+        return slot
+
+    def _remove_old_slots(self):
+        """Removes the directories of the slots that are not the current
+        one and whose cache is not used anymore, and the lists of previous
+        versions of this plugin. Must be called with _update_lock held."""
+        slots_dir = os.path.join(self._get_cache_dir(), 'slots')
+        for slot in os.listdir(slots_dir):
+            ref = (self._slot_caches or {}).get(slot)
+            if slot != self._cache_slot and (ref is None or ref() is None):
+                shutil.rmtree(os.path.join(slots_dir, slot),
+                              ignore_errors=True)
+        shutil.rmtree(self._get_legacy_lists_dir(), ignore_errors=True)
+
+    def _open_cache(self):
+        """Opens the cache on the lists of the last update, or on the lists
+        of previous versions of this plugin, or updates them if there are
+        none yet."""
+        with self._update_lock:
+            cache = self._cache
+            slot = self._get_slot()
+            if cache is None and not slot:
+                slot = self._adopt_legacy_lists()
+            if cache is None and slot:
+                cache = self._open_slot(slot, update=False)
+                with self._cache_lock:
+                    self._cache = cache
+                    self._cache_slot = slot
+                    self._cache_last_update = os.stat(os.path.join(
+                        self._get_cache_dir(), 'slot')).st_mtime
+        if cache is None:
+            self._start_update().join()
+            cache = self._cache
+            if cache is None:
+                raise self._update_error or \
+                    callbacks.Error(_('Could not update the APT cache.'))
+            return cache
+        self._load_description_index(cache)
+        return cache
+
+    def _start_update(self):
+        """Starts updating the cache in a thread, unless an update is
+        already running, and returns the thread."""
         with self._cache_lock:
-            if not self._cache:
-                self._cache = apt.Cache(rootdir=self._get_cache_dir())
-                is_open = False
-            else:
-                # The cache is already instantiated, assume it's open.
-                is_open = True
-            if self._should_update():
-                if is_open:
-                    self._cache.close()
-                    is_open = False
-                self._cache.update()
-                self._cache_last_update = time.time()
-            if not is_open:
-                self._cache.open()
-            return self._cache
+            if self._update_thread and self._update_thread.is_alive():
+                return self._update_thread
+            self._update_thread = threading.Thread(
+                target=self._background_update, name='Apt update',
+                daemon=True)
+            self._update_thread.start()
+            return self._update_thread
+
+    def _background_update(self):
+        self._update_error = None
+        try:
+            self._update_cache()
+        except Exception as e:
+            self.log.exception('Could not update the APT cache.')
+            self._update_error = e
+            # Don't retry before the next interval
+            self._cache_last_update = time.time()
 
     def _update_cache(self):
-        """Equivalent to 'apt-get update'"""
-        with self._cache_lock:
-            if self._cache:
-                self._cache.close()
-                self._cache.update()
-                self._cache.open()
+        """Equivalent to 'apt-get update'. The lists are updated in a slot
+        that is not in use, and indexed, then the new cache replaces the
+        current one, so queries are not blocked by the update. Use
+        _start_update() instead, so only one update runs at a time."""
+        start = time.time()
+        with self._update_lock:
+            current_slot = self._get_slot()
+            if current_slot:
+                source_dir = self._get_slot_dirs(current_slot)[0]
             else:
-                self._cache = apt.Cache(rootdir=self._get_cache_dir())
-                self._cache.update()
-                self._cache.open()
+                source_dir = self._get_legacy_lists_dir()
+            new_slot = self._get_free_slot(current_slot)
+            self._copy_lists(source_dir, new_slot)
+            cache = self._open_slot(new_slot, update=True)
+            lists_time = time.time()
+            self._build_file_indexes(new_slot)
+            description_index = self._get_description_index(cache)
+            self._set_slot(new_slot)
+            with self._cache_lock:
+                # The previous cache is not closed, because queries may
+                # still be using it. It is freed when they are done.
+                self._cache = cache
+                self._cache_slot = new_slot
+                self._cache_last_update = time.time()
+                self._description_index = description_index
+                self._origin_table = (None, None)
+                self._new_generation()
+            self._remove_old_slots()
+        end = time.time()
+        self._update_durations = self._update_durations[-9:] + \
+            ((lists_time - start, end - start),)
+        self.log.info('APT cache updated in %.1fs (indexes built in %.1fs).',
+                      lists_time - start, end - lists_time)
+        return cache
+
+    def _load_description_index(self, cache):
+        """Loads the index of package descriptions of the cache, or builds
+        it if the lists changed since it was saved."""
+        index = self._get_description_index(cache)
+        with self._cache_lock:
+            self._description_index = index
 
-    def _call_apt_get(self, args):
-        self._get_cache()
+    def _get_description_index(self, cache):
+        """Returns the index of package descriptions of the cache, loaded
+        from the disk, or built if the lists changed since it was saved."""
+        if not self.registryValue('cache.descriptionIndex'):
+            return None
+        filename = os.path.join(self._get_cache_dir(), 'descriptions.index')
+        with self._description_index_lock:
+            signature = get_cache_signature(cache)
+            index = self._description_index
+            if index and index.signature == signature:
+                return index
+            try:
+                index = DescriptionIndex.load(filename)
+            except FileNotFoundError:
+                index = None
+            except Exception:
+                self.log.exception('Could not load %s, rebuilding it.',
+                                   filename)
+                index = None
+            if not index or index.signature != signature:
+                index = DescriptionIndex.build(cache)
+                index.save(filename)
+            return index
+
+    def _get_file_index_dir(self):
+        return os.path.join(self._get_cache_dir(), 'fileindex')
+
+    def _get_file_index(self, list_filename):
+        """Returns the path to the index of a Contents file, or None if it
+        was not built from this version of the Contents file."""
+        index_filename = os.path.join(
+            self._get_file_index_dir(),
+            os.path.basename(list_filename) + '.index')
+        try:
+            signature = read_file_index_signature(index_filename)
+            if signature != get_file_signature(list_filename):
+                return None
+        except FileNotFoundError:
+            return None
+        return index_filename
+
+    def _build_file_indexes(self, slot):
+        """Builds the index of each Contents file of the slot that changed
+        since its index was built, and removes indexes of Contents files
+        that are not used anymore."""
+        if not self.registryValue('cache.fileIndex'):
+            return
+        index_dir = self._get_file_index_dir()
+        os.makedirs(index_dir, exist_ok=True)
+        # Index all Contents files, whatever the configured filters are.
+        filters = {'archs': ['*'], 'distribs': ['*'], 'releases': ['*']}
+        index_filenames = set()
+        for (list_filename, opener) in list_content_lists(
+                self, None, None, filters, self._get_cache_dir(), slot):
+            index_filename = os.path.join(
+                index_dir, os.path.basename(list_filename) + '.index')
+            index_filenames.add(index_filename)
+            if self._get_file_index(list_filename) is None:
+                build_file_index(list_filename, opener, index_filename)
+        for filename in os.listdir(index_dir):
+            if filename.endswith('.tmp'):
+                continue
+            filename = os.path.join(index_dir, filename)
+            if filename not in index_filenames:
+                os.unlink(filename)
+
+    def _call_apt_get(self, args, slot=None, check=False):
+        """Runs apt-get on the lists of the slot (or of the current cache)
+        and returns its output. If check is True, raises an error if it
+        fails."""
+        if slot is None:
+            self._get_cache()
+            slot = self._get_slot()
+        (lists_dir, cache_dir) = self._get_slot_dirs(slot)
         p = subprocess.run(
-            ['apt-get', '-o', 'Dir=%s' % apt_pkg.config.get('Dir')] + args,
+            ['apt-get', '-o', 'Dir=%s' % os.path.abspath(
+                self._get_cache_dir()),
+             '-o', 'Dir::State::Lists=%s' % lists_dir,
+             '-o', 'Dir::Cache=%s' % cache_dir] + args,
             capture_output=True)
+        if check and p.returncode != 0:
+            raise callbacks.Error(_('apt-get %s failed: %s') % (
+                ' '.join(args), p.stderr.decode(errors='replace').strip()))
         return p.stdout
 
     @wrap([('checkCapability', 'trusted')])
@@ -362,9 +1326,33 @@ class Apt(callbacks.Plugin):
         """takes no arguments
 
         Updates the APT cache from repositories."""
-        self._update_cache()
+        self._start_update().join()
+        if self._update_error:
+            irc.error(_('Could not update the APT cache: %s') %
+                      self._update_error, Raise=True)
         irc.replySuccess()
 
+    @wrap([])
+    def stats(self, irc, msg, args):
+        """takes no arguments
+
+        Returns the number of hits and misses of the cache of command
+        results, and how long the last updates took."""
+        results = self._get_results()
+        reply = format(
+            _('%n cached for generation %i of the APT cache, %n, %n.'),
+            (len(results), _('result')), self._cache_generation,
+            (results.hits, _('hit')), (results.misses, _('miss')))
+        if self._update_durations:
+            (swap_duration, total_duration) = self._update_durations[-1]
+            average = sum(total for (swap, total) in self._update_durations) \
+                / len(self._update_durations)
+            reply += ' ' + format(
+                _('Last update took %.1fs, %.1fs including indexes '
+                  '(%.1fs on average).'),
+                swap_duration, total_duration, average)
+        irc.reply(reply)
+
     class file(callbacks.Commands):
         def plugin(self, irc):
             return irc.getCallback('Apt')
@@ -372,45 +1360,70 @@ class Apt(callbacks.Plugin):
         @wrap([
             getopts({
                 **FILTERS_OPTLIST,
+                'match': ('literal', FILE_MATCH_TYPES),
             }),
             'something',
         ])
         @add_filters_doc
         def packages(self, irc, msg, args, opts, filename):
-            """%s <filename>
+            """%s [--match {exact,basename,suffix,substring}] <filename>
 
-            Lists packages that contain the given filename. %s"""
+            Lists packages that contain the given filename. --match selects
+            how paths are compared with <filename>; 'exact', 'basename', and
+            'suffix' are answered by an index built when the cache is
+            updated, and are much faster than 'substring'. %s"""
             opts = dict(opts)
             plugin = self.plugin(irc)
-            plugin._get_cache()  # open the cache
+            plugin._get_cache()  # may start a new generation
+
+            match = opts.get('match') or plugin.registryValue(
+                'defaults.match', msg.channel, irc.network)
+            key = ('file packages', match, filename,
+                   get_filters_key(plugin, irc, msg.channel, opts))
+            irc.reply(plugin._get_cached_result(
+                key, lambda: self._packages(irc, msg, opts, match, filename)))
 
+        def _packages(self, irc, msg, opts, match, filename):
+            plugin = self.plugin(irc)
             filename = filename.encode()
-            # You may want to add '^.*' at the beginning of the pattern; but
-            # don't do that because the regexp then becomes much slower (6s for
-            # a 500MB list, instead of 0.3s).
-            # Given that we're matching end of lines, a line can't be matched
-            # twice anyway because matches can't overlap.
-            pattern = re.compile(
-                rb'%s.*\s+(\S+)/(\S+)$' % re.escape(filename),
-                re.MULTILINE)
+            pattern = get_file_pattern(match, filename)
             packages = set()
 
             # I can't find a way to do this with python-apt, so let's open and
             # parse the files directly
             rootdir = self.plugin(irc)._get_cache_dir()
             lists = list_content_lists(plugin, irc, msg.channel, opts, rootdir)
-            with multiprocessing.Pool() as pool:
-                results = pool.imap_unordered(
-                    search_file,
-                    [(pattern, filename, opener)
-                     for (filename, opener) in lists])
-                for result in results:
-                    packages.update(result)
-
-            if packages:
-                irc.reply(format('%L', sorted(packages)))
-            else:
-                irc.error(_('No package found.'))
+            unindexed_lists = []
+            for (list_filename, opener) in lists:
+                index_filename = None
+                if match != 'substring':
+                    index_filename = plugin._get_file_index(list_filename)
+                if index_filename:
+                    packages.update(search_file_index(
+                        index_filename, match, filename))
+                else:
+                    unindexed_lists.append((list_filename, opener))
+
+            if unindexed_lists:
+                # Tasks only carry the source of the pattern; workers
+                # compile it once.
+                pattern = (pattern.pattern, pattern.flags)
+                workers = plugin.registryValue('workers.number') or \
+                    os.cpu_count() or 1
+                pool = plugin._get_pool()
+                try:
+                    results = imap_bounded(
+                        pool,
+                        get_search_tasks(pattern, unindexed_lists, workers),
+                        2 * workers)
+                    for result in results:
+                        packages.update(result)
+                finally:
+                    plugin._release_pool(pool)
+
+            if not packages:
+                irc.error(_('No package found.'), Raise=True)
+            return format('%L', sorted(packages))
 
     class package(callbacks.Commands):
         def plugin(self, irc):
@@ -506,7 +1519,14 @@ class Apt(callbacks.Plugin):
 
             Shows generic information about a package. %s"""
             opts = dict(optlist)
+            plugin = self.plugin(irc)
+            plugin._get_cache()  # may start a new generation
+            key = ('package info', package_name,
+                   get_filters_key(plugin, irc, msg.channel, opts))
+            irc.reply(plugin._get_cached_result(
+                key, lambda: self._info(irc, msg, opts, package_name)))
 
+        def _info(self, irc, msg, opts, package_name):
             # TODO: better version selection
             pkg_versions = self._get_package_versions(irc, package_name)
             pkg_version = filter_versions(
@@ -526,8 +1546,8 @@ class Apt(callbacks.Plugin):
                 pkg_version.version, pkg_version.size,
                 pkg_version.installed_size)
 
-            irc.reply(format(_('%s %s Description: %s'),
-                             generic_info, version_info, pkg_version.summary))
+            return format(_('%s %s Description: %s'),
+                          generic_info, version_info, pkg_version.summary)
 
         @wrap([
             getopts({
@@ -545,6 +1565,15 @@ class Apt(callbacks.Plugin):
             returns matching version numbers. --description searches in package
             description instead of name. %s"""
             opts = dict(optlist)
+            plugin = self.plugin(irc)
+            plugin._get_cache()  # may start a new generation
+            key = ('package search', package_pattern,
+                   'with-version' in opts, 'description' in opts,
+                   get_filters_key(plugin, irc, msg.channel, opts))
+            irc.reply(plugin._get_cached_result(
+                key, lambda: self._search(irc, msg, opts, package_pattern)))
+
+        def _search(self, irc, msg, opts, package_pattern):
             search_description = 'description' in opts
             cache = self.plugin(irc)._get_cache()
             pattern = re.compile(utils.python.glob2re(package_pattern),
@@ -552,7 +1581,15 @@ class Apt(callbacks.Plugin):
 
 
             if search_description:
-                packages = iter(cache)
+                index = self.plugin(irc)._description_index
+                names = index.search(package_pattern) if index else None
+                if names is None:
+                    packages = iter(cache)
+                else:
+                    # Only candidates are read, the pattern is still
+                    # checked on their descriptions below.
+                    packages = (cache[name] for name in sorted(names)
+                                if name in cache)
             else:
                 # The next line is equivalent to:
                 # packages = (pkg for pkg in cache if pattern.match(pkg.shortname))
@@ -577,8 +1614,8 @@ class Apt(callbacks.Plugin):
                             for version in versions
                             if pattern.match(version.description))
 
-            # filter_versions is rather slow, so we're putting this guard
-            # before running it.
+            # Building apt.Version objects is rather slow, so we're putting
+            # this guard before running filter_versions.
             versions = list(itertools.islice(versions, 10000))
             if len(versions) >= 10000:
                 irc.error(_('Too many packages match this search.'),
@@ -590,8 +1627,7 @@ class Apt(callbacks.Plugin):
             if not opts.get('with-version'):
                 package_names = sorted({version.package.shortname
                                         for version in versions})
-                irc.reply(format('%L', package_names))
-                return
+                return format('%L', package_names)
 
             items = []
             for version in versions:
@@ -600,7 +1636,7 @@ class Apt(callbacks.Plugin):
                                     version.version,
                                     {origin.codename
                                      for origin in version.origins}))
-            irc.reply(format('%L', items))
+            return format('%L', items)
 
 
 Class = Apt
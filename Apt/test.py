@@ -28,14 +28,21 @@
 
 ###
 
+import gc
 import os
 import re
+import gzip
+import lzma
 import time
+import weakref
 
 from supybot.test import *
 import supybot.conf as conf
 
-from .plugin import Apt
+from .plugin import Apt, ResultCache, filter_versions, DescriptionIndex, \
+    build_file_index, search_file_index, search_file, get_file_pattern, \
+    get_file_opener, open_uncompressed, read_list_chunks, search_chunk, \
+    get_search_tasks
 
 SOURCES_LIST = '''
 deb [trusted=yes] http://archive.ubuntu.com/ubuntu bionic main universe
@@ -95,6 +102,8 @@ class AptTestCase(PluginTestCase):
 
     def testUpdate(self):
         self.assertResponse('apt update', 'The operation succeeded.')
+        self.assertRegexp('stats', 'Last update took')
+        self.assertResponse('package search limnoria', 'limnoria')
 
     def testFilePackages(self):
         self.assertRegexp(
@@ -107,6 +116,207 @@ class AptTestCase(PluginTestCase):
             'file packages sbin/badblocks',
             'e2fsprogs')
 
+    def testResultCache(self):
+        results = ResultCache(2)
+        self.assertEqual(results.get('foo', lambda: 1), 1)
+        self.assertEqual(results.get('bar', lambda: 2), 2)
+        self.assertEqual(results.get('foo', lambda: 3), 1)
+        self.assertEqual(results.get('baz', lambda: 4), 4)
+        # 'bar' was the least recently used
+        self.assertEqual(results.get('bar', lambda: 5), 5)
+        self.assertEqual((results.hits, results.misses), (1, 4))
+        results.clear()
+        self.assertEqual(len(results), 0)
+
+    def testDescriptionIndex(self):
+        index = DescriptionIndex(
+            (), ['limnoria', 'e2fsprogs'],
+            {'robust': [0], 'python': [0], 'irc': [0], 'bot': [0],
+             'fork': [0], 'of': [0], 'supybot': [0],
+             'ext4': [1], 'file': [1], 'system': [1], 'utilities': [1]})
+        self.assertEqual(index.search('*upybot*'), {'limnoria'})
+        self.assertEqual(index.search('*IRC bot*'), {'limnoria'})
+        self.assertEqual(index.search('robust*'), {'limnoria'})
+        self.assertEqual(index.search('*xt4 fil*'), {'e2fsprogs'})
+        self.assertEqual(index.search('*file sys'), set())
+        # The index can't restrict these searches
+        self.assertIsNone(index.search('*'))
+        self.assertIsNone(index.search('*[ab]*'))
+
+    def testFilterVersions(self):
+        class PackageFile:
+            def __init__(self, id_, label, archive, codename, version):
+                (self.id, self.label, self.archive, self.codename,
+                 self.version) = (id_, label, archive, codename, version)
+        class Cache:
+            # mimics both apt.Cache and apt_pkg.Cache
+            def __init__(self, package_files):
+                self._cache = self
+                self.file_list = package_files
+        class Version:
+            # mimics apt.Version, apt.Package, and apt_pkg.Version
+            def __init__(self, architecture, package_files):
+                self.architecture = architecture
+                self.package = self._cand = self
+                self._pcache = cache
+                self.file_list = [(pf, 0) for pf in package_files]
+        buster = PackageFile(0, 'Debian', 'stable', 'buster', '10')
+        bionic = PackageFile(1, 'Ubuntu', 'bionic', 'bionic', '18.04')
+        cache = Cache([buster, bionic])
+        (debian, ubuntu) = (Version('amd64', [buster]),
+                            Version('armel', [bionic]))
+        plugin = self.irc.getCallback('Apt')
+        def filter_(**filters):
+            filters = {'archs': ['*'], 'distribs': ['*'], 'releases': ['*'],
+                       **filters}
+            return filter_versions(plugin, None, None, filters,
+                                   [debian, ubuntu])
+        self.assertEqual(filter_(archs=['amd64']), [debian])
+        self.assertEqual(filter_(distribs=['debian']), [debian])
+        self.assertEqual(filter_(releases=['Stable']), [debian])
+        self.assertEqual(filter_(releases=['18.04']), [ubuntu])
+        self.assertEqual(filter_(releases=['buster', 'bionic']),
+                         [debian, ubuntu])
+        # The origin table doesn't keep the cache in use
+        cache_ref = weakref.ref(cache)
+        del cache, debian, ubuntu
+        gc.collect()
+        self.assertIsNone(cache_ref())
+
+    def testStats(self):
+        self.assertResponse('package search limnoria', 'limnoria')
+        self.assertResponse('package search limnoria', 'limnoria')
+        self.assertRegexp('stats', r'[1-9]\d* hits?')
+
+    def testFilePackagesMatch(self):
+        self.assertResponse(
+            'file packages --match exact /sbin/badblocks',
+            'e2fsprogs')
+        self.assertResponse(
+            'file packages --match exact badblocks',
+            'Error: No package found.')
+        self.assertResponse(
+            'file packages --match basename badblocks',
+            'e2fsprogs')
+        self.assertRegexp(
+            'file packages --match suffix plugins/Owner/plugin.py',
+            '(limnoria and supybot|supybot and limnoria)')
+
+    def testFileIndex(self):
+        dirname = conf.supybot.directories.data.dirize('fileindex-test')
+        os.makedirs(dirname, exist_ok=True)
+        list_filename = os.path.join(dirname, 'Contents-amd64')
+        index_filename = list_filename + '.index'
+        with open(list_filename, 'wb') as fd:
+            fd.write(b'sbin/badblocks    admin/e2fsprogs\n'
+                     b'usr/share/man/man8/badblocks.8.gz admin/e2fsprogs\n'
+                     b'usr/share/doc/foo bar/README    utils/foo,utils/bar\n')
+        build_file_index(
+            list_filename, lambda filename: open(filename, 'rb'),
+            index_filename)
+        self.assertEqual(
+            search_file_index(index_filename, 'exact', b'/sbin/badblocks'),
+            {'e2fsprogs'})
+        self.assertEqual(
+            search_file_index(index_filename, 'exact', b'badblocks'),
+            set())
+        self.assertEqual(
+            search_file_index(index_filename, 'basename', b'README'),
+            {'foo', 'bar'})
+        self.assertEqual(
+            search_file_index(index_filename, 'suffix', b'blocks.8.gz'),
+            {'e2fsprogs'})
+        # Sorted by runs of one record, then merged
+        build_file_index(
+            list_filename, lambda filename: open(filename, 'rb'),
+            index_filename, chunk_size=1)
+        self.assertEqual(
+            search_file_index(index_filename, 'basename', b'README'),
+            {'foo', 'bar'})
+        self.assertEqual(
+            search_file_index(index_filename, 'exact', b'/sbin/badblocks'),
+            {'e2fsprogs'})
+        # Scanning the list gives the same packages as the index
+        for (match, filename) in [('exact', b'usr/share/doc/foo bar/README'),
+                                  ('basename', b'README'),
+                                  ('suffix', b'bar/README'),
+                                  ('suffix', b'blocks')]:
+            self.assertEqual(
+                search_file((get_file_pattern(match, filename),
+                             list_filename, open_uncompressed, None)),
+                search_file_index(index_filename, match, filename))
+        self.assertEqual(
+            search_file((get_file_pattern('substring', b'README'),
+                         list_filename, open_uncompressed, None)),
+            {'foo', 'bar'})
+
+    def testSearchFileRanges(self):
+        dirname = conf.supybot.directories.data.dirize('fileindex-test')
+        os.makedirs(dirname, exist_ok=True)
+        list_filename = os.path.join(dirname, 'Contents-i386')
+        with open(list_filename, 'wb') as fd:
+            for i in range(1000):
+                fd.write(b'usr/share/doc/pkg%d/changelog    utils/pkg%d\n'
+                         % (i, i))
+        size = os.path.getsize(list_filename)
+        pattern = get_file_pattern('substring', b'changelog')
+        results = []
+        for start in range(0, size, 1000):
+            results.extend(search_file((
+                pattern, list_filename, open_uncompressed,
+                (start, min(start + 1000, size)))))
+        # Each line is in exactly one range
+        self.assertEqual(len(results), 1000)
+        self.assertEqual(
+            set(results),
+            search_file((pattern, list_filename, open_uncompressed, None)))
+
+    def testSearchFileCompressed(self):
+        dirname = conf.supybot.directories.data.dirize('fileindex-test')
+        os.makedirs(dirname, exist_ok=True)
+        list_filename = os.path.join(dirname, 'Contents-armel')
+        data = b''.join(b'usr/share/doc/pkg%d/changelog    utils/pkg%d\n'
+                        % (i, i) for i in range(1000))
+        with open(list_filename, 'wb') as fd:
+            fd.write(data)
+        with gzip.open(list_filename + '.gz', 'wb') as fd:
+            fd.write(data)
+        with lzma.open(list_filename + '.xz', 'wb') as fd:
+            fd.write(data)
+        pattern = get_file_pattern('basename', b'changelog')
+        expected = {'pkg%d' % i for i in range(1000)}
+        self.assertEqual(
+            search_file((pattern, list_filename, open_uncompressed, None)),
+            expected)
+        for extension in ('gz', 'xz'):
+            self.assertEqual(
+                search_file((pattern, list_filename + '.' + extension,
+                             get_file_opener(extension), None)),
+                expected)
+        # Compressed lists are searched in chunks of whole lines
+        for extension in ('gz', 'xz'):
+            chunks = list(read_list_chunks(list_filename + '.' + extension,
+                                           get_file_opener(extension),
+                                           size=1000))
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(b''.join(chunks), data)
+            results = set()
+            for chunk in chunks:
+                results |= search_chunk((pattern, chunk))
+            self.assertEqual(results, expected)
+        # Compressed lists are only split when there are fewer of them
+        # than workers
+        lists = [(list_filename + '.gz', get_file_opener('gz')),
+                 (list_filename + '.xz', get_file_opener('xz'))]
+        self.assertEqual(
+            [function for (function, args)
+             in get_search_tasks(pattern, lists, 2)],
+            [search_file, search_file])
+        self.assertEqual(
+            {function for (function, args)
+             in get_search_tasks(pattern, lists, 4)},
+            {search_chunk})
+
     def testFilePackagesFilterArchs(self):
         self.assertResponse(
             'file packages doc/linux-image-amd64/changelog',
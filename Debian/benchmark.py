@@ -0,0 +1,152 @@
+###
+# Copyright (c) 2003-2005, James Vega
+# Copyright (c) 2011, Valentin Lorentz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Compares the parser of the version command with the BeautifulSoup-based
+one it replaced, on a simulated packages.debian.org search page.
+
+Run it with:
+
+    python3 Debian/benchmark.py --packages 300 --repeat 5
+
+It doesn't connect to anything.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import atexit
+import shutil
+import tempfile
+import argparse
+
+BRANCHES = ('bullseye (oldstable)', 'bookworm (stable)', 'trixie (testing)',
+            'sid (unstable)', 'experimental (experimental)')
+
+def makePage(options):
+    """Returns a search page with options.packages results."""
+    blocks = []
+    for i in range(options.packages):
+        name = 'lib%i' % i
+        items = []
+        for branch in random.sample(BRANCHES, random.randint(1, 4)):
+            suite = branch.split(' ', 1)[0]
+            lines = ['<li class="%s"><a class="resultlink" '
+                     'href="/%s/%s">%s</a> (libs): Library number %i' %
+                     (suite, suite, name, branch, i)]
+            for j in range(random.randint(1, 2)):
+                lines.append('<br>%i:%i.%i-%i [security]: amd64 arm64 i386' %
+                             (j, i, j, random.randrange(10)))
+            if random.random() < 0.2:
+                lines.append('<br>also provided by: '
+                             '<a href="/%s/%s-udeb">%s-udeb</a>' %
+                             (suite, name, name))
+            items.append('\n'.join(lines) + '\n</li>')
+        blocks.append('<h3>Package %s</h3>\n<ul>\n%s\n</ul>' %
+                      (name, '\n'.join(items)))
+    return ('<html><body><div id="content"><h1>Search</h1>\n'
+            '<ul id="navigation"><li><a href="/">Home</a></li></ul>\n'
+            '<h2>Exact hits</h2>\n%s\n</div></body></html>' %
+            '\n'.join(blocks))
+
+_deblistreVersion = re.compile(r'<h3>Package ([^<]+)</h3>(.*?)</ul>',
+                               re.DOTALL | re.IGNORECASE)
+def parseWithBeautifulSoup(html):
+    """The parser used by the version command before VersionParser."""
+    import bs4 as BeautifulSoup
+    import supybot.utils as utils
+    results = []
+    for pkg in _deblistreVersion.findall(html):
+        soup = BeautifulSoup.BeautifulSoup(pkg[1])
+        branches = []
+        def branchVers(br):
+            vers = [b.next.string.strip() for b in br]
+            return [utils.str.rsplit(v, ':', 1)[0].split('[', 1)[0].strip()
+                    for v in vers]
+        for li in soup.find_all('li'):
+            lines = li.find_all('br')
+            versions = branchVers(l for l in lines
+                    if not str(l.next).startswith('also provided by'))
+            providers = [l.next.next.string for l in lines
+                         if str(l.next).startswith('also provided by')]
+            branches.append((li.a.string, versions, providers))
+        results.append((pkg[0], branches))
+    return results
+
+def measure(f, html, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = f(html)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return (best, result)
+
+def main():
+    parser = argparse.ArgumentParser(description='Debian version parser '
+                                     'benchmark.')
+    parser.add_argument('--packages', type=int, default=300,
+                        help='number of packages in the search page')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    random.seed(options.seed)
+
+    pluginsDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, pluginsDir)
+    # Supybot writes its configuration and logs in the current directory.
+    tmpDir = tempfile.mkdtemp()
+    os.chdir(tmpDir)
+    atexit.register(shutil.rmtree, tmpDir, True)
+    run(options)
+
+def run(options):
+    import supybot.log as log
+    log._stdoutHandler.setLevel(100)
+    from Debian.plugin import parseVersions
+
+    html = makePage(options)
+    (old, oldResult) = measure(parseWithBeautifulSoup, html, options.repeat)
+    (new, newResult) = measure(parseVersions, html, options.repeat)
+    if oldResult != newResult:
+        print('The parsers disagree!')
+        sys.exit(1)
+    print('%i packages, %i kB of HTML' % (options.packages, len(html) / 1024))
+    print('  BeautifulSoup:  %8.1f ms' % (old * 1000))
+    print('  VersionParser:  %8.1f ms (%.1f times faster)' %
+          (new * 1000, old / new))
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
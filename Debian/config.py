@@ -89,5 +89,21 @@ conf.registerChannelValue(Debian.defaults.version, 'searchon',
     ValidVersionSearchon('names', _("""Determines the default 'searchon', ie.
     where to search if --searchon is not given.""")))
 
+conf.registerGroup(Debian, 'cache')
+conf.registerGlobalValue(Debian.cache, 'ttl',
+    registry.NonNegativeInteger(3600, _("""Number of seconds the pages of
+    packages.qa.debian.org are kept, for the description and stats
+    commands.  0 disables the cache.""")))
+
+conf.registerGroup(Debian, 'local')
+conf.registerGlobalValue(Debian.local, 'mirror',
+    registry.String('', _("""Path to a local Debian mirror (the directory
+    containing dists/).  If it is set, the file, version, description and
+    stats commands read its Packages, Sources and Contents files instead of
+    fetching Debian's websites.""")))
+conf.registerGlobalValue(Debian.local, 'archs',
+    registry.SpaceSeparatedListOfStrings(['amd64'], _("""Architectures of
+    the local mirror to search in, when --arch is not given.""")))
+
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -30,12 +30,23 @@
 
 import os
 import re
+import gzip
+import lzma
+import mmap
 import time
+import array
+import heapq
+import shutil
+import struct
 import urllib
 import fnmatch
+import tempfile
+import threading
+from html.parser import HTMLParser
 
 import bs4 as BeautifulSoup
 
+import supybot.log as log
 import supybot.conf as conf
 import supybot.utils as utils
 import supybot.world as world
@@ -45,8 +56,554 @@ import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
 from supybot.utils.iter import all
 
+def findIndexFile(path):
+    """Returns the name of the index file of a mirror at path, which may be
+    compressed, or None if it doesn't exist."""
+    for extension in ('', '.xz', '.gz'):
+        if os.path.isfile(path + extension):
+            return path + extension
+    return None
+
+def openIndexFile(filename):
+    if filename.endswith('.xz'):
+        return lzma.open(filename, 'rb')
+    elif filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    else:
+        return open(filename, 'rb')
+
+def parseStanzas(fd):
+    """Yields the paragraphs of a Packages or Sources file, as dicts."""
+    stanza = {}
+    field = None
+    for line in fd:
+        line = line.decode('utf8', 'replace').rstrip('\n')
+        if not line.strip():
+            if stanza:
+                yield stanza
+            stanza = {}
+            field = None
+        elif line[0] in ' \t':
+            if field is not None:
+                stanza[field] += '\n' + line[1:]
+        else:
+            (field, _, value) = line.partition(':')
+            stanza[field] = value.strip()
+    if stanza:
+        yield stanza
+
+def getFileSignature(filename):
+    """Returns the size, modification time and inode of a file, which
+    change whenever the mirror replaces it."""
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+def readContents(filename):
+    """Yields (path, packages) for each line of a Contents file, with the
+    path starting with a slash."""
+    with openIndexFile(filename) as fd:
+        for line in fd:
+            try:
+                (path, locations) = line.rstrip(b'\n').rsplit(None, 1)
+            except ValueError:
+                continue
+            packages = [location.rsplit(b'/', 1)[-1]
+                        for location in locations.split(b',')]
+            yield (b'/' + path.strip().lstrip(b'/'), packages)
+
+def scanContents(filename, mode, exact, s):
+    """Returns the packages containing a file matching s, read directly
+    from a Contents file, for when its index is not built yet."""
+    s = s.encode()
+    if mode == 'path' and exact:
+        s = b'/' + s.lstrip(b'/')
+        matches = lambda path: path == s
+    elif mode == 'path':
+        matches = lambda path: path.endswith(s)
+    elif mode == 'exactfilename':
+        matches = lambda path: path.endswith(b'/' + s)
+    else:
+        matches = lambda path: s in path.rsplit(b'/', 1)[-1]
+    packages = set()
+    for (path, names) in readContents(filename):
+        if matches(path):
+            packages.update(name.decode() for name in names)
+    return packages
+
+CONTENTS_INDEX_MAGIC = b'DEBCIDX2'
+# Magic, number of records, then the signature of the Contents file
+CONTENTS_INDEX_HEADER = struct.Struct('=8sQQqQ')
+# Records are sorted by runs of this many, written to temporary files and
+# merged, so the Contents file is never held in memory.
+CONTENTS_INDEX_SORT_CHUNK = 1000000
+
+def _writeSortedRun(records, dirname):
+    records.sort()
+    fd = tempfile.TemporaryFile(dir=dirname)
+    fd.writelines(records)
+    fd.seek(0)
+    return fd
+
+def buildContentsIndex(contentsFilename, indexFilename,
+                       chunkSize=CONTENTS_INDEX_SORT_CHUNK):
+    """Writes an index of a Contents file: its paths, reversed and sorted,
+    each followed by the packages containing it. The records are preceded
+    by a table of their offsets, so paths can be looked up by suffix with a
+    binary search, and by a newline, so the first record starts a line like
+    the others."""
+    # Taken before reading, so a file replaced meanwhile is indexed again.
+    signature = getFileSignature(contentsFilename)
+    dirname = os.path.dirname(indexFilename)
+    runs = []
+    try:
+        records = []
+        for (path, packages) in readContents(contentsFilename):
+            records.append(path[::-1] + b'\0' + b','.join(packages) + b'\n')
+            if len(records) >= chunkSize:
+                runs.append(_writeSortedRun(records, dirname))
+                records = []
+        runs.append(_writeSortedRun(records, dirname))
+        records = None
+        # The records are merged into a temporary file while their offsets
+        # are computed, as the offsets come first in the index.
+        offsets = array.array('Q')
+        size = 0
+        with tempfile.TemporaryFile(dir=dirname) as recordsFd:
+            for record in heapq.merge(*runs):
+                offsets.append(size)
+                recordsFd.write(record)
+                size += len(record)
+            offsets.append(size)
+            start = CONTENTS_INDEX_HEADER.size + \
+                offsets.itemsize * len(offsets) + 1
+            offsets = array.array('Q', (start + offset for offset in offsets))
+            recordsFd.seek(0)
+            with open(indexFilename + '.tmp', 'wb') as fd:
+                fd.write(CONTENTS_INDEX_HEADER.pack(
+                    CONTENTS_INDEX_MAGIC, len(offsets) - 1, *signature))
+                offsets.tofile(fd)
+                fd.write(b'\n')
+                shutil.copyfileobj(recordsFd, fd)
+    finally:
+        for run in runs:
+            run.close()
+    os.replace(indexFilename + '.tmp', indexFilename)
+
+class ContentsIndex(object):
+    """Memory-mapped index written by buildContentsIndex."""
+    def __init__(self, filename):
+        with open(filename, 'rb') as fd:
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.count, *signature) = \
+            CONTENTS_INDEX_HEADER.unpack_from(self.mmap, 0)
+        if magic != CONTENTS_INDEX_MAGIC:
+            self.mmap.close()
+            raise ValueError('%s is not a Contents index.' % filename)
+        self.signature = tuple(signature)
+        self.start = self._offset(0)
+
+    def close(self):
+        self.mmap.close()
+
+    def _offset(self, i):
+        return struct.unpack_from('=Q', self.mmap,
+                                  CONTENTS_INDEX_HEADER.size + 8 * i)[0]
+
+    def _record(self, i):
+        return self.mmap[self._offset(i):self._offset(i + 1) - 1] \
+                .split(b'\0', 1)
+
+    def searchSuffix(self, suffix, exact=False):
+        """Returns the packages containing a path that ends with suffix (or
+        is equal to it, if exact is True)."""
+        key = suffix.encode()[::-1]
+        (low, high) = (0, self.count)
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        packages = set()
+        for i in range(low, self.count):
+            (path, names) = self._record(i)
+            if not path.startswith(key):
+                break
+            if not exact or path == key:
+                packages.update(names.decode().split(','))
+        return packages
+
+    def searchFilename(self, s):
+        """Returns the packages containing a file whose name contains s."""
+        pattern = re.compile(rb'^[^/\0\n]*%s[^\0\n]*/[^\0\n]*\0([^\n]*)$' %
+                             re.escape(s.encode()[::-1]), re.MULTILINE)
+        packages = set()
+        # Starts on the newline before the first record, which '^' needs.
+        for match in pattern.finditer(self.mmap, self.start - 1):
+            packages.update(match.group(1).decode().split(','))
+        return packages
+
+class LocalMirror(object):
+    """Answers queries from the Packages, Sources and Contents files of a
+    local Debian mirror, instead of Debian's websites."""
+    suites = ('oldstable', 'stable', 'testing', 'unstable', 'experimental')
+    def __init__(self, path, indexDir):
+        self.path = path
+        self.indexDir = indexDir
+        self._loaded = {}
+        self._loading = {}
+        self._contentsIndexes = {}
+        self._indexing = set()
+        self._lock = threading.Lock()
+
+    def getSuites(self, suite='all'):
+        suites = self.suites if suite in (None, 'all') else (suite,)
+        return [suite for suite in suites
+                if os.path.isdir(os.path.join(self.path, 'dists', suite))]
+
+    def getSections(self, suite, section='all'):
+        if suite not in self.getSuites(suite):
+            return []
+        dist = os.path.join(self.path, 'dists', suite)
+        sections = sorted(name for name in os.listdir(dist)
+                          if os.path.isdir(os.path.join(dist, name)))
+        if section not in (None, 'any', 'all'):
+            sections = [name for name in sections if name == section]
+        return sections
+
+    def _load(self, filename, parse):
+        """Returns parse(filename), which is kept until the file changes.
+        A file requested by several threads at once is only parsed once.
+        The previous result is not closed, as other threads may still use
+        it; it is freed when they are done."""
+        signature = getFileSignature(filename)
+        with self._lock:
+            (loadedSignature, result) = self._loaded.get(filename,
+                                                         (None, None))
+            if loadedSignature == signature:
+                return result
+            fileLock = self._loading.setdefault(filename, threading.Lock())
+        with fileLock:
+            with self._lock:
+                (loadedSignature, result) = self._loaded.get(filename,
+                                                             (None, None))
+            if loadedSignature == signature:
+                # Parsed by another thread meanwhile
+                return result
+            result = parse(filename)
+            with self._lock:
+                self._loaded[filename] = (signature, result)
+        return result
+
+    def _parsePackages(self, filename):
+        """Returns a dict from package names to their (version, source,
+        summary, provides), sorted by name."""
+        packages = {}
+        with openIndexFile(filename) as fd:
+            for stanza in parseStanzas(fd):
+                name = stanza.get('Package')
+                if name is None:
+                    continue
+                source = stanza.get('Source', name).split(' ', 1)[0]
+                summary = stanza.get('Description', '').split('\n', 1)[0]
+                provides = [provided.strip().split(' ', 1)[0]
+                            for provided in stanza.get('Provides', '')
+                                                  .split(',')
+                            if provided.strip()]
+                packages.setdefault(name, []).append(
+                    (stanza.get('Version', ''), source, summary, provides))
+        return packages
+
+    def _parseSources(self, filename):
+        """Returns a dict from source package names to their version,
+        maintainer, and binary packages."""
+        sources = {}
+        with openIndexFile(filename) as fd:
+            for stanza in parseStanzas(fd):
+                name = stanza.get('Package')
+                if name is None:
+                    continue
+                binaries = [binary.strip()
+                            for binary in stanza.get('Binary', '').split(',')]
+                sources[name] = (stanza.get('Version', ''),
+                                 stanza.get('Maintainer', ''), binaries)
+        return sources
+
+    def getPackages(self, suite, section, archs):
+        """Yields the Packages index of each architecture of the section."""
+        for arch in archs:
+            filename = findIndexFile(os.path.join(
+                self.path, 'dists', suite, section, 'binary-%s' % arch,
+                'Packages'))
+            if filename:
+                yield self._load(filename, self._parsePackages)
+
+    def getSources(self, suite, section):
+        filename = findIndexFile(os.path.join(
+            self.path, 'dists', suite, section, 'source', 'Sources'))
+        if filename:
+            return self._load(filename, self._parseSources)
+        return {}
+
+    def _getContentsIndexFilename(self, filename):
+        return os.path.join(
+            self.indexDir,
+            os.path.relpath(filename, self.path).replace(os.sep, '_') +
+            '.index')
+
+    def getContentsIndex(self, filename):
+        """Returns the index of a Contents file, or None if it is not built
+        (or not up to date) yet; it is then built in the background."""
+        signature = getFileSignature(filename)
+        with self._lock:
+            index = self._contentsIndexes.get(filename)
+            if index is not None and index.signature == signature:
+                return index
+        try:
+            index = ContentsIndex(self._getContentsIndexFilename(filename))
+        except (FileNotFoundError, ValueError, struct.error):
+            # Not built yet, or by an older version
+            index = None
+        if index is not None and index.signature == signature:
+            with self._lock:
+                # The previous index is not closed, as other threads may
+                # still use it; it is freed when they are done.
+                self._contentsIndexes[filename] = index
+            return index
+        if index is not None:
+            index.close()
+        self.buildContentsIndexes([filename])
+        return None
+
+    def buildContentsIndexes(self, filenames):
+        """Starts a thread building the index of each of the Contents files
+        that is not already being indexed."""
+        with self._lock:
+            filenames = [filename for filename in filenames
+                         if filename not in self._indexing]
+            self._indexing.update(filenames)
+        if not filenames:
+            return
+        def build():
+            for filename in filenames:
+                try:
+                    buildContentsIndex(filename,
+                            self._getContentsIndexFilename(filename))
+                except Exception:
+                    log.exception('Debian: could not index %s:', filename)
+                finally:
+                    with self._lock:
+                        self._indexing.discard(filename)
+        thread = threading.Thread(target=build,
+                                  name='Debian Contents indexer')
+        thread.daemon = True
+        thread.start()
+
+    def getContentsFiles(self, suite, section, archs):
+        """Returns the Contents file of each architecture of the section
+        (or of the suite, for mirrors with a Contents file for all
+        sections)."""
+        dist = os.path.join(self.path, 'dists', suite)
+        sections = self.getSections(suite, section)
+        contentsFiles = []
+        for arch in archs:
+            filenames = [findIndexFile(os.path.join(
+                dist, name, 'Contents-%s' % arch)) for name in sections]
+            filenames = list(filter(None, filenames))
+            if not filenames:
+                filenames = [findIndexFile(os.path.join(
+                    dist, 'Contents-%s' % arch))]
+            contentsFiles.extend(filter(None, filenames))
+        return contentsFiles
+
+    def indexAll(self, archs):
+        """Starts building the indexes of all Contents files of the mirror,
+        so the file command doesn't have to read them."""
+        self.buildContentsIndexes([filename
+                for suite in self.getSuites()
+                for filename in self.getContentsFiles(suite, 'all', archs)])
+
+    def searchFile(self, filename, mode, exact, suite, section, archs):
+        """Returns the names of packages containing filename, with the
+        same modes as packages.debian.org. Contents files whose index is
+        not built yet are read directly."""
+        packages = set()
+        for contentsFilename in self.getContentsFiles(suite, section, archs):
+            index = self.getContentsIndex(contentsFilename)
+            if index is None:
+                packages |= scanContents(contentsFilename, mode, exact,
+                                         filename)
+            elif mode == 'path':
+                packages |= index.searchSuffix(
+                    '/' + filename.lstrip('/') if exact else filename,
+                    exact=exact)
+            elif mode == 'exactfilename':
+                packages |= index.searchSuffix('/' + filename)
+            else:
+                packages |= index.searchFilename(filename)
+        return sorted(packages)
+
+    def searchVersions(self, keyword, searchon, exact, suite, section,
+                       archs):
+        """Returns a list of (package, [(suite, versions, providers)])."""
+        results = {}
+        def matches(name, summary=''):
+            if exact:
+                return name == keyword
+            return keyword in name or \
+                    (searchon == 'all' and keyword in summary.lower())
+        for suiteName in self.getSuites(suite):
+            found = {}
+            providers = {}
+            for sectionName in self.getSections(suiteName, section):
+                if searchon == 'sourcenames':
+                    sources = self.getSources(suiteName, sectionName)
+                    for (name, (version, _, _)) in sources.items():
+                        if matches(name):
+                            found.setdefault(name, []).append(version)
+                    continue
+                for packages in self.getPackages(suiteName, sectionName,
+                                                 archs):
+                    for (name, entries) in packages.items():
+                        for (version, _, summary, provides) in entries:
+                            if matches(name, summary):
+                                found.setdefault(name, []).append(version)
+                            for provided in provides:
+                                providers.setdefault(provided, set()) \
+                                        .add(name)
+            for (name, versions) in found.items():
+                versions = sorted(set(versions), key=versions.index)
+                results.setdefault(name, []).append(
+                    (suiteName, versions,
+                     sorted(providers.get(name, set()) - set([name]))))
+        return sorted(results.items())
+
+    def getSource(self, name, archs):
+        """Returns (version, maintainer, summary) of the source package in
+        the most recent suite it is in, or None if it doesn't exist."""
+        for suite in ('unstable', 'testing', 'stable', 'oldstable',
+                      'experimental'):
+            if suite not in self.getSuites():
+                continue
+            for section in self.getSections(suite):
+                source = self.getSources(suite, section).get(name)
+                if source is None:
+                    continue
+                (version, maintainer, binaries) = source
+                summary = ''
+                # Prefer the binary package with the same name as the
+                # source package.
+                for binary in sorted(binaries, key=lambda b: b != name):
+                    for packages in self.getPackages(suite, section,
+                                                     archs):
+                        if binary in packages:
+                            summary = packages[binary][0][2]
+                            break
+                    if summary:
+                        break
+                return (version, maintainer, summary)
+        return None
+
+class VersionParser(HTMLParser):
+    """Reads the results of a search on packages.debian.org in a single
+    pass.  self.packages is a list of (package, [(branch, versions,
+    providers)])."""
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.packages = []
+        self._tag = None # Tag whose text we are reading
+        self._text = ''
+        self._branches = None # Branches of the current package
+        self._line = None # 'versions' or 'providers', after a <br>
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'h3':
+            self._tag = tag
+            self._text = ''
+        elif self._branches is None:
+            return
+        elif tag == 'li':
+            self._branches.append([None, [], []])
+            self._line = None
+        elif tag == 'a' and self._branches:
+            if self._branches[-1][0] is None or self._line == 'providers':
+                self._tag = tag
+                self._text = ''
+        elif tag == 'br' and self._branches:
+            self._line = 'versions'
+
+    def handle_endtag(self, tag):
+        if tag == 'h3' and self._tag == 'h3':
+            self._tag = None
+            if self._text.startswith('Package '):
+                self._branches = []
+                self.packages.append((self._text[len('Package '):].strip(),
+                                      self._branches))
+        elif tag == 'a' and self._tag == 'a':
+            self._tag = None
+            branch = self._branches[-1]
+            if branch[0] is None:
+                branch[0] = self._text
+            else:
+                branch[2].append(self._text)
+        elif tag == 'ul':
+            self._branches = None
+
+    def handle_data(self, data):
+        if self._tag is not None:
+            self._text += data
+        elif self._line == 'versions':
+            if data.startswith('also provided by'):
+                self._line = 'providers'
+            else:
+                version = utils.str.rsplit(data, ':', 1)[0]
+                self._branches[-1][1].append(version.split('[', 1)[0]
+                                                    .strip())
+                self._line = None
+
+def parseVersions(html):
+    parser = VersionParser()
+    parser.feed(html)
+    parser.close()
+    return [(package, [tuple(branch) for branch in branches])
+            for (package, branches) in parser.packages]
+
+class PendingPage(object):
+    """A page being fetched, that other threads can wait for."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.record = None
+
 class Debian(callbacks.Plugin):
     threaded = True
+    def __init__(self, irc):
+        self.__parent = super(Debian, self)
+        self.__parent.__init__(irc)
+        self._mirror = None
+        self._qaLock = threading.Lock()
+        self._qaPages = {}
+        self._qaPending = {}
+
+    def _getMirror(self):
+        """Returns the LocalMirror to use instead of Debian's websites, or
+        None if there is none."""
+        path = self.registryValue('local.mirror')
+        if not path:
+            return None
+        if self._mirror is None or self._mirror.path != path:
+            indexDir = conf.supybot.directories.data.dirize('Debian')
+            if not os.path.isdir(indexDir):
+                os.makedirs(indexDir)
+            self._mirror = LocalMirror(path, indexDir)
+            self._mirror.indexAll(self.registryValue('local.archs'))
+        return self._mirror
+
+    def _getLocalSource(self, irc, pkg):
+        source = self._getMirror().getSource(pkg,
+                self.registryValue('local.archs'))
+        if source is None:
+            irc.errorInvalid('source package name', pkg, Raise=True)
+        return source
 
     _debreflags = re.DOTALL | re.MULTILINE
     _deblistreFileExact = re.compile(r'<a href="/[^/>]+/[^/>]+">([^<]+)</a>',
@@ -81,9 +638,23 @@ class Debian(callbacks.Plugin):
                 args['arch'] = value
             elif key == 'mode':
                 args['mode'] = value
-        responses = []
         if '*' in filename:
             irc.error('Wildcard characters can not be specified.', Raise=True)
+        mirror = self._getMirror()
+        if mirror is not None:
+            if args['arch'] == 'any':
+                archs = self.registryValue('local.archs')
+            else:
+                archs = [args['arch']]
+            pkgs = mirror.searchFile(filename, args['mode'], exact,
+                                     args['suite'], args['section'], archs)
+            if pkgs:
+                irc.reply(format('%i matches found: %s (%s)',
+                              len(pkgs), '; '.join(pkgs), args['suite']))
+            else:
+                irc.reply(format('No filename found for %s (%s)',
+                          filename, args['suite']))
+            return
         args['keywords'] = utils.web.urlquote(filename, '')
         url %= args
         try:
@@ -124,8 +695,21 @@ class Debian(callbacks.Plugin):
                                 'arch': 'somethingWithoutSpaces'}),
                                 'text'])
 
-    _debreflags = re.DOTALL | re.IGNORECASE
-    _deblistreVersion = re.compile(r'<h3>Package ([^<]+)</h3>(.*?)</ul>', _debreflags)
+    def _formatVersions(self, pkgs):
+        responses = []
+        for (pkgMatch, branches) in pkgs:
+            for (branch, versions, providers) in branches:
+                if providers:
+                    provided_by = format('; also provided by: %L', providers)
+                else:
+                    provided_by = ''
+                responses.append(format('%s (%s%s)', pkgMatch,
+                                        ': '.join([branch,
+                                                   ', '.join(versions)]),
+                                        provided_by))
+        return format('%i matches found: %s',
+                      len(responses), '; '.join(responses))
+
     def version(self, irc, msg, args, optlist, package):
         """[--exact] \
         [--searchon {names,all,sourcenames}] \
@@ -146,18 +730,31 @@ class Debian(callbacks.Plugin):
                 'searchon': reg('searchon'),
                 'suite': reg('branch'),
                 'section': reg('section')}
+        exact = False
         for (key, value) in optlist:
             if key == 'exact':
                 url += '&exact=1'
+                exact = True
             elif key == 'branch':
                 args['suite'] = value
             elif key == 'section':
                 args['section'] = value
             elif key == 'searchon':
                 args['searchon'] = value
-        responses = []
         if '*' in package:
             irc.error('Wildcard characters can not be specified.', Raise=True)
+        mirror = self._getMirror()
+        if mirror is not None:
+            pkgs = mirror.searchVersions(package.lower(), args['searchon'],
+                                         exact, args['suite'],
+                                         args['section'],
+                                         self.registryValue('local.archs'))
+            if not pkgs:
+                irc.reply(format('No package found for %s (%s)',
+                          package, args['suite']))
+                return
+            irc.reply(self._formatVersions(pkgs))
+            return
         args['keywords'] = utils.web.urlquote(package)
         url %= args
         try:
@@ -168,45 +765,12 @@ class Debian(callbacks.Plugin):
         if 'is down at the moment' in html:
             irc.error('Packages.debian.org is down at the moment.  '
                       'Please try again later.', Raise=True)
-        pkgs = self._deblistreVersion.findall(html)
+        pkgs = parseVersions(html)
         if not pkgs:
             irc.reply(format('No package found for %s (%s)',
                       utils.web.urlunquote(package), args['suite']))
         else:
-            for pkg in pkgs:
-                pkgMatch = pkg[0]
-                soup = BeautifulSoup.BeautifulSoup(pkg[1])
-                liBranches = soup.find_all('li')
-                branches = []
-                versions = []
-                provided_by = []
-                def branchVers(br):
-                    vers = [b.next.string.strip() for b in br]
-                    return [utils.str.rsplit(v, ':', 1)[0].split('[', 1)[0].strip() for v in vers]
-                for li in liBranches:
-                    branches.append(li.a.string)
-                    lines = li.find_all('br')
-                    versions.append(branchVers(l for l in lines
-                            if not str(l.next).startswith('also provided by')))
-                    provided_by.append([l.next.next.string for l in lines
-                            if str(l.next).startswith('also provided by')])
-
-                if branches and versions:
-                    for triples in  zip(branches, versions, provided_by):
-                        branch = triples[0]
-                        ver = ', '.join(triples[1])
-                        if triples[2]:
-                            provided_by = format('; also provided by: %L',
-                                    triples[2])
-                        else:
-                            provided_by = ''
-                        s = format('%s (%s%s)', pkgMatch,
-                                   ': '.join([branch, ver]),
-                                   provided_by)
-                        responses.append(s)
-            resp = format('%i matches found: %s',
-                          len(responses), '; '.join(responses))
-            irc.reply(resp)
+            irc.reply(self._formatVersions(pkgs))
     version = wrap(version, [getopts({'exact': '',
                                       'searchon': ('literal', ('names',
                                                                'all',
@@ -222,67 +786,30 @@ class Debian(callbacks.Plugin):
                                       'text'])
 
     _description = re.compile(r'<h1>(.*)</h1>')
-    def description(self, irc, msg, args, pkg):
-        """<source package>
-
-        Reports the description of the <source package>.
-        """
-        pkg = pkg.lower()
-        try:
-            text = utils.web.getUrl('http://packages.qa.debian.org/%s/%s.html' %
-                                    (pkg[0], pkg)).decode('utf8')
-        except utils.web.Error:
-            irc.errorInvalid('source package name')
-        if 'This package is not part of any Debian' in text:
-            irc.error('This package does not exist anymore.', Raise=True)
-        for line in text.split('\n'):
-            match = self._description.search(text)
-            if match is not None:
-                break
-        assert match is not None
-        description = match.group(1)
-        description = description.replace('<br />', ':')
-        description = utils.web.htmlToText(description)
-        irc.reply(description)
-    description = wrap(description, ['somethingWithoutSpaces'])
-
-
-    def bold(self, s):
-        if self.registryValue('bold', dynamic.channel):
-            return ircutils.bold(s)
-        return s
-
     _update = re.compile(r' : ([^<]+)</body')
     _bugsCategoryTitle = re.compile(r'<dt id="bugs_.." title="([^>]+)">')
     _latestVersion = re.compile(r'<span id="latest_version">(.+)</span>')
     _maintainer = re.compile(r'<a href=".*login=(?P<email>[^<]+)">.*'
                              '<span class="name" title="maintainer">'
                              '(?P<name>[^<]+)</span>', re.S)
-    def stats(self, irc, msg, args, pkg):
-        """<source package>
-
-        Reports various statistics (from http://packages.qa.debian.org/) about
-        <source package>.
-        """
-        pkg = pkg.lower()
-        try:
-            text = utils.web.getUrl('http://packages.qa.debian.org/%s/%s.html' %
-                                    (pkg[0], pkg)).decode('utf8')
-        except utils.web.Error:
-            irc.errorInvalid('source package name')
-        if 'This package is not part of any Debian' in text:
-            irc.error('This package does not exist anymore.', Raise=True)
-        for line in text.split('\n'):
-            match = self._latestVersion.search(text)
-            if match is not None:
-                break
-        assert match is not None
-        version = '%s: %s' % (self.bold('Last version'),
-                              match.group(1))
-        updated = None
-        m = self._update.search(text)
-        if m:
-            updated = m.group(1)
+    def _parseQaPage(self, text):
+        """Returns a dict of what the description and stats commands need
+        from a packages.qa.debian.org page."""
+        record = {'gone': 'This package is not part of any Debian' in text,
+                  'description': None, 'version': None, 'updated': None,
+                  'maintainer': None, 'bugs': {}}
+        if record['gone']:
+            return record
+        match = self._description.search(text)
+        if match is not None:
+            description = match.group(1).replace('<br />', ':')
+            record['description'] = utils.web.htmlToText(description)
+        match = self._latestVersion.search(text)
+        if match is not None:
+            record['version'] = match.group(1)
+        match = self._update.search(text)
+        if match is not None:
+            record['updated'] = match.group(1)
         soup = BeautifulSoup.BeautifulSoup(text)
         pairs = zip(soup.find_all('dt'),
                     soup.find_all('dd'))
@@ -299,27 +826,120 @@ class Debian(callbacks.Plugin):
                     continue
             if title == 'Maintainer and Uploaders':
                 match = self._maintainer.search(str(content))
-                name, email = match.group('name'), match.group('email')
+                if match is not None:
+                    record['maintainer'] = (match.group('name'),
+                                            match.group('email'))
+            elif content.span is not None:
+                # Copied to a str, as a NavigableString would keep the
+                # whole soup alive in the cache
+                string = content.span.string
+                record['bugs'][title] = None if string is None else str(string)
+        return record
+
+    def _fetchQaPage(self, pkg):
+        try:
+            text = utils.web.getUrl('http://packages.qa.debian.org/%s/%s.html' %
+                                    (pkg[0], pkg)).decode('utf8')
+        except utils.web.Error:
+            return None
+        return self._parseQaPage(text)
+
+    def _getQaPage(self, irc, pkg):
+        """Returns the parsed packages.qa.debian.org page of the source
+        package pkg.  Pages are kept for supybot.plugins.Debian.cache.ttl
+        seconds, and a page requested by several commands at once is only
+        fetched once."""
+        ttl = self.registryValue('cache.ttl')
+        with self._qaLock:
+            (timestamp, record) = self._qaPages.get(pkg, (0, None))
+            fresh = time.time() - timestamp < ttl
+            pending = self._qaPending.get(pkg)
+            fetcher = not fresh and pending is None
+            if fetcher:
+                pending = self._qaPending[pkg] = PendingPage()
+        if fetcher:
+            try:
+                pending.record = self._fetchQaPage(pkg)
+            finally:
+                with self._qaLock:
+                    now = time.time()
+                    for (key, (timestamp, _)) in list(self._qaPages.items()):
+                        if now - timestamp >= ttl:
+                            del self._qaPages[key]
+                    if pending.record is not None and ttl:
+                        self._qaPages[pkg] = (now, pending.record)
+                    del self._qaPending[pkg]
+                pending.event.set()
+            record = pending.record
+        elif not fresh:
+            # Another thread is already fetching it.
+            pending.event.wait()
+            record = pending.record
+        if record is None:
+            irc.errorInvalid('source package name', pkg, Raise=True)
+        if record['gone']:
+            irc.error('This package does not exist anymore.', Raise=True)
+        return record
+
+    def description(self, irc, msg, args, pkg):
+        """<source package>
+
+        Reports the description of the <source package>.
+        """
+        pkg = pkg.lower()
+        if self._getMirror() is not None:
+            (version, maintainer, summary) = self._getLocalSource(irc, pkg)
+            irc.reply('%s: %s' % (pkg, summary))
+            return
+        record = self._getQaPage(irc, pkg)
+        assert record['description'] is not None
+        irc.reply(record['description'])
+    description = wrap(description, ['somethingWithoutSpaces'])
+
+
+    def bold(self, s):
+        if self.registryValue('bold', dynamic.channel):
+            return ircutils.bold(s)
+        return s
+
+    _maintainerField = re.compile(r'(?P<name>.*?)\s*<(?P<email>[^>]+)>')
+    _bugsCategories = (('All bugs', '%i Total'),
+                       ('Release Critical', '%i RC'),
+                       ('Important and Normal', '%i Important/Normal'),
+                       ('Minor and Wishlist', '%i Minor/Wishlist'),
+                       ('Fixed and Pending', '%i Fixed/Pending'))
+    def stats(self, irc, msg, args, pkg):
+        """<source package>
+
+        Reports various statistics (from http://packages.qa.debian.org/) about
+        <source package>.
+        """
+        pkg = pkg.lower()
+        if self._getMirror() is not None:
+            # Bug counts are not in the mirror.
+            (version, maintainer, summary) = self._getLocalSource(irc, pkg)
+            s = '%s: %s' % (self.bold('Last version'), version)
+            match = self._maintainerField.match(maintainer)
+            if match is not None:
                 maintainer = format('%s: %s %u', self.bold('Maintainer'),
-                                    name, utils.web.mungeEmail(email))
-            elif title == 'All bugs':
-                bugsAll = format('%i Total', content.span.string)
-            elif title == 'Release Critical':
-                bugsRC = format('%i RC', content.span.string)
-            elif title == 'Important and Normal':
-                bugs = format('%i Important/Normal',
-                              content.span.string)
-            elif title == 'Minor and Wishlist':
-                bugsMinor = format('%i Minor/Wishlist',
-                                   content.span.string)
-            elif title == 'Fixed and Pending':
-                bugsFixed = format('%i Fixed/Pending',
-                                   content.span.string)
-        bugL = (bugsAll, bugsRC, bugs, bugsMinor, bugsFixed)
+                                    match.group('name'),
+                                    utils.web.mungeEmail(match.group('email')))
+                s = '.  '.join((s, maintainer))
+            irc.reply(s)
+            return
+        record = self._getQaPage(irc, pkg)
+        assert record['version'] is not None
+        version = '%s: %s' % (self.bold('Last version'), record['version'])
+        (name, email) = record['maintainer']
+        maintainer = format('%s: %s %u', self.bold('Maintainer'),
+                            name, utils.web.mungeEmail(email))
+        bugL = [format(text, record['bugs'][title])
+                for (title, text) in self._bugsCategories
+                if title in record['bugs']]
         s = '.  '.join((version, maintainer,
                         '%s: %s' % (self.bold('Bugs'), '; '.join(bugL))))
-        if updated:
-            s = 'As of %s, %s' % (updated, s)
+        if record['updated']:
+            s = 'As of %s, %s' % (record['updated'], s)
         irc.reply(s)
     stats = wrap(stats, ['somethingWithoutSpaces'])
 
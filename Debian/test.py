@@ -29,7 +29,9 @@
 ###
 
 import os
+import gzip
 import time
+import threading
 
 from supybot.test import *
 
@@ -38,6 +40,195 @@ class DebianTestCase(PluginTestCase):
     timeout = 100
     cleanDataDir = False
     fileDownloaded = False
+
+    def _writeMirror(self, path):
+        def write(filename, content, opener=open):
+            filename = os.path.join(path, filename)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with opener(filename, 'wb') as fd:
+                fd.write(content.encode())
+        write('dists/stable/main/binary-amd64/Packages.gz',
+              'Package: dash\nSource: dash\nVersion: 0.5.12-2\n'
+              'Provides: sh\nDescription: POSIX-compliant shell\n'
+              ' The Debian Almquist Shell.\n\n'
+              'Package: limnoria\nVersion: 2021.06.15-1\n'
+              'Description: robust and user-friendly Python IRC bot\n\n',
+              gzip.open)
+        write('dists/stable/main/source/Sources',
+              'Package: limnoria\nBinary: limnoria\n'
+              'Version: 2021.06.15-1\n'
+              'Maintainer: Jane Doe <jane@example.org>\n\n')
+        write('dists/unstable/main/binary-amd64/Packages',
+              'Package: dash\nVersion: 0.5.12-6\n'
+              'Description: POSIX-compliant shell\n\n'
+              'Package: busybox\nVersion: 1:1.36.1-3\nProvides: dash\n'
+              'Description: Tiny utilities for small and embedded systems\n'
+              '\n')
+        write('dists/stable/main/Contents-amd64.gz',
+              'bin/dash                shells/dash\n'
+              'bin/sh                  shells/dash\n'
+              'usr/lib/klibc/bin/sh    libs/klibc-utils\n'
+              'usr/share/doc/dash/copyright shells/dash,shells/dash-static\n',
+              gzip.open)
+
+    def testLocalMirror(self):
+        path = os.path.join(conf.supybot.directories.data(), 'mirror')
+        self._writeMirror(path)
+        try:
+            conf.supybot.plugins.Debian.local.mirror.setValue(path)
+            self.assertResponse('debian file --exact --branch stable /bin/sh',
+                                '1 matches found: dash (stable)')
+            self.assertResponse('debian file --branch stable bin/sh',
+                                '2 matches found: dash; klibc-utils (stable)')
+            self.assertResponse('debian file --mode exactfilename copyright',
+                                '2 matches found: dash; dash-static (stable)')
+            self.assertResponse('debian file --mode filename ash',
+                                '1 matches found: dash (stable)')
+            self.assertRegexp('debian file oigrgrgregg',
+                              r'^No filename.*\(stable\)')
+            self.assertRegexp('debian file --branch testing bin/sh',
+                              r'^No filename.*\(testing\)')
+            # The index is rebuilt when the mirror replaces the file, even
+            # within the same second.
+            contents = os.path.join(path, 'dists/stable/main/Contents-amd64')
+            with gzip.open(contents + '.new', 'wb') as fd:
+                fd.write(b'bin/sh                  shells/bash\n')
+            os.replace(contents + '.new', contents + '.gz')
+            self.assertResponse('debian file --branch stable bin/sh',
+                                '1 matches found: bash (stable)')
+            self.assertResponse('debian version --exact dash',
+                                '2 matches found: dash (stable: 0.5.12-2); '
+                                'dash (unstable: 0.5.12-6; also provided by: '
+                                'busybox)')
+            self.assertResponse('debian version --searchon all embedded',
+                                '1 matches found: busybox (unstable: '
+                                '1:1.36.1-3)')
+            self.assertRegexp('debian version lakjdfad',
+                              r'^No package.*\(all\)')
+            self.assertResponse('description limnoria',
+                    'limnoria: robust and user-friendly Python IRC bot')
+            self.assertResponse('stats limnoria',
+                    '\x02Last version\x02: 2021.06.15-1.  '
+                    '\x02Maintainer\x02: Jane Doe '
+                    '<jane AT example DOT org>')
+            self.assertRegexp('stats rigjeojgoiejeo', 'Error.*package name')
+        finally:
+            conf.supybot.plugins.Debian.local.mirror.setValue('')
+
+    def testContentsIndex(self):
+        from Debian.plugin import buildContentsIndex, scanContents, \
+                ContentsIndex
+        path = os.path.join(conf.supybot.directories.data(), 'mirror')
+        self._writeMirror(path)
+        contents = os.path.join(path, 'dists/stable/main/Contents-amd64.gz')
+        indexFilename = os.path.join(conf.supybot.directories.data(),
+                                     'Contents-amd64.index')
+        # Sorted by runs of two records, which are then merged.
+        buildContentsIndex(contents, indexFilename, chunkSize=2)
+        index = ContentsIndex(indexFilename)
+        try:
+            self.assertEqual(index.count, 4)
+            for (mode, exact, s) in [('path', False, 'bin/sh'),
+                                     ('path', True, '/bin/sh'),
+                                     ('exactfilename', False, 'copyright'),
+                                     ('filename', False, 'ash')]:
+                if mode == 'path':
+                    found = index.searchSuffix(
+                        '/' + s.lstrip('/') if exact else s, exact=exact)
+                elif mode == 'exactfilename':
+                    found = index.searchSuffix('/' + s)
+                else:
+                    found = index.searchFilename(s)
+                self.assertEqual(found, scanContents(contents, mode, exact, s))
+        finally:
+            index.close()
+        # The first record of the index can match too
+        with gzip.open(contents, 'wb') as fd:
+            fd.write(b'bin/dash    shells/dash\nbin/sh    shells/sh\n')
+        buildContentsIndex(contents, indexFilename)
+        index = ContentsIndex(indexFilename)
+        try:
+            self.assertEqual(index.searchFilename('sh'), {'dash', 'sh'})
+            self.assertEqual(scanContents(contents, 'filename', False, 'sh'),
+                             {'dash', 'sh'})
+        finally:
+            index.close()
+
+    def testParseVersions(self):
+        from Debian.plugin import parseVersions
+        html = """<ul id="navigation"><li><a href="/">Home</a></li></ul>
+<h2>Exact hits</h2>
+<h3>Package libc6</h3>
+<ul>
+<li class="bookworm"><a class="resultlink" href="/bookworm/libc6">bookworm
+(stable)</a> (libs): GNU C Library: Shared libraries
+<br>2.36-9+deb12u3 [security]: amd64 arm64
+<br>2.36-9+deb12u4: amd64 arm64
+</li>
+<li class="sid"><a class="resultlink" href="/sid/libc6">sid (unstable)</a>
+(libs): GNU C Library: Shared libraries
+<br>2.37-12: amd64 arm64
+<br>also provided by: <a href="/sid/libc6-udeb">libc6-udeb</a>
+</li>
+</ul>
+<h3>Package busybox</h3>
+<ul>
+<li class="sid"><a class="resultlink" href="/sid/busybox">sid
+(unstable)</a> (utils): Tiny utilities
+<br>1:1.36.1-6: amd64
+</li>
+</ul>"""
+        self.assertEqual(parseVersions(html), [
+            ('libc6', [('bookworm\n(stable)',
+                        ['2.36-9+deb12u3', '2.36-9+deb12u4'], []),
+                       ('sid (unstable)', ['2.37-12'], ['libc6-udeb'])]),
+            ('busybox', [('sid\n(unstable)', ['1:1.36.1-6'], [])])])
+
+    _qaPage = """<html><body>
+<h1>limnoria<br />robust and user-friendly Python IRC bot</h1>
+<span id="latest_version">2021.06.15-1</span>
+<dl><dt title="Maintainer and Uploaders">maint</dt>
+<dd><a href="https://qa.debian.org/developer.php?login=jane@example.org">
+<span class="name" title="maintainer">Jane Doe</span></a></dd>
+<dt id="bugs_all">all</dt><dd><span>3</span></dd>
+<dt id="bugs_rc" title="Release Critical">RC</dt><dd><span>1</span></dd>
+</dl><p>Last update : Sun, 18 Oct 2026</body></html>"""
+
+    def testQaPageCache(self):
+        cb = self.irc.getCallback('Debian')
+        fetched = []
+        def fetch(pkg):
+            fetched.append(pkg)
+            time.sleep(0.1)
+            return cb._parseQaPage(self._qaPage)
+        cb._fetchQaPage = fetch
+        try:
+            threads = [threading.Thread(target=cb._getQaPage,
+                                        args=(self.irc, 'limnoria'))
+                       for i in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(fetched, ['limnoria'])
+            self.assertResponse('description limnoria',
+                    'limnoria:robust and user-friendly Python IRC bot')
+            self.assertResponse('stats limnoria',
+                    'As of Sun, 18 Oct 2026, '
+                    '\x02Last version\x02: 2021.06.15-1.  '
+                    '\x02Maintainer\x02: Jane Doe '
+                    '<jane AT example DOT org>.  '
+                    '\x02Bugs\x02: 3 Total; 1 RC')
+            self.assertEqual(fetched, ['limnoria'])
+            conf.supybot.plugins.Debian.cache.ttl.setValue(0)
+            self.assertNotError('description limnoria')
+            self.assertEqual(fetched, ['limnoria', 'limnoria'])
+        finally:
+            del cb._fetchQaPage
+            cb._qaPages.clear()
+            conf.supybot.plugins.Debian.cache.ttl.setValue(3600)
+
     if network:
         def testDebBug(self):
             self.assertNotRegexp('debian bug 539859', r'\<em\>')
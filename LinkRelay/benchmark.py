@@ -0,0 +1,206 @@
+###
+# Copyright (c) 2010, quantumlemur
+# Copyright (c) 2011, Valentin Lorentz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Measures how fast LinkRelay relays lines between simulated networks.
+
+Run it with:
+
+    python3 LinkRelay/benchmark.py --networks 3 --channels 20 --users 500
+
+It doesn't connect to anything: the networks are fake Irc objects whose
+state is filled with random users, and the relayed lines are only counted.
+"""
+
+import os
+import sys
+import time
+import random
+import atexit
+import shutil
+import tempfile
+import argparse
+import collections
+
+class FakeIrc(object):
+    """Just enough of supybot.irclib.Irc for LinkRelay."""
+    zombie = False
+
+    def __init__(self, network, nick='relay'):
+        import supybot.irclib as irclib
+        self.network = network
+        self.nick = nick
+        self.state = irclib.IrcState()
+        self.sent = 0
+
+    def isChannel(self, s):
+        import supybot.ircutils as ircutils
+        return ircutils.isChannel(s)
+
+    def sendMsg(self, msg):
+        self.sent += 1
+
+def makeNetworks(options):
+    import supybot.irclib as irclib
+    ircs = []
+    for i in range(options.networks):
+        irc = FakeIrc('net%i' % i)
+        for j in range(options.channels):
+            channel = '#chan%i' % j
+            state = irclib.ChannelState()
+            state.addUser(irc.nick)
+            for k in range(options.users):
+                state.addUser('user%i' % random.randrange(options.users * 4))
+            irc.state.channels[channel] = state
+        ircs.append(irc)
+    return ircs
+
+def makeRelays(options):
+    relays = []
+    for i in range(options.relays):
+        source = random.randrange(options.networks)
+        target = (source + 1 + random.randrange(options.networks - 1)) % \
+                options.networks
+        channel = random.randrange(options.channels)
+        relays.append('#chan%i | net%i | #chan%i | net%i | ' %
+                      (channel, source, channel, target))
+    for i in range(options.regexpRelays):
+        source = random.randrange(options.networks)
+        target = (source + 1 + random.randrange(options.networks - 1)) % \
+                options.networks
+        relays.append('#chan%i.* | net%i | #chan0 | net%i | ' %
+                      (i % 10, source, target))
+    return ' || '.join(relays)
+
+def makeTraffic(ircs, options):
+    import supybot.ircmsgs as ircmsgs
+    events = []
+    for i in range(options.events):
+        irc = random.choice(ircs)
+        channel = random.choice(list(irc.state.channels))
+        users = irc.state.channels[channel].users
+        nick = random.choice(list(users - set([irc.nick])))
+        prefix = '%s!user@host' % nick
+        kind = random.random()
+        if kind < 0.8:
+            msg = ircmsgs.privmsg(channel, 'line %i of the benchmark' % i,
+                                  prefix=prefix)
+        elif kind < 0.85:
+            msg = ircmsgs.join(channel, prefix='new%i!user@host' % i)
+        elif kind < 0.9:
+            msg = ircmsgs.part(channel, 'bye', prefix=prefix)
+        elif kind < 0.93:
+            msg = ircmsgs.mode(channel, ('+v', nick), prefix='op!user@host')
+        elif kind < 0.96:
+            msg = ircmsgs.nick('renamed%i' % i, prefix=prefix)
+        else:
+            msg = ircmsgs.quit('bye', prefix=prefix)
+        events.append((irc, msg))
+    return events
+
+def main():
+    parser = argparse.ArgumentParser(description='LinkRelay benchmark.')
+    parser.add_argument('--networks', type=int, default=3)
+    parser.add_argument('--channels', type=int, default=20,
+                        help='number of channels on each network')
+    parser.add_argument('--users', type=int, default=500,
+                        help='number of users in each channel')
+    parser.add_argument('--relays', type=int, default=40,
+                        help='number of channel@network to channel@network '
+                        'relays')
+    parser.add_argument('--regexp-relays', dest='regexpRelays', type=int,
+                        default=5, help='number of relays whose source is '
+                        'a regexp')
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    if options.networks < 2:
+        parser.error('At least two networks are needed.')
+    random.seed(options.seed)
+
+    pluginsDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, pluginsDir)
+    # Supybot writes its configuration and logs in the current directory.
+    tmpDir = tempfile.mkdtemp()
+    os.chdir(tmpDir)
+    # Registered before Supybot is imported, so it runs after Supybot's own
+    # exit handlers.
+    atexit.register(shutil.rmtree, tmpDir, True)
+    run(options)
+
+def run(options):
+    import supybot.conf as conf
+    import supybot.world as world
+    import supybot.log as log
+    log._stdoutHandler.setLevel(100)
+    import LinkRelay
+
+    ircs = makeNetworks(options)
+    world.ircs.extend(ircs)
+    conf.supybot.plugins.LinkRelay.queue.interval.setValue(0)
+    cb = LinkRelay.Class(ircs[0])
+    conf.supybot.plugins.LinkRelay.relays.setValue(makeRelays(options))
+    events = makeTraffic(ircs, options)
+
+    times = collections.defaultdict(float)
+    counts = collections.defaultdict(int)
+    startWall = time.time()
+    startCpu = time.process_time()
+    for (irc, msg) in events:
+        # Like Irc.feedMsg: the state is updated before the callbacks
+        # are called.
+        irc.state.addMsg(irc, msg)
+        # The handlers are called directly, so we only measure LinkRelay
+        # and not the dispatching done by Supybot.
+        handler = getattr(cb, 'do' + msg.command.capitalize())
+        before = time.process_time()
+        handler(irc, msg)
+        times[msg.command] += time.process_time() - before
+        counts[msg.command] += 1
+    wall = time.time() - startWall
+    cpu = time.process_time() - startCpu
+    cb.die()
+    for irc in ircs:
+        world.ircs.remove(irc)
+
+    relayed = sum(irc.sent for irc in ircs)
+    print('%i events, %i lines relayed in %.3fs (%.3fs CPU)' %
+          (len(events), relayed, wall, cpu))
+    print('%.0f lines relayed per second, %.1f us CPU per event' %
+          (relayed / wall, cpu / len(events) * 1e6))
+    for command in sorted(counts):
+        print('  %-8s %6i events, %8.1f us CPU per event' %
+              (command, counts[command],
+               times[command] / counts[command] * 1e6))
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
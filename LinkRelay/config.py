@@ -102,6 +102,25 @@ conf.registerGlobalValue(LinkRelay, 'substitutes',
     registry.String('', _("""You shouldn't edit this configuration variable
     yourself unless you know what you do. Use @LinkRelay (no)substitute instead.""")))
 
+conf.registerGroup(LinkRelay, 'queue')
+conf.registerGlobalValue(LinkRelay.queue, 'interval',
+    registry.Float(0.0, _("""Determines the minimum number of seconds
+    between two lines relayed to the same channel of the same network.
+    If it is 0, lines are relayed as soon as they are received.""")))
+conf.registerGlobalValue(LinkRelay.queue, 'coalesce',
+    registry.Boolean(False, _("""Determines whether consecutive lines from
+    the same source waiting in a queue will be joined in a single line, if
+    they fit in it.""")))
+conf.registerGlobalValue(LinkRelay.queue, 'maxSize',
+    registry.PositiveInteger(50, _("""Determines the maximum number of lines
+    waiting to be relayed to a channel of a network.""")))
+class ValidDropPolicy(registry.OnlySomeStrings):
+    validStrings = ('oldest', 'newest')
+conf.registerGlobalValue(LinkRelay.queue, 'dropPolicy',
+    ValidDropPolicy('oldest', _("""Determines which line is dropped when a
+    queue is full: the oldest waiting line (oldest) or the line which is
+    being added (newest).""")))
+
 conf.registerGroup(LinkRelay, 'colors')
 for name, color in {'info': '02',
                     'truncated': '14',
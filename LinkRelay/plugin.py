@@ -29,13 +29,16 @@
 ###
 
 import re
-import copy
+import time
 import string
+import threading
+import collections
 import supybot.log as log
 import supybot.conf as conf
 import supybot.utils as utils
 import supybot.world as world
 from supybot.commands import *
+import supybot.schedule as schedule
 import supybot.irclib as irclib
 import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
@@ -68,12 +71,59 @@ class LinkRelay(callbacks.Plugin):
             self.networkRegex = networkRegex
             self.messageRegex = messageRegex
 
+    class Queue():
+        """Lines waiting to be relayed to a channel of a network."""
+        def __init__(self, targetNetwork, targetChannel):
+            self.targetNetwork = targetNetwork
+            self.targetChannel = targetChannel
+            self.lines = collections.deque()
+            self.lastSent = 0
+            self.scheduled = None
+            self.sent = 0
+            self.coalesced = 0
+            self.dropped = 0
+            self.totalLag = 0.
+            self.maxLag = 0.
+
+        def push(self, source, f, s, maxLength, coalesce, maxSize,
+                 dropPolicy):
+            if coalesce and self.lines:
+                (when, lastSource, lastF, lastS) = self.lines[-1]
+                if lastSource == source and lastF is f and \
+                        len(lastS) + len(s) + 3 <= maxLength:
+                    self.lines[-1] = (when, source, f, '%s | %s' % (lastS, s))
+                    self.coalesced += 1
+                    return
+            if len(self.lines) >= maxSize:
+                self.dropped += 1
+                if dropPolicy == 'newest':
+                    return
+                self.lines.popleft()
+            self.lines.append((time.time(), source, f, s))
+
+        def pop(self):
+            (when, source, f, s) = self.lines.popleft()
+            self.lastSent = time.time()
+            lag = self.lastSent - when
+            self.sent += 1
+            self.totalLag += lag
+            self.maxLag = max(self.maxLag, lag)
+            msg = f(self.targetChannel, s)
+            msg.tag('relayedMsg')
+            return msg
+
 
     def __init__(self, irc):
         self.__parent = super(LinkRelay, self)
         self.__parent.__init__(irc)
         self._loadFromConfig()
         self.ircstates = {}
+        # network -> (nick -> channels), used to know where a quitting
+        # nick was, as the IrcState has already forgotten it by then.
+        self._channelsOf = {}
+        # (network, channel) -> Queue
+        self._queues = {}
+        self._queuesLock = threading.Lock()
         try:
             conf.supybot.plugins.LinkRelay.substitutes.addCallback(
                     self._loadFromConfig)
@@ -104,6 +154,20 @@ class LinkRelay(callbacks.Plugin):
             except:
                 log.error('Failed adding relay: %r' % relay)
 
+        # Relays whose source is a plain channel@network are looked up
+        # directly; the others have to be matched against every channel,
+        # so we remember the result for the channels we already saw.
+        self._exactRoutes = {}
+        self._wildcardRelays = []
+        for relay in self.relays:
+            if self._isWildcard(relay.sourceChannel) or \
+                    self._isWildcard(relay.sourceNetwork):
+                self._wildcardRelays.append(relay)
+            else:
+                key = (relay.sourceNetwork.lower(), relay.sourceChannel.lower())
+                self._exactRoutes.setdefault(key, []).append(relay)
+        self._routesCache = utils.structures.CacheDict(1000)
+
         self.nickSubstitutions = {}
         for substitute in self.registryValue('substitutes').split(' || '):
             if substitute.endswith('|'):
@@ -115,6 +179,27 @@ class LinkRelay(callbacks.Plugin):
 
 
 
+    _wildcardChars = frozenset('.^$*+?{}[]\\|()')
+    def _isWildcard(self, s):
+        return not self._wildcardChars.isdisjoint(s)
+
+    def _getRoutes(self, network, channel):
+        """Returns the relays whose source matches this channel@network, in
+        the order they are configured."""
+        key = (network.lower(), channel.lower())
+        try:
+            return self._routesCache[key]
+        except KeyError:
+            pass
+        routes = list(self._exactRoutes.get(key, []))
+        routes.extend([relay for relay in self._wildcardRelays
+                       if relay.channelRegex.match(channel) and
+                       relay.networkRegex.match(network)])
+        if self._wildcardRelays and routes:
+            routes.sort(key=self.relays.index)
+        self._routesCache[key] = routes
+        return routes
+
     def simpleHash(self, s):
         colors = ["\x0305", "\x0304", "\x0303", "\x0309", "\x0302", "\x0312",
                   "\x0306",   "\x0313", "\x0310", "\x0311", "\x0307"]
@@ -150,6 +235,50 @@ class LinkRelay(callbacks.Plugin):
         return s
 
 
+    # The following functions maintain the nick -> channels index
+    def _getChannelsOf(self, irc):
+        """Returns the nick -> channels index of this network, building it
+        from the IrcState if we don't know this network yet."""
+        try:
+            return self._channelsOf[irc.network]
+        except KeyError:
+            channelsOf = ircutils.IrcDict()
+            for (channel, c) in irc.state.channels.items():
+                for nick in c.users:
+                    channelsOf.setdefault(nick, ircutils.IrcSet()).add(channel)
+            self._channelsOf[irc.network] = channelsOf
+            return channelsOf
+
+    def _addMember(self, irc, nick, channel):
+        channelsOf = self._getChannelsOf(irc)
+        channelsOf.setdefault(nick, ircutils.IrcSet()).add(channel)
+
+    def _removeMember(self, irc, nick, channel):
+        channelsOf = self._getChannelsOf(irc)
+        if ircutils.strEqual(nick, irc.nick):
+            # We left the channel, so we don't know who is in it anymore.
+            nicks = list(channelsOf)
+        else:
+            nicks = [nick]
+        for nick in nicks:
+            channels = channelsOf.get(nick)
+            if channels is None:
+                continue
+            channels.discard(channel)
+            if not channels:
+                del channelsOf[nick]
+
+    def do001(self, irc, msg):
+        self._channelsOf[irc.network] = ircutils.IrcDict()
+
+    def do366(self, irc, msg):
+        # End of /NAMES: the IrcState now knows all the users of the channel.
+        channel = msg.args[1]
+        if channel in irc.state.channels:
+            for nick in irc.state.channels[channel].users:
+                self._addMember(irc, nick, channel)
+
+
     @internationalizeDocstring
     def list(self, irc, msg, args):
         """takes no arguments
@@ -232,6 +361,8 @@ class LinkRelay(callbacks.Plugin):
             args['nick'] = msg.prefix
         s = '%(color)s' + _('--> %(nick)s has joined %(channel)s%(network)s')
         self.sendToOthers(irc, msg.args[0], s, args)
+        for channel in msg.args[0].split(','):
+            self._addMember(irc, msg.nick, channel)
 
     def doPart(self, irc, msg):
         args = {'nick': msg.nick, 'channel': msg.args[0], 'color': ''}
@@ -241,6 +372,8 @@ class LinkRelay(callbacks.Plugin):
             args['nick'] = msg.prefix
         s = '%(color)s' + _('<-- %(nick)s has left %(channel)s%(network)s')
         self.sendToOthers(irc, msg.args[0], s, args)
+        for channel in msg.args[0].split(','):
+            self._removeMember(irc, msg.nick, channel)
 
     def doKick(self, irc, msg):
         args = {'kicked': msg.args[1], 'channel': msg.args[0],
@@ -251,6 +384,13 @@ class LinkRelay(callbacks.Plugin):
         s = '%(color)s' + _('<-- %(kicked)s has been kicked from '
                 '%(channel)s%(network)s by %(kicker)s (%(message)s)')
         self.sendToOthers(irc, msg.args[0], s, args)
+        # Either one channel and several nicks, or as many channels as nicks
+        channels = msg.args[0].split(',')
+        nicks = msg.args[1].split(',')
+        if len(channels) == 1:
+            channels *= len(nicks)
+        for (channel, nick) in zip(channels, nicks):
+            self._removeMember(irc, nick, channel)
 
     def doNick(self, irc, msg):
         args = {'oldnick': msg.nick, 'network': irc.network,
@@ -263,6 +403,9 @@ class LinkRelay(callbacks.Plugin):
         for (channel, c) in irc.state.channels.items():
             if msg.args[0] in c.users:
                 self.sendToOthers(irc, channel, s, args)
+        channelsOf = self._getChannelsOf(irc)
+        if msg.nick in channelsOf:
+            channelsOf[msg.args[0]] = channelsOf.pop(msg.nick)
 
     def doQuit(self, irc, msg):
         args = {'nick': msg.nick, 'network': irc.network,
@@ -272,17 +415,36 @@ class LinkRelay(callbacks.Plugin):
             args['color'] = '\x03%s' % self.registryValue('colors.quit')
         s = _('<-- %(nick)s has quit on %(network)s (%(message)s)')
         self.sendToOthers(irc, None, s, args, msg.nick)
+        if ircutils.strEqual(msg.nick, irc.nick):
+            self._channelsOf.pop(irc.network, None)
+        else:
+            self._getChannelsOf(irc).pop(msg.nick, None)
 
     def sendToOthers(self, irc, channel, s, args, nick=None, isPrivmsg=False):
         assert channel is not None or nick is not None
-        def format_(relay, s, args):
-            if 'network' not in args:
-                if self.registryValue('includeNetwork', relay.targetChannel):
-                    args['network'] = '@' + irc.network
+        # The only thing which depends on the relay is whether the network
+        # is included, so the message is formatted at most twice.
+        formatted = {}
+        def format_(relay):
+            if 'network' in args:
+                includeNetwork = None
+            else:
+                includeNetwork = self.registryValue('includeNetwork',
+                                                    relay.targetChannel)
+            try:
+                return formatted[includeNetwork]
+            except KeyError:
+                pass
+            args_ = args
+            if includeNetwork is not None:
+                args_ = dict(args)
+                if includeNetwork:
+                    args_['network'] = '@' + irc.network
                 else:
-                    args['network'] = ''
-            return s % args
-        def send(s):
+                    args_['network'] = ''
+            new_s = formatted[includeNetwork] = s % args_
+            return new_s
+        def send(relay, channel, s):
             targetIRC = world.getIrc(relay.targetNetwork)
             if not targetIRC:
                 self.log.info('LinkRelay:  Not connected to network %s.' %
@@ -309,33 +471,96 @@ class LinkRelay(callbacks.Plugin):
                 head = s[0:allowedLength]
                 tail = [cont + ' ' + s[i:i+remainingLength] for i in
                         range(allowedLength, len(s), remainingLength)]
-                for s in [head] + tail:
-                    msg = f(relay.targetChannel, s)
-                    msg.tag('relayedMsg')
-                    targetIRC.sendMsg(msg)
+                self._queueLines(relay, '%s@%s' % (channel, irc.network), f,
+                                 [head] + tail, allowedLength)
 
         if channel is None:
-            for relay in self.relays:
-                if not hasattr(relay, 'sourceIRCChannels'):
-                    continue
-                for channel in relay.sourceIRCChannels:
-                    new_s = format_(relay, s, args)
-                    if nick in relay.sourceIRCChannels[channel].users and \
-                            relay.channelRegex.match(channel) and \
-                            relay.networkRegex.match(irc.network)and \
-                            relay.messageRegex.search(new_s):
-                        send(new_s)
+            channels = self._getChannelsOf(irc).get(nick, ())
         else:
-            for relay in self.relays:
-                new_s = format_(relay, s, args)
-                if relay.channelRegex.match(channel) and \
-                        relay.networkRegex.match(irc.network)and \
-                        relay.messageRegex.search(new_s):
-                    send(new_s)
-        for relay in self.relays:
-            if relay.sourceNetwork == irc.network:
-                relay.sourceIRCChannels = copy.deepcopy(irc.state.channels)
+            channels = (channel,)
+        for channel in channels:
+            for relay in self._getRoutes(irc.network, channel):
+                new_s = format_(relay)
+                if relay.messageRegex.search(new_s):
+                    send(relay, channel, new_s)
+
+
+    # The following functions handle the outbound queues
+    def _queueLines(self, relay, source, f, lines, maxLength):
+        key = (relay.targetNetwork.lower(), ircutils.toLower(relay.targetChannel))
+        with self._queuesLock:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self.Queue(relay.targetNetwork, relay.targetChannel)
+                self._queues[key] = queue
+            for s in lines:
+                queue.push(source, f, s, maxLength,
+                           self.registryValue('queue.coalesce'),
+                           self.registryValue('queue.maxSize'),
+                           self.registryValue('queue.dropPolicy'))
+            if queue.scheduled is None:
+                self._flushQueue(queue)
+
+    def _flushQueue(self, queue):
+        """Sends the lines of the queue which can be sent right now, and
+        schedules the sending of the other ones. The lock must be held."""
+        queue.scheduled = None
+        targetIRC = world.getIrc(queue.targetNetwork)
+        if not targetIRC or targetIRC.zombie:
+            queue.dropped += len(queue.lines)
+            queue.lines.clear()
+            return
+        interval = self.registryValue('queue.interval')
+        while queue.lines and time.time() - queue.lastSent >= interval:
+            targetIRC.sendMsg(queue.pop())
+        if queue.lines:
+            def flush():
+                with self._queuesLock:
+                    self._flushQueue(queue)
+            queue.scheduled = schedule.addEvent(flush,
+                                                queue.lastSent + interval)
+
+    def die(self):
+        with self._queuesLock:
+            for queue in self._queues.values():
+                if queue.scheduled is not None:
+                    try:
+                        schedule.removeEvent(queue.scheduled)
+                    except KeyError:
+                        pass
+                    queue.scheduled = None
+                # Don't lose the waiting lines; the Irc objects will still
+                # send them at their own rate.
+                targetIRC = world.getIrc(queue.targetNetwork)
+                while queue.lines and targetIRC and not targetIRC.zombie:
+                    targetIRC.sendMsg(queue.pop())
+        self.__parent.die()
+
+    @internationalizeDocstring
+    def queues(self, irc, msg, args):
+        """takes no arguments
 
+        Returns, for each channel lines are relayed to, the number of lines
+        waiting, sent, coalesced and dropped, and the average and maximum
+        time lines waited before being relayed."""
+        with self._queuesLock:
+            queues = list(self._queues.values())
+        if not queues:
+            irc.reply(_('No line has been relayed yet.'))
+            return
+        replies = []
+        for queue in queues:
+            if queue.sent:
+                averageLag = queue.totalLag / queue.sent
+            else:
+                averageLag = 0.
+            replies.append(_('%s on %s: %i waiting, %i sent, %i coalesced, '
+                             '%i dropped, %.2fs average lag, %.2fs max lag') %
+                           (queue.targetChannel, queue.targetNetwork,
+                            len(queue.lines), queue.sent, queue.coalesced,
+                            queue.dropped, averageLag, queue.maxLag))
+        irc.replies(replies)
+    queues = wrap(queues)
 
     @internationalizeDocstring
     def nicks(self, irc, msg, args, channel):
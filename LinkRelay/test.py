@@ -87,6 +87,84 @@ class LinkRelayTestCase(ChannelPluginTestCase):
         self.assertNotError('linkrelay nosubstitute foobar')
         self.assertResponse('config supybot.plugins.LinkRelay.substitutes', ' ')
 
+    def testChannelsOf(self):
+        cb = self.irc.getCallback('LinkRelay')
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='foo!bar@baz'))
+        self.irc.feedMsg(ircmsgs.join('#other', prefix='foo!bar@baz'))
+        channelsOf = cb._getChannelsOf(self.irc)
+        self.assertEqual(set(channelsOf['foo']), set([self.channel, '#other']))
+        self.irc.feedMsg(ircmsgs.part('#other', prefix='foo!bar@baz'))
+        self.assertEqual(set(channelsOf['FOO']), set([self.channel]))
+        self.irc.feedMsg(ircmsgs.join('#a,#b', prefix='a!bar@baz'))
+        self.irc.feedMsg(ircmsgs.join('#a', prefix='b!bar@baz'))
+        self.irc.feedMsg(ircmsgs.IrcMsg(command='KICK',
+                                        args=('#a,#b', 'b,a', 'bye'),
+                                        prefix='op!bar@baz'))
+        self.assertEqual(set(channelsOf['a']), set(['#a']))
+        self.assertFalse('b' in channelsOf)
+        self.irc.feedMsg(ircmsgs.nick('qux', prefix='foo!bar@baz'))
+        self.assertFalse('foo' in channelsOf)
+        self.assertEqual(set(channelsOf['qux']), set([self.channel]))
+        self.irc.feedMsg(ircmsgs.quit('bye', prefix='qux!bar@baz'))
+        self.assertFalse('qux' in channelsOf)
+
+    def testRoutes(self):
+        cb = self.irc.getCallback('LinkRelay')
+        self.assertNotError('config supybot.plugins.LinkRelay.relays '
+                            '"#foo | bar | #baz | bam |  || '
+                            '#f.* | bar | #qux | bam |  || '
+                            '#Foo | Bar | #quux | bam | "')
+        self.assertEqual([r.targetChannel for r in cb._getRoutes('bar', '#foo')],
+                         ['#baz', '#qux', '#quux'])
+        self.assertEqual([r.targetChannel for r in cb._getRoutes('BAR', '#fa')],
+                         ['#qux'])
+        self.assertEqual(cb._getRoutes('bam', '#foo'), [])
+        self.assertNotError('config supybot.plugins.LinkRelay.relays ""')
+        self.assertEqual(cb._getRoutes('bar', '#foo'), [])
+
+    def testRelay(self):
+        self.assertNotError('config supybot.plugins.LinkRelay.color False')
+        self.assertNotError('config supybot.plugins.LinkRelay.relayOutgoing '
+                            'False')
+        self.assertNotError('config supybot.plugins.LinkRelay.queue.interval '
+                            '0')
+        self.assertNotError('config supybot.plugins.LinkRelay.relays '
+                            '"#test | test | #test | test | "')
+        while self.irc.takeMsg():
+            # The command itself was relayed.
+            pass
+        try:
+            self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'hello',
+                                             prefix='foo!bar@baz'))
+            m = self.irc.takeMsg()
+            self.assertEqual(m.args, (self.channel, '<foo@test> hello'))
+            self.assertTrue(m.relayedMsg)
+        finally:
+            self.assertNotError('config supybot.plugins.LinkRelay.relays ""')
+            self.assertNotError('config supybot.plugins.LinkRelay.color True')
+            self.assertNotError('config supybot.plugins.LinkRelay.'
+                                'relayOutgoing True')
+            self.assertNotError('config supybot.plugins.LinkRelay.'
+                                'queue.interval 0')
+
+    def testQueue(self):
+        cb = self.irc.getCallback('LinkRelay')
+        queue = cb.Queue('test', self.channel)
+        queue.push('#a@net', ircmsgs.privmsg, '<a> foo', 20, True, 2, 'oldest')
+        queue.push('#a@net', ircmsgs.privmsg, '<b> bar', 20, True, 2, 'oldest')
+        queue.push('#b@net', ircmsgs.privmsg, '<c> baz', 20, True, 2, 'oldest')
+        self.assertEqual(queue.coalesced, 1)
+        self.assertEqual(len(queue.lines), 2)
+        queue.push('#b@net', ircmsgs.privmsg, '<d> a long line', 20, True, 2,
+                   'oldest')
+        self.assertEqual(queue.dropped, 1)
+        queue.push('#b@net', ircmsgs.privmsg, '<e> another one', 20, True, 2,
+                   'newest')
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(queue.pop().args, (self.channel, '<c> baz'))
+        self.assertEqual(queue.pop().args, (self.channel, '<d> a long line'))
+        self.assertEqual(queue.sent, 2)
+
 
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -14,7 +14,7 @@
 ###
 
 """
-Display information on packages using apt-cache and search for files in packages with apt-file.
+Display information on packages using python-apt and search for files in packages with apt-file.
 """
 
 from imp import reload
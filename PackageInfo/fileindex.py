@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- Encoding: utf-8 -*-
+###
+# Copyright (c) 2006-2007 Dennis Kaarsemaker
+# Copyright (c) 2008-2010 Terence Simpson
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+###
+
+# Index of the files of the packages of a release, built from the Contents
+# files downloaded by apt-file, so 'find' doesn't have to run apt-file.
+#
+# The index starts with a header (magic, number of paths), followed by the
+# offsets of the records, then the records: each path, reversed and with a
+# leading slash, then a NUL and the comma-separated names of the packages
+# containing it.  The records are sorted, so the paths ending with a given
+# name are next to each other and are found with a binary search.
+
+import os
+import sys
+import gzip
+import mmap
+import array
+import heapq
+import shutil
+import struct
+import tempfile
+
+MAGIC = b'PKGFIDX1'
+HEADER = struct.Struct('<8sQ')
+OFFSET = struct.Struct('<Q')
+
+def read_contents(filename):
+    """Yields (path, packages) for each line of a Contents file."""
+    opener = gzip.open if filename.endswith('.gz') else open
+    fd = opener(filename, 'rb')
+    try:
+        for line in fd:
+            try:
+                (path, locations) = line.rstrip(b'\n').rsplit(None, 1)
+            except ValueError:
+                continue
+            if b'/' not in locations:
+                # Header of old Contents files
+                continue
+            yield (path.strip().lstrip(b'/'),
+                   [location.rsplit(b'/', 1)[-1]
+                    for location in locations.split(b',')])
+    finally:
+        fd.close()
+
+# Records are sorted by runs of this many, written to temporary files and
+# merged, so the Contents files are never held in memory.
+SORT_CHUNK = 1000000
+
+def _write_run(records, dirname):
+    records.sort()
+    fd = tempfile.TemporaryFile(dir=dirname)
+    fd.writelines(records)
+    fd.seek(0)
+    return fd
+
+def _merge_duplicates(lines):
+    """Yields the sorted records, with the records of the same path
+    merged."""
+    (path, packages) = (None, [])
+    for line in lines:
+        (line_path, line_packages) = line.rstrip(b'\n').split(b'\0', 1)
+        if line_path != path:
+            if path is not None:
+                yield path + b'\0' + b','.join(packages) + b'\n'
+            (path, packages) = (line_path, [])
+        for package in line_packages.split(b','):
+            if package not in packages:
+                packages.append(package)
+    if path is not None:
+        yield path + b'\0' + b','.join(packages) + b'\n'
+
+def build(source, index_filename, chunk_size=SORT_CHUNK):
+    """Writes the index of the Contents files in the directory source (or
+    of the Contents file source) to index_filename."""
+    if os.path.isdir(source):
+        filenames = [os.path.join(source, name)
+                     for name in sorted(os.listdir(source))
+                     if 'Contents' in name]
+    else:
+        filenames = [source]
+    dirname = os.path.dirname(os.path.abspath(index_filename))
+    runs = []
+    try:
+        records = []
+        for filename in filenames:
+            for (path, packages) in read_contents(filename):
+                records.append((b'/' + path)[::-1] + b'\0' +
+                               b','.join(packages) + b'\n')
+                if len(records) >= chunk_size:
+                    runs.append(_write_run(records, dirname))
+                    records = []
+        runs.append(_write_run(records, dirname))
+        records = None
+        # The records are written to a temporary file while their offsets
+        # are computed, as the offsets come first in the index.
+        offsets = array.array('Q')
+        size = 0
+        records_fd = tempfile.TemporaryFile(dir=dirname)
+        try:
+            for record in _merge_duplicates(heapq.merge(*runs)):
+                offsets.append(size)
+                records_fd.write(record)
+                size += len(record)
+            offsets.append(size)
+            start = HEADER.size + OFFSET.size * len(offsets)
+            offsets = array.array('Q', (start + offset for offset in offsets))
+            if sys.byteorder != 'little':
+                offsets.byteswap()
+            records_fd.seek(0)
+            fd = open(index_filename + '.tmp', 'wb')
+            try:
+                fd.write(HEADER.pack(MAGIC, len(offsets) - 1))
+                offsets.tofile(fd)
+                shutil.copyfileobj(records_fd, fd)
+            finally:
+                fd.close()
+        finally:
+            records_fd.close()
+    finally:
+        for run in runs:
+            run.close()
+    os.rename(index_filename + '.tmp', index_filename)
+
+class FileIndex:
+    """Memory-mapped index written by build()."""
+    def __init__(self, filename):
+        fd = open(filename, 'rb')
+        try:
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+        self.mtime = os.stat(filename).st_mtime
+        (magic, self.count) = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a file index.' % filename)
+
+    def close(self):
+        self.mmap.close()
+
+    def _record(self, i):
+        (start,) = OFFSET.unpack_from(self.mmap, HEADER.size + OFFSET.size * i)
+        (end,) = OFFSET.unpack_from(self.mmap,
+                                    HEADER.size + OFFSET.size * (i + 1))
+        return self.mmap[start:end - 1].split(b'\0', 1)
+
+    def search(self, name):
+        """Returns the sorted names of the packages containing a file named
+        name, or a file whose path ends with name if it contains a slash."""
+        key = (b'/' + name.strip('/').encode('utf8'))[::-1]
+        (low, high) = (0, self.count)
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        packages = set()
+        for i in range(low, self.count):
+            (path, names) = self._record(i)
+            if not path.startswith(key):
+                break
+            packages.update(names.decode('utf8').split(','))
+        return sorted(packages)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: %s <apt-file cache directory> <index file>" % sys.argv[0])
+        sys.exit(1)
+    build(sys.argv[1], sys.argv[2])
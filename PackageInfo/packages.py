@@ -18,8 +18,13 @@
 import sys
 import warnings
 warnings.filterwarnings("ignore", "apt API not stable yet", FutureWarning)
-import subprocess, os, apt
-from email.feedparser import FeedParser
+import os, re, threading, apt, apt_pkg
+import apt.progress.base
+import supybot.world as world
+try:
+    from . import fileindex
+except (ImportError, ValueError): # Simple test, below
+    import fileindex
 
 if sys.version_info[0] >= 3:
     import urllib.parse
@@ -41,22 +46,141 @@ def description(pkg):
         return pkg['Description'].split('\n')[0]
     return None
 
-def apt_cache(aptdir, distro, extra):
-    return subprocess.check_output(['apt-cache',
-             '-oDir::State::Lists=%s/%s' % (aptdir, distro),
-             '-oDir::etc::sourcelist=%s/%s.list' % (aptdir, distro),
-             '-oDir::etc::SourceParts=%s/%s.list.d' % (aptdir, distro),
-             '-oDir::State::status=%s/%s.status' % (aptdir, distro),
-             '-oDir::Cache=%s/cache' % aptdir,
-             '-oAPT::Architecture=i386'] +
-             extra).decode('utf8')
-
-def apt_file(aptdir, distro, pkg):
-    return subprocess.check_output(['apt-file',
-            '-s', '%s/%s.list' % (aptdir, distro),
-            '-c', '%s/apt-file/%s' % (aptdir, distro),
-            '-l', '-a', 'i386',
-            'search', pkg]).decode('utf8')
+# The APT configuration is global to the process, so it is changed (and
+# restored) under this lock while a cache is being opened.  Other plugins
+# (like Apt) change it too, so the lock is kept in supybot.world, which is
+# shared by all plugins, as world.aptConfigLock.
+if not hasattr(world, 'aptConfigLock'):
+    world.aptConfigLock = threading.Lock()
+config_lock = world.aptConfigLock
+
+def cache_signature(aptdir, distro):
+    """Changes when apt-get update or the .list file change the lists."""
+    signature = []
+    for path in ('%s/%s' % (aptdir, distro), '%s/%s.list' % (aptdir, distro),
+                 '%s/%s.status' % (aptdir, distro)):
+        try:
+            signature.append(os.stat(path).st_mtime)
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+class DistroCache:
+    """python-apt cache of a distribution, instead of running apt-cache for
+    every lookup."""
+    def __init__(self, aptdir, distro, log):
+        self.signature = cache_signature(aptdir, distro)
+        self.lock = threading.Lock()
+        cachedir = '%s/cache/%s' % (aptdir, distro)
+        try:
+            os.makedirs(cachedir)
+        except OSError:
+            pass
+        options = {'Dir::State::Lists': '%s/%s' % (aptdir, distro),
+                   'Dir::Etc::sourcelist': '%s/%s.list' % (aptdir, distro),
+                   'Dir::Etc::SourceParts': '%s/%s.list.d' % (aptdir, distro),
+                   'Dir::State::status': '%s/%s.status' % (aptdir, distro),
+                   'Dir::Cache': cachedir,
+                   'APT::Architecture': 'i386'}
+        with config_lock:
+            saved = dict((key, apt_pkg.config.get(key)) for key in options)
+            try:
+                for (key, value) in options.items():
+                    apt_pkg.config.set(key, value)
+                self.cache = apt_pkg.Cache(apt.progress.base.OpProgress())
+                self.records = apt_pkg.PackageRecords(self.cache)
+                try:
+                    self.srcrecords = apt_pkg.SourceRecords()
+                except apt_pkg.Error:
+                    # No deb-src lines: packages are shown without the
+                    # architectures of their source.
+                    log.error("PackageInfo/packages: apt returned an error, do you have the deb-src URLs in %s.list?" % distro)
+                    self.srcrecords = None
+            finally:
+                for (key, value) in saved.items():
+                    apt_pkg.config.set(key, value)
+
+    def show(self, pkg):
+        """Returns the fields of the newest version of the binary package,
+        like 'apt-cache show', or None if there is no such package."""
+        with self.lock:
+            return self._show(pkg)
+
+    def showsrc(self, pkg):
+        """Returns the fields of the newest version of the source package of
+        pkg, like 'apt-cache showsrc', or None."""
+        with self.lock:
+            if self.srcrecords is None:
+                return None
+            newest = None
+            self.srcrecords.restart()
+            while self.srcrecords.lookup(pkg):
+                if newest is None or \
+                        apt_pkg.version_compare(newest['Version'], self.srcrecords.version) <= 0:
+                    newest = dict(apt_pkg.TagSection(self.srcrecords.record))
+            return newest
+
+    def show_many(self, pkgs):
+        """Returns {pkg: (show(pkg), showsrc(pkg))} for all the pkgs.  Each
+        showsrc() reads all the source records, so they are read once for
+        all the packages instead."""
+        with self.lock:
+            sources = {}
+            wanted = set(pkgs)
+            if self.srcrecords is not None:
+                self.srcrecords.restart()
+                while self.srcrecords.step():
+                    names = wanted.intersection([self.srcrecords.package] +
+                                                list(self.srcrecords.binaries))
+                    fields = None
+                    for name in names:
+                        newest = sources.get(name)
+                        if newest is None or \
+                                apt_pkg.version_compare(newest['Version'], self.srcrecords.version) <= 0:
+                            if fields is None:
+                                fields = dict(apt_pkg.TagSection(self.srcrecords.record))
+                            sources[name] = fields
+            return dict((pkg, (self._show(pkg), sources.get(pkg)))
+                        for pkg in wanted)
+
+    def _show(self, pkg):
+        try:
+            package = self.cache[pkg]
+        except KeyError:
+            return None
+        newest = None
+        for version in package.version_list:
+            if not version.file_list:
+                continue
+            if newest is None or \
+                    apt_pkg.version_compare(newest.ver_str, version.ver_str) <= 0:
+                newest = version
+        if newest is None:
+            return None
+        self.records.lookup(newest.file_list[0])
+        fields = dict(apt_pkg.TagSection(self.records.record))
+        if 'Description' not in fields and newest.translated_description:
+            self.records.lookup(newest.translated_description.file_list[0])
+            fields['Description-en'] = self.records.short_desc
+        return fields
+
+    def search(self, pattern):
+        """Returns the names of the packages matching the regexp, like
+        'apt-cache search -n'."""
+        try:
+            regexp = re.compile(pattern, re.I)
+        except re.error:
+            regexp = re.compile(re.escape(pattern), re.I)
+        names = set()
+        for package in self.cache.packages:
+            if package.has_versions and regexp.search(package.name):
+                names.add(package.name)
+        return sorted(names)
+
+def format_info(maxp):
+    return("%s (source: %s): %s. In component %s, is %s. Version %s (%s), package size %s kB, installed size %s kB%s" %
+           (maxp['Package'], maxp.get('Source') or maxp['Package'], description(maxp), component(maxp.get('Section', '')),
+            maxp.get('Priority'), maxp['Version'], maxp["Distribution"], int(maxp.get('Size', 0))/1024, maxp.get('Installed-Size'), maxp["Architectures"]))
 
 class Apt:
     def __init__(self, plugin):
@@ -68,6 +192,46 @@ class Apt:
         if self.aptdir:
             self.distros = [x[:-5] for x in os.listdir(self.aptdir) if x.endswith('.list')]
             self.distros.sort()
+        self.caches = {}
+        self.caches_lock = threading.Lock()
+        # Held while the cache of a distro is opened, so it is only opened
+        # once, without blocking the other distros.
+        self.distro_locks = {}
+        self.file_indexes = {}
+        self.file_indexes_lock = threading.Lock()
+
+    def get_cache(self, distro):
+        """Returns the DistroCache of distro, which is opened the first time
+        it is used and reopened when its lists change."""
+        signature = cache_signature(self.aptdir, distro)
+        with self.caches_lock:
+            cache = self.caches.get(distro)
+            if cache is not None and cache.signature == signature:
+                return cache
+            distro_lock = self.distro_locks.setdefault(distro, threading.Lock())
+        with distro_lock:
+            with self.caches_lock:
+                cache = self.caches.get(distro)
+            if cache is None or \
+                    cache.signature != cache_signature(self.aptdir, distro):
+                cache = DistroCache(self.aptdir, distro, self.log)
+                with self.caches_lock:
+                    self.caches[distro] = cache
+            return cache
+
+    def get_file_index(self, distro):
+        """Returns the FileIndex built by update_apt_file for distro, or None
+        if there is none."""
+        filename = '%s/%s.fileindex' % (self.aptdir, distro)
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            return None
+        with self.file_indexes_lock:
+            index = self.file_indexes.get(distro)
+            if index is None or index.mtime != mtime:
+                index = self.file_indexes[distro] = fileindex.FileIndex(filename)
+            return index
 
     def find(self, pkg, chkdistro, filelookup=True):
         _pkg = ''.join([x for x in pkg.strip().split(None,1)[0] if x.isalnum() or x in '.-_+/'])
@@ -80,32 +244,20 @@ class Apt:
             return "%s is not a valid distribution: %s" % (distro, ", ".join(self.distros))
         pkg = _pkg
 
-        try:
-            data = apt_cache(self.aptdir, distro, ['search', '-n', pkg])
-        except subprocess.CalledProcessError as e:
-            data = e.output
-        if not data:
+        pkgs = self.get_cache(distro).search(pkg)
+        if not pkgs:
             if filelookup:
-                try:
-                    data = apt_file(self.aptdir, distro, pkg).split()
-                except subprocess.CalledProcessError as e:
-                    data = e.output
+                index = self.get_file_index(distro)
+                if index is None:
+                    self.log.error("PackageInfo/packages: Please run the 'update_apt_file' script")
+                    return "Cache out of date, please contact the administrator"
+                data = index.search(pkg)
                 if data:
-                    if data[0] == 'sh:': # apt-file isn't installed
-                      self.log.error("PackageInfo/packages: apt-file is not installed")
-                      return "Please use http://packages.ubuntu.com/ to search for files"
-                    if data[0] == 'E:': # No files in the cache dir
-                      self.log.error("PackageInfo/packages: Please run the 'update_apt_file' script")
-                      return "Cache out of date, please contact the administrator"
-                    if data[0] == "Use" and data[1] == "of":
-                        url = "http://packages.ubuntu.com/search?searchon=contents&keywords=%s&mode=&suite=%s&arch=any" % (urlquote(pkg), distro)
-                        return url
                     if len(data) > 10:
                         return "File %s found in %s (and %d others) http://packages.ubuntu.com/search?searchon=contents&keywords=%s&mode=&suite=%s&arch=any" % (pkg, ', '.join(data[:10]), len(data)-10, urlquote(pkg), distro)
                     return "File %s found in %s" % (pkg, ', '.join(data))
                 return 'Package/file %s does not exist in %s' % (pkg, distro)
             return "No packages matching '%s' could be found" % pkg
-        pkgs = [x.split()[0] for x in data.split('\n') if x.split()]
         if len(pkgs) > 10:
             return "Found: %s (and %d others) http://packages.ubuntu.com/search?keywords=%s&searchon=names&suite=%s&section=all" % (', '.join(pkgs[:10]), len(pkgs)-10, urlquote(pkg), distro)
         else:
@@ -123,50 +275,15 @@ class Apt:
 
         pkg = _pkg
 
-        try:
-            data = apt_cache(self.aptdir, distro, ['show', pkg])
-        except subprocess.CalledProcessError as e:
-            data = e.output
-        try:
-            data2 = apt_cache(self.aptdir, distro, ['showsrc', pkg])
-        except subprocess.CalledProcessError as e:
-            data2 = e.output
-        if not data or 'E: No packages found' in data:
+        cache = self.get_cache(distro)
+        maxp = cache.show(pkg)
+        if maxp is None:
             return 'Package %s does not exist in %s' % (pkg, distro)
-        maxp = {'Version': '0~'}
-        packages = [x.strip() for x in data.split('\n\n')]
-        for p in packages:
-            if not p.strip():
-                continue
-            parser = FeedParser()
-            parser.feed(p)
-            p = parser.close()
-            if type(p) == type(""):
-                self.log.error("PackageInfo/packages: apt returned an error, do you have the deb-src URLs in %s.list?" % distro)
-                return "Package lookup faild"
-            if not p.get("Version", None):
-                continue
-            if apt.apt_pkg.version_compare(maxp['Version'], p['Version']) <= 0:
-                maxp = p
-            del parser
-        maxp2 = {'Version': '0~'}
-        packages2 = [x.strip() for x in data2.split('\n\n')]
-        for p in packages2:
-            if not p.strip():
-                continue
-            parser = FeedParser()
-            parser.feed(p)
-            p = parser.close()
-            if type(p) == type(""):
-                self.log.error("PackageInfo/packages: apt returned an error, do you have the deb-src URLs in %s.list?" % distro)
-                return "Package lookup faild"
-            if not p['Version']:
-                continue
-            if apt.apt_pkg.version_compare(maxp2['Version'], p['Version']) <= 0:
-                maxp2 = p
-            del parser
+        return self.add_source_info(maxp, cache.showsrc(pkg), distro)
+
+    def add_source_info(self, maxp, maxp2, distro):
         archs = ''
-        if 'Architecture' in maxp2:
+        if maxp2 and 'Architecture' in maxp2:
             archs = [_.strip() for _ in maxp2['Architecture'].split() if _.strip()]
             for arch in archs:
                 if arch not in ('any', 'all'):
@@ -182,20 +299,35 @@ class Apt:
         maxp["Architectures"] = archs
         return maxp
 
+    def batch_info(self, pkgs, distro):
+        """Returns the info() of each of the pkgs in distro, looked up in a
+        single pass over the cache."""
+        if distro not in self.distros:
+            return ["%r is not a valid distribution: %s" % (distro, ", ".join(self.distros))]
+        pkgs = [''.join([x for x in pkg.strip() if x.isalnum() or x in '.-_+']) for pkg in pkgs]
+        pkgs = [pkg for pkg in pkgs if pkg]
+        found = self.get_cache(distro).show_many(pkgs)
+        replies = []
+        for pkg in pkgs:
+            (maxp, maxp2) = found[pkg]
+            if maxp is None:
+                replies.append('Package %s does not exist in %s' % (pkg, distro))
+            else:
+                replies.append(format_info(self.add_source_info(maxp, maxp2, distro)))
+        return replies
+
     def info(self, pkg, chkdistro):
         maxp = self.raw_info(pkg, chkdistro)
         if isinstance(maxp, str):
             return maxp
-        return("%s (source: %s): %s. In component %s, is %s. Version %s (%s), package size %s kB, installed size %s kB%s" %
-               (maxp['Package'], maxp['Source'] or maxp['Package'], description(maxp), component(maxp['Section']),
-                maxp['Priority'], maxp['Version'], maxp["Distribution"], int(maxp['Size'])/1024, maxp['Installed-Size'], maxp["Architectures"]))
+        return format_info(maxp)
 
     def depends(self, pkg, chkdistro):
         maxp = self.raw_info(pkg, chkdistro)
         if isinstance(maxp, str):
             return maxp
         return("%s (version %s in %s) depends on: %s" %
-                (maxp['Package'], maxp["Version"], maxp["Distribution"], maxp["Depends"]))
+                (maxp['Package'], maxp["Version"], maxp["Distribution"], maxp.get("Depends")))
                        
 # Simple test
 if __name__ == "__main__":
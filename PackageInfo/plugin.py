@@ -41,7 +41,7 @@ def stripNick(nick):
     return nick
 
 class PackageInfo(callbacks.Plugin):
-    """Lookup package information via apt-cache/apt-file"""
+    """Lookup package information via python-apt/apt-file"""
     threaded = True
     space_re = re.compile(r'  *')
 
@@ -95,6 +95,21 @@ class PackageInfo(callbacks.Plugin):
         irc.reply(reply)
     info = wrap(real_info, ['anything', optional('text')])
 
+    def real_infos(self, irc, msg, args, packages, release):
+        """<package>[,<package> ...] [<release>]
+
+        Lookup information for up to 10 <package>s at once, optionally in
+        <release>
+        """
+        if len(packages) > 10:
+            irc.error("You can look up at most 10 packages at once.",
+                    Raise=True)
+        channel = self.__getChannel(msg.args[0])
+        release = self.__getRelease(irc, release, channel)
+        replies = self.Apt.batch_info(packages, release)
+        irc.replies(replies)
+    infos = wrap(real_infos, [commalist('anything'), optional('text')])
+
     def real_depends(self, irc, msg, args, package, release):
         """<package> [<release>]
 
@@ -134,6 +149,8 @@ class PackageInfo(callbacks.Plugin):
         (term, rest) = (rest.split(' ', 1) + [None])[:2]
         if cmd == "find":
             self.real_find(irc, msg, [], term, rest)
+        elif cmd == "infos":
+            self.real_infos(irc, msg, [], term.split(','), rest)
         else:
             self.real_info(irc, msg, [], term, rest)
 
@@ -152,6 +169,8 @@ class PackageInfo(callbacks.Plugin):
         (term, rest) = (rest.split(' ', 1) + [None])[:2]
         if cmd == "find":
             self.real_find(irc, msg, [], term, rest)
+        elif cmd == "infos":
+            self.real_infos(irc, msg, [], term.split(','), rest)
         else:
             self.real_info(irc, msg, [], term, rest)
 
@@ -13,6 +13,9 @@
 #
 ###
 
+import os
+import gzip
+
 from supybot.test import *
 
 class PackageInfoTestCase(PluginTestCase):
@@ -26,6 +29,39 @@ class PackageInfoTestCase(PluginTestCase):
         self.assertRegexp('info rjegegjierigj', 'does not exist')
         self.assertRegexp('find irssi', 'Found: .*irssi-dev')
         self.assertRegexp('depends supybot', 'python')
+        self.assertRegexp('infos rjegegjierigj,irssi', 'does not exist')
+        self.assertError('infos ' + ','.join(['irssi'] * 11))
+        self.assertRegexp(' ', r'irssi \(source: irssi\)')
+
+    def testFileIndex(self):
+        from PackageInfo import fileindex
+        dirname = os.path.join(conf.supybot.directories.data(), 'contents')
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        for (name, content) in (('main', b'bin/ls  utils/coreutils\n'
+                                         b'usr/share/doc/irssi/README  '
+                                         b'net/irssi,net/irssi-dev\n'),
+                                ('updates', b'usr/share/doc/irssi/README  '
+                                            b'net/irssi-scripts\n'
+                                            b'usr/lib/ls  utils/other\n')):
+            with gzip.open(os.path.join(dirname, 'Contents-i386-%s.gz' % name),
+                           'wb') as fd:
+                fd.write(content)
+        filename = os.path.join(conf.supybot.directories.data(), 'fileindex')
+        fileindex.build(dirname, filename)
+        index = fileindex.FileIndex(filename)
+        self.assertEqual(index.search('ls'), ['coreutils', 'other'])
+        self.assertEqual(index.search('/bin/ls'), ['coreutils'])
+        self.assertEqual(index.search('doc/irssi/README'),
+                         ['irssi', 'irssi-dev', 'irssi-scripts'])
+        self.assertEqual(index.search('s'), [])
+        index.close()
+        # Sorted by runs of one record, then merged
+        fileindex.build(dirname, filename, chunk_size=1)
+        index = fileindex.FileIndex(filename)
+        self.assertEqual(index.search('doc/irssi/README'),
+                         ['irssi', 'irssi-dev', 'irssi-scripts'])
+        index.close()
 
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -51,5 +51,51 @@ conf.registerChannelValue(WebLogs, 'enabled',
     registry.Boolean(False, _("""Determines whether the web logs for this
     channel are available.""")))
 
+conf.registerGlobalValue(WebLogs, 'maxWait',
+    registry.NonNegativeInteger(0, _("""Determines the maximum number of
+    seconds a client of the JSON feed can wait for new lines (with the
+    'wait' parameter). As the HTTP server of the bot answers one request at
+    a time, waiting clients delay the other requests, so this is disabled
+    (0) by default.""")))
+
+conf.registerGlobalValue(WebLogs, 'maxOpenFiles',
+    registry.PositiveInteger(100, _("""Determines the maximum number of log
+    files and search indexes kept open. The least recently used ones are
+    closed when there are more.""")))
+
+conf.registerGlobalValue(WebLogs, 'compress',
+    registry.Boolean(False, _("""Determines whether the logs of the previous
+    days are compressed (with gzip). This is checked every hour, and applies
+    to the existing logs of all channels, including the ones where logging
+    is disabled. Compressed logs can still be read by the plugin, but not
+    by older versions of it.""")))
+
+conf.registerGroup(WebLogs, 'search')
+conf.registerChannelValue(WebLogs.search, 'enabled',
+    registry.Boolean(False, _("""Determines whether the logs of this channel
+    are indexed, so they can be searched. The existing logs are indexed in
+    the background the first time a line is logged after this is enabled;
+    lines logged while this is disabled are not indexed.""")))
+conf.registerGlobalValue(WebLogs.search, 'results',
+    registry.PositiveInteger(20, _("""Determines the number of search
+    results per page on the web interface.""")))
+conf.registerGlobalValue(WebLogs.search, 'ircResults',
+    registry.PositiveInteger(5, _("""Determines the number of search
+    results per page returned by the 'search' command.""")))
+
+conf.registerGroup(WebLogs, 'buffer')
+conf.registerGlobalValue(WebLogs.buffer, 'size',
+    registry.NonNegativeInteger(4096, _("""Determines the number of bytes
+    of logs kept in memory for a channel before they are written to the
+    disk. If it is 0, every line is written immediately.""")))
+conf.registerGlobalValue(WebLogs.buffer, 'interval',
+    registry.PositiveInteger(10, _("""Determines how often (in seconds) the
+    logs kept in memory are written to the disk. Changes take effect when
+    the plugin is reloaded.""")))
+conf.registerGlobalValue(WebLogs.buffer, 'fsync',
+    registry.Boolean(False, _("""Determines whether the bot will ask the
+    operating system to write the logs to the disk itself each time they
+    are flushed. This is safer in case of a crash, but slower.""")))
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -31,13 +31,21 @@
 import re
 import os
 import sys
+import gzip
+import shutil
 import html
+import json
 import time
-import urllib
+import sqlite3
+import urllib.parse
+import itertools
+import threading
+import collections
 
 import supybot.conf as conf
 import supybot.utils as utils
 from supybot.commands import *
+import supybot.schedule as schedule
 import supybot.irclib as irclib
 import supybot.ircmsgs as ircmsgs
 import supybot.plugins as plugins
@@ -116,17 +124,27 @@ page_template = """
 # From http://stackoverflow.com/questions/1071191/detect-urls-in-a-string
 URL_REGEXP = re.compile(r'''((?:mailto:|ftp://|http://)[^ <>'"{}|\\^`[\]]*)''')
 
-def format_logs(logs):
+DAY_FILE_REGEXP = re.compile(r'^(\d{4}-\d{2}-\d{2})\.log(?:\.gz)?$')
+CURSOR_REGEXP = re.compile(r'^(\d{4}-\d{2}-\d{2}):(\d+)$')
+
+def get_day(timestamp):
+    """Returns the (UTC) day of the timestamp, as used in the file names and
+    in the URLs."""
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+def format_logs(lines):
+    """Returns an iterator over the HTML chunks of the given log lines, so
+    pages can be sent while they are rendered."""
     def format_nick(nick):
         template = '<span style="color: %(color)s;">%(nick)s</span>'
         colors = ['red', 'orange', 'blue', 'lime', 'grey', 'green', 'purple',
                 'black', 'olive']
         hash_ = sum([ord(x) for x in nick]) % len(colors)
         return template % {'color': colors[hash_], 'nick': nick}
-    html_logs = '<div>' # Will be closed by the first "Changed day"
+    yield '<div>' # Will be closed by the first "Changed day"
     old_gmtime_day = None
-    for line in logs.split('\n'):
-        words = line.split(' ')
+    for line in lines:
+        words = line.rstrip('\n').split(' ')
         if len(words) < 2:
             continue
         timestamp = words[0]
@@ -178,55 +196,711 @@ def format_logs(logs):
             gmtime = time.gmtime(int(words[0]))
             gmtime_day = (gmtime.tm_year, gmtime.tm_mon, gmtime.tm_mday)
             if old_gmtime_day != gmtime_day:
-                html_logs += '</div><div class="day">'
-                html_logs += """
+                yield '</div><div class="day">'
+                yield """
                     <input type="button" value="reveal" class="reveal" />
                     <input type="button" value="hide" class="hide" />
                     """
-                html_logs += '<h1>%i-%i-%i</h1>' % \
+                yield '<h1>%i-%i-%i</h1>' % \
                         gmtime_day
                 old_gmtime_day = gmtime_day
             timestamp = time.strftime('%H:%M:%S', gmtime)
 
 
-            html_logs += template % {'line': new_line,
+            yield template % {'line': new_line,
                     'timestamp': timestamp, 'command': command}
-    return html_logs
+    yield '</div>'
+
+def parse_line(line):
+    """Returns a dict describing the log line, or None if it is not a valid
+    line."""
+    words = line.rstrip('\n').split(' ')
+    if len(words) < 3:
+        return None
+    try:
+        timestamp = int(words[0])
+    except ValueError:
+        return None
+    command = words[1]
+    record = {'timestamp': timestamp, 'command': command, 'nick': words[2]}
+    if command in ('PRIVMSG', 'NOTICE', 'PRIVMSG-ACTION'):
+        record['message'] = ' '.join(words[3:])
+    elif command in ('PART', 'QUIT'):
+        record['reason'] = ' '.join(words[3:])
+    elif command == 'MODE':
+        record['modes'] = ' '.join(words[3:])
+    elif command == 'KICK':
+        record['kicked'] = words[3]
+        record['reason'] = ' '.join(words[4:])
+    return record
+
+def format_json(records):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+def format_record(record):
+    """Returns a one-line text version of a parsed line with a message."""
+    if record['command'] == 'PRIVMSG-ACTION':
+        template = _('[%(time)s] * %(nick)s %(message)s')
+    elif record['command'] == 'NOTICE':
+        template = _('[%(time)s] -%(nick)s- %(message)s')
+    else:
+        template = _('[%(time)s] <%(nick)s> %(message)s')
+    return template % {'nick': record['nick'], 'message': record['message'],
+            'time': time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.gmtime(record['timestamp']))}
+
+def format_search_results(channel, query, page, records, has_next):
+    quoted_channel = utils.web.urlquote(channel)
+    yield '<form action="./"><input type="text" name="q" value="%s" />' \
+            '<input type="submit" value="%s" /></form><ul>' % \
+            (html.escape(query), _('Search'))
+    for record in records:
+        day = get_day(record['timestamp'])
+        yield '<li><a href="../../html/%s/%s">%s</a></li>' % (quoted_channel,
+                day, URL_REGEXP.sub(r'<a href="\1">\1</a>',
+                                    html.escape(format_record(record))))
+    yield '</ul><p>'
+    links = []
+    for (label, other_page) in ((_('Previous'), page - 1),
+                                (_('Next'), page + 1)):
+        if other_page < 1 or (other_page > page and not has_next):
+            continue
+        links.append('<a href="./?%s">%s</a>' % (urllib.parse.urlencode(
+            {'q': query, 'page': other_page}), label))
+    yield ' | '.join(links)
+    yield '</p>'
+
+def format_days(days):
+    yield '<ul>'
+    for day in reversed(days):
+        yield '<li><a href="./%s">%s</a></li>' % (day, day)
+    yield '</ul>'
+
+def format_navigation(days, day):
+    index = days.index(day)
+    links = ['<a href="./">%s</a>' % _('All days')]
+    if index > 0:
+        links.insert(0, '<a href="./%s">&larr; %s</a>' %
+                (days[index-1], days[index-1]))
+    if index < len(days) - 1:
+        links.append('<a href="./%s">%s &rarr;</a>' %
+                (days[index+1], days[index+1]))
+    return '<p>%s</p>' % ' | '.join(links)
+
+
+class _PooledHandle(object):
+    """A handle of the HandlePool, with the number of threads using it."""
+    def __init__(self, handle):
+        self.handle = handle
+        self.users = 0
+        self.evicted = False
+
+class HandlePool(object):
+    """Keeps at most supybot.plugins.WebLogs.maxOpenFiles log files and
+    search indexes open, closing the least recently used ones. They are
+    reopened the next time they are needed.
+
+    The lock only protects the bookkeeping: handles are opened and used
+    without it, and an evicted handle is only closed once the last thread
+    using it is done with it."""
+    def __init__(self):
+        self._handles = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._handles)
+
+    def use(self, key, opener, f):
+        """Returns f(handle), opening the handle with opener() if it is not
+        open. The handle must not be used after f returns, as it may be
+        closed at any time."""
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None:
+                self._handles.move_to_end(key)
+                entry.users += 1
+                self.hits += 1
+        if entry is None:
+            handle = opener()
+            with self._lock:
+                self.misses += 1
+                entry = self._handles.get(key)
+                if entry is None:
+                    entry = _PooledHandle(handle)
+                    self._handles[key] = entry
+                    handle = None
+                else:
+                    # Opened by another thread meanwhile
+                    self._handles.move_to_end(key)
+                entry.users += 1
+                to_close = self._evict_old()
+            if handle is not None:
+                to_close.append(handle)
+            for old_handle in to_close:
+                old_handle.close()
+        try:
+            return f(entry.handle)
+        finally:
+            self._release(entry)
+
+    def _evict_old(self):
+        """Removes the least recently used handles from the pool, and returns
+        the ones nobody uses. Must be called with the lock."""
+        max_handles = WebLogsMiddleware._plugin.registryValue('maxOpenFiles')
+        to_close = []
+        while len(self._handles) > max_handles:
+            (old_key, old_entry) = self._handles.popitem(last=False)
+            self.evictions += 1
+            old_entry.evicted = True
+            if not old_entry.users:
+                to_close.append(old_entry.handle)
+        return to_close
+
+    def _release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            close = entry.evicted and not entry.users
+        if close:
+            entry.handle.close()
+
+    def evict(self, key):
+        """Removes the handle of key from the pool, closing it as soon as it
+        is not used anymore."""
+        with self._lock:
+            entry = self._handles.pop(key, None)
+            if entry is None:
+                return
+            entry.evicted = True
+            close = not entry.users
+        if close:
+            entry.handle.close()
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._handles.values())
+            self._handles.clear()
+            to_close = []
+            for entry in entries:
+                entry.evicted = True
+                if not entry.users:
+                    to_close.append(entry.handle)
+        for handle in to_close:
+            handle.close()
+
+handle_pool = HandlePool()
 
 
 class WebLogsMiddleware(object):
-    """Class for reading and parsing WebLogs data."""
+    """Class for reading and parsing WebLogs data.
+
+    Logs of a channel are stored in one file per (UTC) day, in the
+    WebLogs_<channel> directory."""
     __shared_states = {}
+    # The compression thread creates middlewares too.
+    __shared_states_lock = threading.Lock()
     def __init__(self, channel):
+        with self.__shared_states_lock:
+            self._init(channel)
+
+    def _init(self, channel):
         if channel in self.__shared_states:
             self.__dict__ = self.__shared_states[channel]
         else:
             self._channel = channel
-            path = conf.supybot.directories.data.dirize('WebLogs_%s.log' %
-                    channel)
-            self.fd = open(path, 'a+')
+            self._dir = conf.supybot.directories.data.dirize(
+                    'WebLogs_%s' % channel)
+            self._day = None
+            self._buffer = []
+            self._buffer_size = 0
+            self._lock = threading.Lock()
+            self._new_lines = threading.Condition(self._lock)
+            self._line_count = 0
+            self._index_failed = False
+            self._index_buffer = []
+            self._index_thread = None
+            # Lines flushed while the log file of older versions is split,
+            # as (day, data)
+            self._pending = []
+            self._migrating = os.path.isfile(self._dir + '.log')
+            self._migration_failed = False
+            self._migration_thread = None
             self.__shared_states.update({channel: self.__dict__})
+            if self._migrating:
+                # Split in the background, so a large file doesn't stall
+                # the logging of every channel.
+                self._migration_thread = threading.Thread(
+                        target=self._migrate,
+                        name='WebLogs migration of %s' % channel,
+                        daemon=True)
+                self._migration_thread.start()
+            elif not os.path.isdir(self._dir):
+                os.makedirs(self._dir)
 
     @classmethod
     def get_channel_list(cls):
-        channels = [x[len('WebLogs_'):-len('.log')]
-                for x in os.listdir(conf.supybot.directories.data())
-                if x.endswith('.log')]
-        return [x for x in channels
+        return [x for x in cls._list_channels()
                 if cls._plugin.registryValue('enabled', x)]
 
-    def get_logs(self):
-        self.fd.seek(0)
-        return self.fd.read()
+    @classmethod
+    def _list_channels(cls):
+        """Returns the channels with logs, including the disabled ones."""
+        channels = set()
+        for x in os.listdir(conf.supybot.directories.data()):
+            if not x.startswith('WebLogs_') or x.endswith('.migrating'):
+                continue
+            elif x.endswith('.log'):
+                # Not migrated yet
+                channels.add(x[len('WebLogs_'):-len('.log')])
+            elif os.path.isdir(conf.supybot.directories.data.dirize(x)):
+                channels.add(x[len('WebLogs_'):])
+        return channels
+
+    @classmethod
+    def flush_all(cls):
+        for channel in list(cls.__shared_states):
+            cls(channel).flush()
+
+    @classmethod
+    def close_all(cls):
+        for channel in list(cls.__shared_states):
+            middleware = cls(channel)
+            middleware.flush()
+            with cls.__shared_states_lock:
+                cls.__shared_states.pop(channel, None)
+        handle_pool.close_all()
+
+    def _migrate(self):
+        """Splits the log file used by older versions of the plugin in one
+        file per day. The files are written in a temporary directory, which
+        replaces the directory of the channel once they are complete, so an
+        interrupted migration is started over. Lines logged meanwhile are
+        written afterwards."""
+        path = self._dir + '.log'
+        tmp_dir = self._dir + '.migrating'
+        try:
+            # Otherwise, it was interrupted after the directory was renamed.
+            if not os.path.isdir(self._dir):
+                if os.path.isdir(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+                os.makedirs(tmp_dir)
+                self._split_log(path, tmp_dir)
+                os.rename(tmp_dir, self._dir)
+            os.rename(path, path + '.migrated')
+        except Exception:
+            self._plugin.log.exception('WebLogs: cannot migrate the logs of '
+                    '%s, they are still written to %s:', self._channel, path)
+            with self._lock:
+                # Lines logged meanwhile are kept with the old ones, and
+                # migrated when the plugin is loaded again.
+                self._migration_failed = True
+                self._migrating = False
+                self._flush_pending()
+            return
+        with self._lock:
+            self._migrating = False
+            self._flush_pending()
+
+    @staticmethod
+    def _split_log(path, directory):
+        # Lines are sorted, so only one day file is open at a time.
+        (day_fd, day) = (None, None)
+        try:
+            with open(path, 'rb') as fd:
+                for line in fd:
+                    try:
+                        line_day = get_day(int(line.split(b' ', 1)[0]))
+                    except ValueError:
+                        continue
+                    if line_day != day:
+                        if day_fd is not None:
+                            day_fd.close()
+                        day = line_day
+                        day_fd = open(os.path.join(directory,
+                                                   '%s.log' % day), 'ab')
+                    day_fd.write(line)
+        finally:
+            if day_fd is not None:
+                day_fd.close()
+
+    def _wait_migration(self):
+        """Waits until the log file of older versions is split."""
+        thread = self._migration_thread
+        if thread is not None:
+            thread.join()
+
+    def _flush_pending(self):
+        """Writes the lines flushed during the migration. The lock must be
+        held."""
+        pending = self._pending
+        self._pending = []
+        for (day, data) in pending:
+            self._write_day(day, data)
+        self._flush_index()
+
+    def _get_path(self, day):
+        return os.path.join(self._dir, '%s.log' % day)
+
+    def get_days(self):
+        """Returns the sorted list of the days with logs."""
+        self._wait_migration()
+        self.flush()
+        return self._list_days()
+
+    def _list_days(self):
+        days = set()
+        if not os.path.isdir(self._dir):
+            # The migration failed
+            return []
+        for x in os.listdir(self._dir):
+            match = DAY_FILE_REGEXP.match(x)
+            if match:
+                days.add(match.group(1))
+        return sorted(days)
+
+    def _open_day(self, day):
+        """Opens the file of this day for reading, decompressing it if it
+        was archived."""
+        path = self._get_path(day)
+        try:
+            return open(path, encoding='utf8', errors='replace')
+        except FileNotFoundError:
+            return gzip.open(path + '.gz', 'rt', encoding='utf8',
+                             errors='replace')
+
+    def get_lines(self, day):
+        """Returns an iterator over the lines logged on this day."""
+        self._wait_migration()
+        if day == self._day:
+            self.flush()
+        with self._open_day(day) as fd:
+            for line in fd:
+                yield line
+
+    @classmethod
+    def compress_all(cls):
+        # Disabled channels have old logs too.
+        for channel in cls._list_channels():
+            cls(channel).compress()
+
+    def compress(self):
+        """Compresses the files of the days before the current one."""
+        self._wait_migration()
+        today = get_day(time.time())
+        for day in self._list_days():
+            path = self._get_path(day)
+            if day >= today or not os.path.isfile(path):
+                continue
+            with self._lock:
+                # The buffer is flushed before the day changes, so nothing
+                # will be written to the file of a previous day.
+                if day == self._day:
+                    continue
+            with open(path, 'rb') as fd:
+                with gzip.open(path + '.gz.tmp', 'wb') as gzip_fd:
+                    shutil.copyfileobj(fd, gzip_fd)
+            os.rename(path + '.gz.tmp', path + '.gz')
+            handle_pool.evict(path)
+            os.unlink(path)
+
+    def get_records(self, since=0, cursor=None):
+        """Returns an iterator over the parsed lines logged after the since
+        timestamp, or after the cursor if it is given. A cursor is a (day,
+        number of lines) tuple, and each record has the 'cursor' to resume
+        after it, as a 'day:number' string."""
+        if cursor is None:
+            (first_day, skipped) = (get_day(since), 0)
+        else:
+            (first_day, skipped) = cursor
+            since = -1
+        for day in self.get_days():
+            if day < first_day:
+                continue
+            for (number, line) in enumerate(self.get_lines(day), 1):
+                if day == first_day and number <= skipped:
+                    continue
+                record = parse_line(line)
+                if record is not None and record['timestamp'] > since:
+                    record['cursor'] = '%s:%i' % (day, number)
+                    yield record
+
+    def get_line_count(self):
+        """Returns the number of lines logged since the plugin was loaded,
+        to be given to wait_lines."""
+        with self._lock:
+            return self._line_count
+
+    def wait_lines(self, line_count, timeout):
+        """Waits until a line is logged after the first line_count ones, or
+        until the timeout expires."""
+        with self._new_lines:
+            self._new_lines.wait_for(lambda: self._line_count > line_count,
+                                     timeout)
 
     def write(self, *args):
-        self.fd.read()
-        self.fd.write(s('%i %s\n' % (time.time(), ' '.join(args))))
+        now = time.time()
+        line = b('%i %s\n' % (now, ' '.join(args)))
+        day = get_day(now)
+        with self._lock:
+            if day != self._day:
+                self._flush()
+                self._day = day
+            self._buffer.append(line)
+            self._buffer_size += len(line)
+            if self._plugin.registryValue('search.enabled', self._channel):
+                record = parse_line(s(line))
+                if record and 'message' in record:
+                    self._index_buffer.append((record['timestamp'],
+                        record['command'], record['nick'], record['message']))
+            if self._buffer_size >= self._plugin.registryValue('buffer.size'):
+                self._flush()
+            self._line_count += 1
+            self._new_lines.notify_all()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffer_size = 0
+        if self._migrating:
+            # Written when the migration is done
+            self._pending.append((self._day, data))
+            return
+        self._write_day(self._day, data)
+        self._flush_index()
+
+    def _write_day(self, day, data):
+        fsync = self._plugin.registryValue('buffer.fsync')
+        def write(fd):
+            fd.write(data)
+            if fsync:
+                os.fsync(fd.fileno())
+        if self._migration_failed:
+            # Lines are added to the old log file instead.
+            path = self._dir + '.log'
+        else:
+            path = self._get_path(day)
+        # Lines are only appended, so readers can open the files whenever
+        # they want.
+        handle_pool.use(path, lambda: open(path, 'ab', buffering=0), write)
+
+    def _flush_index(self):
+        if self._migration_failed:
+            # There are no day files to index.
+            self._index_buffer = []
+        if self._index_buffer and not self._index_failed:
+            path = self._get_index_path()
+            if self.is_indexing():
+                # Indexed by the thread building the index, when it is done.
+                return
+            elif os.path.isfile(path):
+                try:
+                    handle_pool.use(path, lambda: sqlite3.connect(path,
+                                        check_same_thread=False),
+                                    self._index_lines)
+                except sqlite3.Error as e:
+                    self._plugin.log.error('WebLogs: cannot update the '
+                            'search index of %s: %s', self._channel, e)
+            else:
+                # Must be done after the lines are written, as the new index
+                # is filled from the files.
+                self._start_index_build()
+        self._index_buffer = []
+
+    def _index_lines(self, index):
+        index.executemany('INSERT INTO lines VALUES (?, ?, ?, ?)',
+                          self._index_buffer)
+        index.commit()
+
+    def _get_index_path(self):
+        return os.path.join(self._dir, 'search.db')
+
+    def is_indexing(self):
+        """Returns whether the search index is being built."""
+        return self._index_thread is not None and \
+                self._index_thread.is_alive()
+
+    def _start_index_build(self):
+        """Starts building the search index from the log files, in a new
+        thread. The lock must be held."""
+        # Only the lines written so far are read, the other ones are added
+        # from the index buffer at the end.
+        sizes = []
+        for day in self._list_days():
+            path = self._get_path(day)
+            sizes.append((day, os.path.getsize(path)
+                               if os.path.isfile(path) else None))
+        self._index_thread = threading.Thread(target=self._build_index,
+                args=(sizes,), name='WebLogs index of %s' % self._channel,
+                daemon=True)
+        self._index_thread.start()
+
+    def _build_index(self, sizes):
+        """Writes the search index in a temporary file, which replaces the
+        index once it is complete, so a failed build is retried later."""
+        path = self._get_index_path()
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        index = sqlite3.connect(tmp_path, check_same_thread=False)
+        try:
+            index.execute('CREATE VIRTUAL TABLE lines USING '
+                    'fts5(timestamp UNINDEXED, command UNINDEXED, nick, '
+                    'message)')
+            for (day, size) in sizes:
+                index.executemany('INSERT INTO lines VALUES (?, ?, ?, ?)',
+                        [(x['timestamp'], x['command'], x['nick'],
+                          x['message'])
+                         for x in map(parse_line, self._read_day(day, size))
+                         if x and 'message' in x])
+            index.commit()
+            with self._lock:
+                self._index_lines(index)
+                self._index_buffer = []
+                index.execute('PRAGMA journal_mode=WAL')
+                index.close()
+                os.rename(tmp_path, path)
+        except Exception as e:
+            index.close()
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            if isinstance(e, sqlite3.OperationalError):
+                self._plugin.log.error('WebLogs: cannot create the search '
+                        'index of %s (is FTS5 available?): %s',
+                        self._channel, e)
+                self._index_failed = True
+            else:
+                self._plugin.log.exception('WebLogs: cannot create the '
+                        'search index of %s:', self._channel)
+
+    def _read_day(self, day, size=None):
+        """Returns the lines of this day, only reading the first size bytes
+        if size is not None."""
+        path = self._get_path(day)
+        try:
+            fd = open(path, 'rb')
+        except FileNotFoundError:
+            fd = gzip.open(path + '.gz', 'rb')
+        with fd:
+            data = fd.read(-1 if size is None else size)
+        return data.decode('utf8', 'replace').splitlines(True)
+
+    def search(self, query, limit, offset=0):
+        """Returns the parsed lines matching all the words of the query,
+        best matches first."""
+        self.flush()
+        path = self._get_index_path()
+        if not os.path.isfile(path):
+            return []
+        query = ' '.join('"%s"' % word.replace('"', '""')
+                         for word in query.split())
+        if not query:
+            return []
+        connection = sqlite3.connect(path)
+        try:
+            cursor = connection.execute('SELECT timestamp, command, nick, '
+                    'message FROM lines WHERE lines MATCH ? ORDER BY rank '
+                    'LIMIT ? OFFSET ?', (query, limit, offset))
+            return [{'timestamp': int(timestamp), 'command': command,
+                     'nick': nick, 'message': message}
+                    for (timestamp, command, nick, message) in cursor]
+        finally:
+            connection.close()
 
 class WebLogsServerCallback(httpserver.SupyHTTPServerCallback):
     name = 'WebLogs'
 
+    def write_chunks(self, chunks):
+        """Sends the chunks while they are rendered, in blocks of about
+        64kB."""
+        buffer_ = []
+        size = 0
+        for chunk in chunks:
+            buffer_.append(chunk)
+            size += len(chunk)
+            if size >= 65536:
+                self.wfile.write(b(''.join(buffer_)))
+                buffer_ = []
+                size = 0
+        if buffer_:
+            self.wfile.write(b(''.join(buffer_)))
+
+    def write_page(self, title, chunks):
+        (head, foot) = page_template.split('%(body)s')
+        self.write_chunks(itertools.chain(
+            [head % {'title': html.escape(title)}], chunks, [foot]))
+
+    def write_feed(self, middleware, query):
+        """Sends the lines logged after the 'since' timestamp, or after the
+        'cursor' of a previous line, as newline-delimited JSON. If there is
+        none and 'wait' is given, waits up to this number of seconds for new
+        lines."""
+        try:
+            since = int(query.get('since', ['0'])[0])
+            get_day(since) # Checks the timestamp is in range
+            cursor = None
+            if 'cursor' in query:
+                match = CURSOR_REGEXP.match(query['cursor'][0])
+                if match is None:
+                    raise ValueError('Invalid cursor')
+                cursor = (match.group(1), int(match.group(2)))
+            wait = min(float(query.get('wait', ['0'])[0]),
+                       WebLogsMiddleware._plugin.registryValue('maxWait'))
+        except (ValueError, OverflowError, OSError):
+            self.send_response(400)
+            self.send_header('Content-type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(b('Bad parameters.'))
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson; charset=utf-8')
+        self.end_headers()
+        line_count = middleware.get_line_count()
+        records = middleware.get_records(since, cursor)
+        first_record = next(records, None)
+        if first_record is None and wait > 0:
+            middleware.wait_lines(line_count, wait)
+            records = middleware.get_records(since, cursor)
+            first_record = next(records, None)
+        if first_record is not None:
+            self.write_chunks(format_json(
+                itertools.chain([first_record], records)))
+
+    def write_search(self, channel, middleware, query):
+        try:
+            page = int(query.get('page', ['1'])[0])
+        except ValueError:
+            page = 0
+        if page < 1:
+            self.send_response(400)
+            self.send_header('Content-type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(b('Bad parameters.'))
+            return
+        text = query.get('q', [''])[0]
+        limit = WebLogsMiddleware._plugin.registryValue('search.results')
+        # Get one more result, to know whether there is a next page
+        records = middleware.search(text, limit + 1, (page - 1) * limit)
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.end_headers()
+        self.write_page(_('Search in %s') % channel, format_search_results(
+            channel, text, page, records[0:limit], len(records) > limit))
+
     def doGet(self, handler, path):
+        if '?' in path:
+            (path, query) = path.split('?', 1)
+        else:
+            query = ''
+        query = urllib.parse.parse_qs(query)
         if path == '':
             self.send_response(301)
             self.send_header('Location', '/weblogs/')
@@ -256,7 +930,12 @@ class WebLogsServerCallback(httpserver.SupyHTTPServerCallback):
             self.end_headers()
             self.wfile.write(b('Bad URL.'))
             return
-        assert mode in ('html', 'json')
+        if mode not in ('html', 'json', 'search'):
+            self.send_response(404)
+            self.send_header('Content-type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(b('Bad URL.'))
+            return
         channel = utils.web.urlunquote(channel)
         if channel not in WebLogsMiddleware.get_channel_list():
             self.send_response(404)
@@ -266,13 +945,40 @@ class WebLogsServerCallback(httpserver.SupyHTTPServerCallback):
             return
 
         middleware = WebLogsMiddleware(channel)
-        if page == '':
+        days = middleware.get_days()
+        if mode == 'json' and page == '':
+            self.write_feed(middleware, query)
+        elif mode == 'search' and page == '' and \
+                WebLogsMiddleware._plugin.registryValue('search.enabled',
+                                                        channel):
+            self.write_search(channel, middleware, query)
+        elif mode in ('json', 'search'):
+            self.send_response(404)
+            self.send_header('Content-type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(b('Bad URL.'))
+        elif page == '':
             self.send_response(200)
             self.send_header('Content-type', 'text/html; charset=utf-8')
             self.end_headers()
-            self.wfile.write(b(page_template % {
-                'title': channel,
-                'body': format_logs(middleware.get_logs())}))
+            self.write_page(channel, itertools.chain(
+                ['<form action="../../search/%s/"><input type="text" '
+                 'name="q" /><input type="submit" value="%s" /></form>' %
+                 (utils.web.urlquote(channel), _('Search'))],
+                format_days(days)))
+        elif page in days:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/html; charset=utf-8')
+            self.end_headers()
+            navigation = format_navigation(days, page)
+            chunks = itertools.chain([navigation],
+                    format_logs(middleware.get_lines(page)), [navigation])
+            self.write_page('%s %s' % (channel, page), chunks)
+        else:
+            self.send_response(404)
+            self.send_header('Content-type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(b('There are no logs for this day.'))
 
 def check_enabled(f):
     def newf(self, irc, msg):
@@ -293,8 +999,12 @@ class WebLogs(callbacks.Plugin):
         self.__parent = super(WebLogs, self)
         callbacks.Plugin.__init__(self, irc)
 
-        self.lastStates = {}
         WebLogsMiddleware._plugin = self
+        schedule.addPeriodicEvent(WebLogsMiddleware.flush_all,
+                                  self.registryValue('buffer.interval'),
+                                  name='WebLogs_flush', now=False)
+        schedule.addPeriodicEvent(self._compress, 3600,
+                                  name='WebLogs_compress', now=False)
 
         # registering the callback
         callback = WebLogsServerCallback() # create an instance of the callback
@@ -340,27 +1050,91 @@ class WebLogs(callbacks.Plugin):
     def doKick(self, irc, msg, middleware):
         middleware.write('KICK', msg.nick, ' '.join(msg.args[1:]))
 
-    def __call__(self, irc, msg):
-        self.__parent.__call__(irc, msg)
-        self.lastStates[irc] = irc.state.copy()
+    _compress_lock = threading.Lock()
+    def _compress(self):
+        """Compresses the logs of the previous days in a new thread, unless
+        the previous compression is not finished yet."""
+        if not self.registryValue('compress'):
+            return
+        def compress():
+            if not self._compress_lock.acquire(False):
+                return
+            try:
+                WebLogsMiddleware.compress_all()
+            finally:
+                self._compress_lock.release()
+        thread = threading.Thread(target=compress, name='WebLogs compression')
+        thread.daemon = True
+        thread.start()
+
     def doQuit(self, irc, msg):
         if len(msg.args) == 0:
             reason = ''
         else:
             reason = msg.args[0]
 
-        if not isinstance(irc, irclib.Irc):
-            irc = irc.getRealIrc()
-        for (channel, chan) in self.lastStates[irc].channels.items():
-            if msg.nick in chan.users:
-                if self.registryValue('enabled', channel):
-                    middleware = WebLogsMiddleware(channel)
-                    middleware.write('QUIT', msg.nick, reason)
+        # The IrcState has already forgotten the nick, but tagged the message
+        # with the channels it was in.
+        for channel in msg.tagged('channels') or ():
+            if self.registryValue('enabled', channel):
+                middleware = WebLogsMiddleware(channel)
+                middleware.write('QUIT', msg.nick, reason)
+
+    @internationalizeDocstring
+    def search(self, irc, msg, args, channel, optlist, text):
+        """[<channel>] [--page <number>] <words>
+
+        Returns the lines logged in the <channel> containing all the <words>,
+        best matches first. <channel> is only necessary if the message isn't
+        sent in the channel itself."""
+        if not self.registryValue('enabled', channel) or \
+                not self.registryValue('search.enabled', channel):
+            irc.error(_('The logs of this channel cannot be searched.'),
+                      Raise=True)
+        page = dict(optlist).get('page', 1)
+        limit = self.registryValue('search.ircResults')
+        middleware = WebLogsMiddleware(channel)
+        records = middleware.search(text, limit, (page - 1) * limit)
+        if not records and middleware.is_indexing():
+            irc.reply(_('The logs of this channel are being indexed, please '
+                        'try again later.'))
+            return
+        if not records:
+            irc.reply(_('No matching line.'))
+            return
+        irc.reply(' | '.join(map(format_record, records)))
+    search = wrap(search, ['channel', getopts({'page': 'positiveInt'}),
+                           'text'])
+
+    @internationalizeDocstring
+    def handles(self, irc, msg, args):
+        """takes no arguments
+
+        Returns the number of log files and search indexes kept open, and
+        how often they were already open when they were needed."""
+        total = handle_pool.hits + handle_pool.misses
+        if total:
+            hit_rate = 100. * handle_pool.hits / total
+        else:
+            hit_rate = 0.
+        irc.reply(_('%i open files (at most %i), %.1f%% hit rate (%i hits, '
+                    '%i misses), %i evictions.') %
+                  (len(handle_pool), self.registryValue('maxOpenFiles'),
+                   hit_rate, handle_pool.hits, handle_pool.misses,
+                   handle_pool.evictions))
+    handles = wrap(handles)
 
     def die(self):
         # unregister the callback
         httpserver.unhook('weblogs')
 
+        for name in ('WebLogs_flush', 'WebLogs_compress'):
+            try:
+                schedule.removeEvent(name)
+            except KeyError:
+                pass
+        WebLogsMiddleware.close_all()
+
         # Stuff for Supybot
         self.__parent.die()
 
@@ -28,10 +28,211 @@
 
 ###
 
+import json
+
 from supybot.test import *
 
-class WebLogsTestCase(PluginTestCase):
+class WebLogsTestCase(HTTPPluginTestCase):
     plugins = ('WebLogs',)
 
+    def getMiddleware(self, channel):
+        cb = self.irc.getCallback('WebLogs')
+        return sys.modules[cb.__module__].WebLogsMiddleware(channel)
+
+    def testQuit(self):
+        with conf.supybot.plugins.WebLogs.enabled.context(True):
+            self.irc.feedMsg(ircmsgs.join('#foo', prefix='bar!baz@qux'))
+            self.irc.feedMsg(ircmsgs.nick('quux', prefix='bar!baz@qux'))
+            self.irc.feedMsg(ircmsgs.quit('bye', prefix='quux!baz@qux'))
+            self.irc.feedMsg(ircmsgs.quit('bye', prefix='quux!baz@qux'))
+        middleware = self.getMiddleware('#foo')
+        (day,) = middleware.get_days()
+        lines = [line.split(' ', 1)[1] for line in middleware.get_lines(day)]
+        self.assertEqual(lines, ['JOIN bar\n', 'QUIT quux bye\n'])
+
+    def testBuffer(self):
+        day = time.strftime('%Y-%m-%d', time.gmtime())
+        path = os.path.join(conf.supybot.directories.data.dirize('WebLogs_#bar'),
+                            '%s.log' % day)
+        with conf.supybot.plugins.WebLogs.enabled.context(True):
+            with conf.supybot.plugins.WebLogs.buffer.size.context(1000):
+                self.irc.feedMsg(ircmsgs.join('#bar', prefix='bar!baz@qux'))
+                self.assertFalse(os.path.exists(path))
+                self.getMiddleware('#bar').flush_all()
+                with open(path) as fd:
+                    self.assertTrue(fd.read().endswith(' JOIN bar\n'))
+            with conf.supybot.plugins.WebLogs.buffer.size.context(0):
+                self.irc.feedMsg(ircmsgs.part('#bar', prefix='bar!baz@qux'))
+                with open(path) as fd:
+                    self.assertTrue(fd.read().endswith(' PART bar \n'))
+
+    def testMigrate(self):
+        path = conf.supybot.directories.data.dirize('WebLogs_#migrated.log')
+        with open(path, 'w') as fd:
+            fd.write('86400 JOIN foo\n86401 PRIVMSG foo hi\n'
+                     '172800 PART foo bye\n')
+        middleware = self.getMiddleware('#migrated')
+        self.assertEqual(middleware.get_days(), ['1970-01-02', '1970-01-03'])
+        self.assertEqual(list(middleware.get_lines('1970-01-03')),
+                         ['172800 PART foo bye\n'])
+        self.assertFalse(os.path.exists(path))
+
+    def testMigrateInterrupted(self):
+        path = conf.supybot.directories.data.dirize('WebLogs_#interrupted.log')
+        with open(path, 'w') as fd:
+            fd.write('86400 JOIN foo\n86401 PRIVMSG foo hi\n')
+        # Left by a migration that was interrupted
+        os.makedirs(path[:-len('.log')] + '.migrating')
+        with open(os.path.join(path[:-len('.log')] + '.migrating',
+                               '1970-01-02.log'), 'w') as fd:
+            fd.write('86400 JOIN foo\n')
+        middleware = self.getMiddleware('#interrupted')
+        self.assertEqual(list(middleware.get_lines('1970-01-02')),
+                         ['86400 JOIN foo\n', '86401 PRIVMSG foo hi\n'])
+        self.assertFalse(os.path.exists(path[:-len('.log')] + '.migrating'))
+
+    def testCompress(self):
+        path = conf.supybot.directories.data.dirize('WebLogs_#compress.log')
+        with open(path, 'w') as fd:
+            fd.write('86400 PRIVMSG foo hi\n172800 PART foo bye\n')
+        middleware = self.getMiddleware('#compress')
+        # Logging is disabled in #compress, its logs are compressed anyway.
+        middleware.compress_all()
+        directory = conf.supybot.directories.data.dirize('WebLogs_#compress')
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['1970-01-02.log.gz', '1970-01-03.log.gz'])
+        self.assertEqual(middleware.get_days(), ['1970-01-02', '1970-01-03'])
+        self.assertEqual(list(middleware.get_lines('1970-01-02')),
+                         ['86400 PRIVMSG foo hi\n'])
+        with conf.supybot.plugins.WebLogs.enabled.context(True):
+            (respCode, body) = self.request(
+                    '/weblogs/html/%23compress/1970-01-03')
+            self.assertEqual(respCode, 200)
+            self.assertIn(b'has left the channel (bye)', body)
+
+    def testHtml(self):
+        with conf.supybot.plugins.WebLogs.enabled.context(True):
+            self.irc.feedMsg(ircmsgs.privmsg('#baz', 'hello <world>',
+                                             prefix='bar!baz@qux'))
+            day = time.strftime('%Y-%m-%d', time.gmtime())
+            (respCode, body) = self.request('/weblogs/html/%23baz/')
+            self.assertEqual(respCode, 200)
+            self.assertIn(('<a href="./%s">' % day).encode(), body)
+            (respCode, body) = self.request('/weblogs/html/%%23baz/%s' % day)
+            self.assertEqual(respCode, 200)
+            self.assertIn(b'hello &lt;world&gt;', body)
+            (respCode, body) = self.request('/weblogs/html/%23baz/1970-01-01')
+            self.assertEqual(respCode, 404)
+        (respCode, body) = self.request('/weblogs/html/%23baz/')
+        self.assertEqual(respCode, 404)
+
+    def testJson(self):
+        with conf.supybot.plugins.WebLogs.enabled.context(True):
+            self.irc.feedMsg(ircmsgs.privmsg('#json', 'hello',
+                                             prefix='bar!baz@qux'))
+            self.irc.feedMsg(ircmsgs.kick('#json', 'bar', 'go away',
+                                          prefix='op!baz@qux'))
+            (respCode, body) = self.request('/weblogs/json/%23json/')
+            self.assertEqual(respCode, 200)
+            records = [json.loads(line) for line in body.splitlines()]
+            self.assertEqual([(r['command'], r['nick']) for r in records],
+                             [('PRIVMSG', 'bar'), ('KICK', 'op')])
+            self.assertEqual(records[0]['message'], 'hello')
+            self.assertEqual(records[1]['kicked'], 'bar')
+            self.assertEqual(records[1]['reason'], 'go away')
+            (respCode, body) = self.request('/weblogs/json/%%23json/?since=%i'
+                                            % records[1]['timestamp'])
+            self.assertEqual(respCode, 200)
+            self.assertEqual(body, b'')
+            # Lines logged in the same second are not lost with a cursor
+            self.irc.feedMsg(ircmsgs.privmsg('#json', 'again',
+                                             prefix='bar!baz@qux'))
+            (respCode, body) = self.request('/weblogs/json/%%23json/?cursor=%s'
+                                            % records[0]['cursor'])
+            self.assertEqual(respCode, 200)
+            self.assertEqual([json.loads(line)['command']
+                              for line in body.splitlines()],
+                             ['KICK', 'PRIVMSG'])
+            (respCode, body) = self.request('/weblogs/json/%23json/?since=foo')
+            self.assertEqual(respCode, 400)
+            (respCode, body) = self.request('/weblogs/json/%23json/'
+                                            '?since=99999999999999999999')
+            self.assertEqual(respCode, 400)
+            (respCode, body) = self.request('/weblogs/json/%23json/'
+                                            '?cursor=yesterday')
+            self.assertEqual(respCode, 400)
+
+    def testSearch(self):
+        with conf.supybot.plugins.WebLogs.enabled.context(True):
+            self.irc.feedMsg(ircmsgs.privmsg('#search', 'hello world',
+                                             prefix='bar!baz@qux'))
+            with conf.supybot.plugins.WebLogs.search.enabled.context(True):
+                self.assertResponse('weblogs search #search world',
+                                    'No matching line.')
+                self.irc.feedMsg(ircmsgs.privmsg('#search', 'hello you',
+                                                 prefix='bar!baz@qux'))
+                self.irc.feedMsg(ircmsgs.action('#search', 'says hello',
+                                                prefix='qux!baz@qux'))
+                middleware = self.getMiddleware('#search')
+                middleware.flush()
+                middleware._index_thread.join()
+                self.assertTrue(os.path.isfile(os.path.join(
+                    middleware._dir, 'search.db')))
+                self.assertRegexp('weblogs search #search world',
+                                  r'^\[.*\] <bar> hello world$')
+                self.assertRegexp('weblogs search #search says hello',
+                                  r'^\[.*\] \* qux says hello$')
+                self.assertResponse('weblogs search #search foo', 'No matching line.')
+                with conf.supybot.plugins.WebLogs.search.results.context(2):
+                    (respCode, body) = self.request(
+                            '/weblogs/search/%23search/?q=hello')
+                    self.assertEqual(respCode, 200)
+                    self.assertEqual(body.count(b'<li>'), 2)
+                    self.assertIn(b'page=2', body)
+                    (respCode, body) = self.request(
+                            '/weblogs/search/%23search/?q=hello&page=2')
+                    self.assertEqual(body.count(b'<li>'), 1)
+                    self.assertNotIn(b'page=3', body)
+            self.assertError('weblogs search #search hello')
+            (respCode, body) = self.request('/weblogs/search/%23search/?q=hello')
+            self.assertEqual(respCode, 404)
+
+    def testHandles(self):
+        with conf.supybot.plugins.WebLogs.enabled.context(True), \
+                conf.supybot.plugins.WebLogs.buffer.size.context(0), \
+                conf.supybot.plugins.WebLogs.maxOpenFiles.context(1):
+            for channel in ('#handles1', '#handles2', '#handles1'):
+                self.irc.feedMsg(ircmsgs.privmsg(channel, 'hi',
+                                                 prefix='bar!baz@qux'))
+            self.assertRegexp('weblogs handles',
+                              r'^1 open files \(at most 1\), .* [1-9]\d* '
+                              r'evictions\.$')
+            for channel in ('#handles1', '#handles2'):
+                middleware = self.getMiddleware(channel)
+                (day,) = middleware.get_days()
+                self.assertEqual(len(list(middleware.get_lines(day))),
+                                 channel == '#handles1' and 2 or 1)
+
+
+    def testHandleInUse(self):
+        cb = self.irc.getCallback('WebLogs')
+        pool = sys.modules[cb.__module__].HandlePool()
+        class Handle(object):
+            closed = False
+            def close(self):
+                self.closed = True
+        (first, second) = (Handle(), Handle())
+        def evict(handle):
+            # Opening another handle evicts this one, which is in use.
+            pool.use('second', lambda: second, lambda h: None)
+            self.assertFalse(handle.closed)
+        with conf.supybot.plugins.WebLogs.maxOpenFiles.context(1):
+            pool.use('first', lambda: first, evict)
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+        self.assertEqual(pool.evictions, 1)
+        pool.close_all()
+        self.assertTrue(second.closed)
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: